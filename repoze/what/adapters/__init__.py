@@ -31,8 +31,12 @@ and ``its items are the groups that are granted that permission``. Example: If
 ("update-site"), then you can also say that items "developers" and "designers"
 belong to the "update-site" section.
 
-@todo: Add support for "universal sections" (those containing item "_").
-@todo: Add support for "anonymous sections" (those containing item "-").
+Two items have a special meaning: The "universal sections" are those
+containing item "_" (:data:`UNIVERSAL_ITEM`), which apply to every
+authenticated user, and the "anonymous sections" are those containing item "-"
+(:data:`ANONYMOUS_ITEM`), which apply to every anonymous user. For example, if
+the "view-site" section of a permission source contains "_", every
+authenticated user is granted the right to view the web site.
 
 """
 
@@ -40,7 +44,15 @@ from zope.interface import Interface
 
 __all__ = ['BaseSourceAdapter', 'AdapterError', 'SourceError',
            'ExistingSectionError', 'NonExistingSectionError', 
-           'ItemPresentError', 'ItemNotPresentError']
+           'ItemPresentError', 'ItemNotPresentError', 'UNIVERSAL_ITEM',
+           'ANONYMOUS_ITEM']
+
+
+# The item which makes a section apply to every authenticated user:
+UNIVERSAL_ITEM = u'_'
+
+# The item which makes a section apply to every anonymous user:
+ANONYMOUS_ITEM = u'-'
 
 
 class BaseSourceAdapter(object):
@@ -104,21 +116,87 @@ class BaseSourceAdapter(object):
         self.all_sections_loaded = False
         # Whether the current source is writable:
         self.is_writable = writable
+        # The callables to be notified when the source is modified:
+        self.change_listeners = []
+        # The callables which may reject the items to be included:
+        self.inclusion_validators = []
+    
+    def add_change_listener(self, listener):
+        """
+        Notify ``listener`` every time the source is modified through this
+        adapter.
+        
+        :param listener: The callable to be notified; it will receive the
+            adapter, the name of the modified section and the items that were
+            included or excluded (``None`` if the section itself was created,
+            renamed or deleted).
+        
+        This is how the components which cache data retrieved from the source
+        find out that they have to refresh it.
+        
+        """
+        self.change_listeners.append(listener)
     
-    def get_all_sections(self):
+    def add_inclusion_validator(self, validator):
+        """
+        Ask ``validator`` whether some items may be included in a section,
+        before they're included through this adapter.
+        
+        :param validator: The callable which will receive the adapter, the
+            name of the section and the items to be included; it must raise
+            an exception (e.g., :class:`SourceError`) to reject them.
+        
+        This is how the components which rely on the integrity of the source
+        prevent it from being modified in an invalid way.
+        
+        """
+        self.inclusion_validators.append(validator)
+    
+    def get_all_sections(self, reload=False):
         """
         Return all the sections found in the source.
         
+        :param reload: Whether the sections must be retrieved from the source
+            even if they have been loaded already.
+        :type reload: bool
         :return: All the sections found in the source.
         :rtype: dict
         :raise SourceError: If there was a problem with the source.
         
         """
-        if not self.all_sections_loaded:
+        if reload or not self.all_sections_loaded:
             self.loaded_sections = self._get_all_sections()
             self.all_sections_loaded = True
         return self.loaded_sections
     
+    def get_universal_sections(self):
+        """
+        Return the sections which apply to every authenticated user.
+        
+        :return: The sections that contain :data:`UNIVERSAL_ITEM`.
+        :rtype: frozenset
+        :raise SourceError: If there was a problem with the source.
+        
+        """
+        return self._get_sections_with_item(UNIVERSAL_ITEM)
+    
+    def get_anonymous_sections(self):
+        """
+        Return the sections which apply to every anonymous user.
+        
+        :return: The sections that contain :data:`ANONYMOUS_ITEM`.
+        :rtype: frozenset
+        :raise SourceError: If there was a problem with the source.
+        
+        """
+        return self._get_sections_with_item(ANONYMOUS_ITEM)
+    
+    def _get_sections_with_item(self, item):
+        """Return the sections that contain ``item``."""
+        all_sections = self.get_all_sections()
+        return frozenset([section for (section, items) in all_sections.items()
+                          if item in items])
+    
     def get_section_items(self, section):
         """
         Return the properties of ``section``.
@@ -137,12 +215,63 @@ class BaseSourceAdapter(object):
             self.loaded_sections[section] = self._get_section_items(section)
         return self.loaded_sections[section]
     
+    def get_sections_items(self, sections):
+        """
+        Return the items of those ``sections`` which exist.
+        
+        :param sections: The names of the sections to be fetched.
+        :return: The items of each section found, by section.
+        :rtype: dict
+        :raise SourceError: If there was a problem with the source.
+        
+        Unlike :meth:`get_section_items`, the sections which don't exist are
+        skipped and those which have not been loaded yet are retrieved at
+        once, with :meth:`_get_sections_items`.
+        
+        """
+        found_sections = {}
+        unloaded_sections = []
+        for section in sections:
+            if section in self.loaded_sections:
+                found_sections[section] = self.loaded_sections[section]
+            elif not self.all_sections_loaded:
+                unloaded_sections.append(section)
+        if unloaded_sections:
+            retrieved_sections = self._get_sections_items(unloaded_sections)
+            self.loaded_sections.update(retrieved_sections)
+            found_sections.update(retrieved_sections)
+        return found_sections
+    
+    def item_is_included(self, section, item):
+        """
+        Check whether ``section`` exists and includes ``item``.
+        
+        :param section: The name of the section that may include the item.
+        :type section: unicode
+        :param item: The name of the item to look for.
+        :type item: unicode
+        :return: Whether the item is included in the section or not.
+        :rtype: bool
+        :raise SourceError: If there was a problem with the source.
+        
+        Unlike :meth:`get_section_items`, it won't retrieve all the items of
+        the section unless they have been loaded already.
+        
+        """
+        if section in self.loaded_sections:
+            return item in self.loaded_sections[section]
+        if not self._section_exists(section):
+            return False
+        return self._item_is_included(section, item)
+    
     def set_section_items(self, section, items):
         """
         Set ``items`` as the only items of the ``section``.
         
         :raise NonExistingSectionError: If the section doesn't exist.
-        :raise SourceError: If there was a problem with the source.
+        :raise SourceError: If there was a problem with the source or an
+            :meth:`inclusion validator <add_inclusion_validator>` rejected
+            the new items.
         
         """
         old_items = self.get_section_items(section)
@@ -150,6 +279,9 @@ class BaseSourceAdapter(object):
         # Finding what was added and what was removed:
         added = set((i for i in items if i not in old_items))
         removed = set((i for i in old_items if i not in items))
+        # The new items are validated before anything is removed:
+        if added:
+            self._validate_inclusion(section, added)
         # Removing/adding as requested. We're removing first to avoid
         # increasing the size of the source more than required.
         self.exclude_items(section, removed)
@@ -199,7 +331,9 @@ class BaseSourceAdapter(object):
         :raise NonExistingSectionError: If the ``section`` doesn't exist.
         :raise ItemPresentError: If at least one of the items is already
             present.
-        :raise SourceError: If there was a problem with the source.
+        :raise SourceError: If there was a problem with the source or an
+            :meth:`inclusion validator <add_inclusion_validator>` rejected
+            the items.
         
         """
         # Verifying that the section exists and doesn't already contain the
@@ -209,12 +343,14 @@ class BaseSourceAdapter(object):
             self._confirm_item_not_present(section, i)
         # Verifying write permissions:
         self._check_writable()
-        # Everything's OK, let's add it:
         items = set(items)
+        self._validate_inclusion(section, items)
+        # Everything's OK, let's add it:
         self._include_items(section, items)
         # Updating the cache, if necessary:
         if section in self.loaded_sections:
             self.loaded_sections[section] |= items
+        self._notify_change(section, items)
     
     def exclude_item(self, section, item):
         """
@@ -261,6 +397,7 @@ class BaseSourceAdapter(object):
         # Updating the cache, if necessary:
         if section in self.loaded_sections:
             self.loaded_sections[section] -= items
+        self._notify_change(section, items)
     
     def create_section(self, section):
         """
@@ -277,6 +414,7 @@ class BaseSourceAdapter(object):
         self._create_section(section)
         # Adding to the cache:
         self.loaded_sections[section] = set()
+        self._notify_change(section)
         
     def edit_section(self, section, new_section):
         """
@@ -297,6 +435,8 @@ class BaseSourceAdapter(object):
         if section in self.loaded_sections:
             self.loaded_sections[new_section] = self.loaded_sections[section]
             del self.loaded_sections[section]
+        self._notify_change(section)
+        self._notify_change(new_section)
         
     def delete_section(self, section):
         """
@@ -317,6 +457,32 @@ class BaseSourceAdapter(object):
         # Removing from the cache too, if loaded:
         if section in self.loaded_sections:
             del self.loaded_sections[section]
+        self._notify_change(section)
+    
+    def _validate_inclusion(self, section, items):
+        """
+        Ask the :meth:`inclusion validators <add_inclusion_validator>` whether
+        ``items`` may be included in ``section``.
+        
+        """
+        # Adapters which don't call the constructor don't have validators:
+        for validator in getattr(self, 'inclusion_validators', ()):
+            validator(self, section, items)
+    
+    def _notify_change(self, section, items=None):
+        """
+        Notify the change listeners that ``section`` has been modified.
+        
+        :param section: The name of the modified section.
+        :type section: unicode
+        :param items: The items included in or excluded from the section, if
+            that's what changed.
+        :type items: set
+        
+        """
+        # Adapters which don't call the constructor don't have listeners:
+        for listener in getattr(self, 'change_listeners', ()):
+            listener(self, section, items)
     
     def _check_writable(self):
         """
@@ -393,6 +559,28 @@ class BaseSourceAdapter(object):
                                                                      section)
             raise ItemPresentError(msg)
     
+    def _get_sections_items(self, sections):
+        """
+        Return the items of those ``sections`` which exist.
+        
+        :param sections: The names of the sections to be fetched.
+        :type sections: list
+        :return: The items of each section found, by section.
+        :rtype: dict
+        :raise SourceError: If there was a problem with the source while
+            retrieving the sections.
+        
+        By default, each section is retrieved with :meth:`_get_section_items`.
+        Adapters whose source can retrieve many sections at once (e.g., with a
+        single query to a database) should override this method.
+        
+        """
+        sections_items = {}
+        for section in sections:
+            if self._section_exists(section):
+                sections_items[section] = self._get_section_items(section)
+        return sections_items
+    
     #{ Abstract methods
     
     def _get_all_sections(self):
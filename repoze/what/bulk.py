@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2008-2009, Gustavo Narea <me@gustavonarea.net>
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+"""
+Evaluation of predicates for many users at once.
+
+The groups and permissions of the users are encoded as columns with one bit
+per user, so the built-in predicates are evaluated by combining the columns
+instead of evaluating the predicate for each user. `NumPy
+<http://numpy.scipy.org/>`_ is used if it's available.
+
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from repoze.what.predicates import All, Any, Not, is_user, in_group, \
+                                   in_all_groups, in_any_group, \
+                                   has_permission, has_all_permissions, \
+                                   has_any_permission, is_anonymous, \
+                                   not_anonymous
+
+__all__ = ['CredentialsMatrix']
+
+
+class CredentialsMatrix(object):
+    """
+    The groups and permissions of many users, to find which of them meet a
+    predicate.
+
+    Example::
+
+        users = [Credentials(u.user_name, u.groups, u.permissions)
+                 for u in all_the_users]
+        matrix = CredentialsMatrix(users)
+        reviewers = matrix.find_users(All(in_group('staff'),
+                                          has_permission('review')))
+
+    The built-in predicates are evaluated for all the users at once; the
+    other predicates are evaluated for each user, with a WSGI environment
+    which only contains the ``credentials``.
+
+    """
+
+    def __init__(self, credentials, use_numpy=None):
+        """
+        :param credentials: The :mod:`repoze.what` ``credentials`` of each
+            user.
+        :type credentials: list
+        :param use_numpy: Whether to encode the columns as NumPy arrays
+            instead of Python integers; by default, NumPy is used if it's
+            available.
+        :type use_numpy: bool
+        :raise ValueError: If ``use_numpy`` is ``True`` but NumPy is not
+            available.
+
+        """
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        elif use_numpy and numpy is None:
+            raise ValueError('NumPy is not available')
+        self.credentials = list(credentials)
+        self.userids = [c.get('repoze.what.userid') for c in self.credentials]
+        if use_numpy:
+            self._columns = _NumPyColumns(len(self.credentials))
+        else:
+            self._columns = _BitColumns(len(self.credentials))
+        # The positions of the users in each group and with each permission:
+        group_positions = {}
+        permission_positions = {}
+        for (position, user_credentials) in enumerate(self.credentials):
+            for group in user_credentials.get('groups', ()):
+                group_positions.setdefault(group, []).append(position)
+            for permission in user_credentials.get('permissions', ()):
+                permission_positions.setdefault(permission,
+                                                []).append(position)
+        self._group_columns = self._make_columns(group_positions)
+        self._permission_columns = self._make_columns(permission_positions)
+        self._authenticated_column = self._columns.make(
+            [i for (i, u) in enumerate(self.userids) if u is not None])
+
+    def _make_columns(self, positions):
+        """Return the column of each section, given its users' positions."""
+        columns = {}
+        for (section, section_positions) in positions.items():
+            columns[section] = self._columns.make(section_positions)
+        return columns
+
+    def evaluate(self, predicate):
+        """
+        Find which users meet ``predicate``.
+
+        :param predicate: The predicate to be evaluated.
+        :type predicate: :class:`repoze.what.predicates.Predicate`
+        :return: The users who meet the predicate, as a column whose bit
+            number ``i`` is set if the user number ``i`` meets it: A NumPy
+            array of booleans or a Python integer.
+
+        """
+        return self._evaluate(predicate, {})
+
+    def find_users(self, predicate):
+        """
+        Return the userids of the users who meet ``predicate``.
+
+        :param predicate: The predicate to be evaluated.
+        :type predicate: :class:`repoze.what.predicates.Predicate`
+        :rtype: list
+
+        """
+        column = self.evaluate(predicate)
+        return [self.userids[i] for i in self._columns.positions(column)]
+
+    def _evaluate(self, predicate, results):
+        """
+        Return the column of ``predicate``, reusing the ``results`` of the
+        predicates evaluated previously.
+
+        """
+        try:
+            return results[predicate]
+        except KeyError:
+            evaluator = _EVALUATORS.get(type(predicate),
+                                        CredentialsMatrix._evaluate_each)
+            column = results[predicate] = evaluator(self, predicate, results)
+            return column
+
+    def _evaluate_all(self, predicate, results):
+        column = self._columns.every()
+        for p in predicate.predicates:
+            column = self._columns.intersection(column,
+                                                self._evaluate(p, results))
+        return column
+
+    def _evaluate_any(self, predicate, results):
+        column = self._columns.none()
+        for p in predicate.predicates:
+            column = self._columns.union(column, self._evaluate(p, results))
+        return column
+
+    def _evaluate_not(self, predicate, results):
+        return self._columns.complement(self._evaluate(predicate.predicate,
+                                                       results))
+
+    def _evaluate_is_user(self, predicate, results):
+        return self._columns.make([i for (i, u) in enumerate(self.userids)
+                                   if u == predicate.user_name])
+
+    def _evaluate_in_group(self, predicate, results):
+        return self._get_column(self._group_columns, predicate.group_name)
+
+    def _evaluate_has_permission(self, predicate, results):
+        return self._get_column(self._permission_columns,
+                                predicate.permission_name)
+
+    def _evaluate_in_all_groups(self, predicate, results):
+        return self._get_intersection(self._group_columns,
+                                      predicate.group_names)
+
+    def _evaluate_in_any_group(self, predicate, results):
+        return self._get_union(self._group_columns, predicate.group_names)
+
+    def _evaluate_has_all_permissions(self, predicate, results):
+        return self._get_intersection(self._permission_columns,
+                                      predicate.permission_names)
+
+    def _evaluate_has_any_permission(self, predicate, results):
+        return self._get_union(self._permission_columns,
+                               predicate.permission_names)
+
+    def _evaluate_not_anonymous(self, predicate, results):
+        return self._authenticated_column
+
+    def _evaluate_is_anonymous(self, predicate, results):
+        return self._columns.complement(self._authenticated_column)
+
+    def _evaluate_each(self, predicate, results):
+        """Evaluate a predicate which is not built-in for each user."""
+        positions = []
+        for (position, credentials) in enumerate(self.credentials):
+            if predicate.is_met({'repoze.what.credentials': credentials}):
+                positions.append(position)
+        return self._columns.make(positions)
+
+    def _get_column(self, columns, section):
+        """Return the column of ``section``, which may have no users."""
+        column = columns.get(section)
+        if column is None:
+            return self._columns.none()
+        return column
+
+    def _get_intersection(self, columns, sections):
+        """Return the users who have all the ``sections``."""
+        column = self._columns.every()
+        for section in sections:
+            column = self._columns.intersection(
+                column, self._get_column(columns, section))
+        return column
+
+    def _get_union(self, columns, sections):
+        """Return the users who have any of the ``sections``."""
+        column = self._columns.none()
+        for section in sections:
+            column = self._columns.union(column,
+                                         self._get_column(columns, section))
+        return column
+
+
+class _BitColumns(object):
+    """
+    Operations on columns encoded as Python integers, where bit number ``i``
+    represents user number ``i``.
+
+    """
+
+    def __init__(self, size):
+        """
+        :param size: The number of users.
+        :type size: int
+
+        """
+        self.size = size
+
+    def make(self, positions):
+        """Return the column where the users at ``positions`` are set."""
+        if not positions:
+            return 0
+        digits = ['0'] * self.size
+        for position in positions:
+            digits[self.size - position - 1] = '1'
+        return int(''.join(digits), 2)
+
+    def every(self):
+        return (1 << self.size) - 1
+
+    def none(self):
+        return 0
+
+    def intersection(self, column1, column2):
+        return column1 & column2
+
+    def union(self, column1, column2):
+        return column1 | column2
+
+    def complement(self, column):
+        return self.every() ^ column
+
+    def positions(self, column):
+        """Return the positions of the users set in ``column``."""
+        digits = ''.join([_HEX_DIGITS[d] for d in '%x' % column])
+        size = len(digits)
+        return [size - i - 1 for i in range(size - 1, -1, -1)
+                if digits[i] == '1']
+
+
+class _NumPyColumns(object):
+    """Operations on columns encoded as NumPy arrays of booleans."""
+
+    def __init__(self, size):
+        """
+        :param size: The number of users.
+        :type size: int
+
+        """
+        self.size = size
+
+    def make(self, positions):
+        """Return the column where the users at ``positions`` are set."""
+        column = numpy.zeros(self.size, dtype=bool)
+        column[list(positions)] = True
+        return column
+
+    def every(self):
+        return numpy.ones(self.size, dtype=bool)
+
+    def none(self):
+        return numpy.zeros(self.size, dtype=bool)
+
+    def intersection(self, column1, column2):
+        return column1 & column2
+
+    def union(self, column1, column2):
+        return column1 | column2
+
+    def complement(self, column):
+        return ~column
+
+    def positions(self, column):
+        """Return the positions of the users set in ``column``."""
+        return numpy.flatnonzero(column).tolist()
+
+
+# The binary representation of each hexadecimal digit:
+_HEX_DIGITS = {
+    '0': '0000', '1': '0001', '2': '0010', '3': '0011',
+    '4': '0100', '5': '0101', '6': '0110', '7': '0111',
+    '8': '1000', '9': '1001', 'a': '1010', 'b': '1011',
+    'c': '1100', 'd': '1101', 'e': '1110', 'f': '1111',
+    }
+
+# The methods which evaluate each type of built-in predicate:
+_EVALUATORS = {
+    All: CredentialsMatrix._evaluate_all,
+    Any: CredentialsMatrix._evaluate_any,
+    Not: CredentialsMatrix._evaluate_not,
+    is_user: CredentialsMatrix._evaluate_is_user,
+    in_group: CredentialsMatrix._evaluate_in_group,
+    has_permission: CredentialsMatrix._evaluate_has_permission,
+    in_all_groups: CredentialsMatrix._evaluate_in_all_groups,
+    in_any_group: CredentialsMatrix._evaluate_in_any_group,
+    has_all_permissions: CredentialsMatrix._evaluate_has_all_permissions,
+    has_any_permission: CredentialsMatrix._evaluate_has_any_permission,
+    is_anonymous: CredentialsMatrix._evaluate_is_anonymous,
+    not_anonymous: CredentialsMatrix._evaluate_not_anonymous,
+    }
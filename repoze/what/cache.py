@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2008-2009, Gustavo Narea <me@gustavonarea.net>
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+"""
+In-memory caches shared among the threads of a process.
+
+"""
+
+import time
+from collections import deque
+from threading import Lock
+
+__all__ = ['TTLCache']
+
+
+class TTLCache(object):
+    """
+    Thread-safe, size-bounded cache whose entries expire after a while.
+
+    When the cache is full, the oldest entry is evicted to make room for the
+    new one.
+
+    """
+
+    def __init__(self, max_size=1000, ttl=None, timer=None):
+        """
+        Create an empty cache.
+
+        :param max_size: The maximum number of entries kept at once.
+        :type max_size: int
+        :param ttl: The number of seconds an entry is valid for; if ``None``,
+            entries never expire.
+        :type ttl: int
+        :param timer: The function that returns the current time, in seconds
+            (defaults to :func:`time.time`).
+
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.timer = timer or time.time
+        # The cached entries, as in {key: (stamp, expiration_time, value)}:
+        self._entries = {}
+        # The (key, stamp) pairs, in the order they were stored. Pairs whose
+        # stamp doesn't match the entry's anymore are stale and get skipped:
+        self._order = deque()
+        self._stamp = 0
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the value cached for ``key``, or ``default`` if it's not cached
+        or it has expired.
+
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        stamp, expiration_time, value = entry
+        if expiration_time is not None and expiration_time <= self.timer():
+            self.invalidate(key)
+            return default
+        return value
+
+    def set(self, key, value):
+        """Cache ``value`` under ``key``."""
+        if self.ttl is None:
+            expiration_time = None
+        else:
+            expiration_time = self.timer() + self.ttl
+        self._lock.acquire()
+        try:
+            if key not in self._entries:
+                while len(self._entries) >= self.max_size and self._order:
+                    self._evict_oldest()
+            self._stamp += 1
+            self._entries[key] = (self._stamp, expiration_time, value)
+            self._order.append((key, self._stamp))
+            if len(self._order) > 2 * self.max_size:
+                self._compact()
+        finally:
+            self._lock.release()
+
+    def invalidate(self, key):
+        """Remove the entry for ``key``, if any."""
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Remove all the entries."""
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._order.clear()
+        finally:
+            self._lock.release()
+
+    def _evict_oldest(self):
+        """Remove the oldest entry; the lock must be held by the caller."""
+        key, stamp = self._order.popleft()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            del self._entries[key]
+
+    def _compact(self):
+        """Forget the stale pairs; the lock must be held by the caller."""
+        self._order = deque([(k, s) for (k, s) in self._order
+                             if k in self._entries and
+                                self._entries[k][0] == s])
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_MISSING = object()
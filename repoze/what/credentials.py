@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2008-2009, Gustavo Narea <me@gustavonarea.net>
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+"""
+The :mod:`repoze.what` ``credentials`` dictionary and the containers for the
+groups and permissions in it.
+
+"""
+
+from threading import Lock
+
+__all__ = ['Credentials', 'SectionSet', 'LazySections', 'DemandSections',
+           'SectionIndex', 'BitmaskSections']
+
+# The maximum number of masks of required sections remembered by a
+# SectionIndex:
+_MASK_CACHE_SIZE = 1000
+
+
+class Credentials(dict):
+    """
+    The :mod:`repoze.what` ``credentials`` dictionary.
+
+    It's a regular dictionary with the ``repoze.what.userid``, ``groups`` and
+    ``permissions`` items, which are also available as attributes.
+
+    """
+
+    __slots__ = ()
+
+    def __init__(self, userid, groups=(), permissions=()):
+        """
+        :param userid: The identifier of the authenticated user (``None`` if
+            the user is anonymous).
+        :param groups: The groups to which the user belongs.
+        :param permissions: The permissions granted to the user.
+
+        """
+        dict.__init__(self)
+        self['repoze.what.userid'] = userid
+        self['groups'] = groups
+        self['permissions'] = permissions
+
+    def __nonzero__(self):
+        # The credentials of anonymous users are false, like the empty
+        # dictionary used when there are no credentials at all:
+        return self.userid is not None
+
+    @property
+    def userid(self):
+        return self.get('repoze.what.userid')
+
+    @property
+    def groups(self):
+        return self.get('groups', ())
+
+    @property
+    def permissions(self):
+        return self.get('permissions', ())
+
+
+class SectionSet(frozenset):
+    """
+    Immutable set of :term:`sections <section>` which can be used as a tuple.
+
+    The groups and permissions used to be stored as tuples, so it can be
+    indexed and it's equal to the tuples and lists with the same sections (in
+    any order). Unlike them, checking whether it contains a section takes
+    constant time.
+
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __eq__(self, other):
+        if isinstance(other, (tuple, list)):
+            other = frozenset(other)
+        return frozenset.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = frozenset.__hash__
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+
+class LazySections(object):
+    """
+    Tuple-like collection of :term:`sections <section>` which are only
+    retrieved when they are used for the first time.
+
+    """
+
+    def __init__(self, loader):
+        """
+        :param loader: The callable that returns the sections.
+
+        """
+        self._loader = loader
+        self._sections = None
+
+    @property
+    def loaded(self):
+        """Whether the sections have been retrieved already."""
+        return self._sections is not None
+
+    def _load(self):
+        """Retrieve the sections, if they have not been retrieved yet."""
+        if self._sections is None:
+            sections = self._loader()
+            if not isinstance(sections, (SectionSet, BitmaskSections)):
+                sections = SectionSet(sections)
+            self._sections = sections
+            self._loader = None
+        return self._sections
+
+    def __contains__(self, section):
+        return section in self._load()
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __getitem__(self, index):
+        return self._load()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, LazySections):
+            other = other._load()
+        return self._load() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        if self._sections is None:
+            return '<%s (not loaded)>' % self.__class__.__name__
+        return repr(self._sections)
+
+    def __str__(self):
+        return str(self._load())
+
+
+class DemandSections(LazySections):
+    """
+    Tuple-like collection of :term:`sections <section>` which finds whether
+    it contains a given section without retrieving all of them.
+
+    The answers are memoised, so each section is only looked up once. All the
+    sections are retrieved when the collection is used in any other way (e.g.,
+    when iterating over it).
+
+    """
+
+    def __init__(self, loader, checker):
+        """
+        :param loader: The callable that returns all the sections.
+        :param checker: The callable that checks whether the section passed
+            is included in the collection.
+
+        """
+        super(DemandSections, self).__init__(loader)
+        self._checker = checker
+        self._answers = {}
+
+    def __contains__(self, section):
+        if self._sections is not None:
+            return section in self._sections
+        try:
+            return self._answers[section]
+        except KeyError:
+            answer = self._answers[section] = bool(self._checker(section))
+            return answer
+
+
+class SectionIndex(object):
+    """
+    Dense integer identifiers of :term:`sections <section>`, used to encode
+    collections of sections as bitmasks.
+
+    Each section is assigned a bit the first time it's encoded, which never
+    changes afterwards, so the masks remain valid when new sections are
+    added.
+
+    """
+
+    def __init__(self, sections=()):
+        """
+        :param sections: The sections known in advance.
+
+        """
+        # The bit of each section, and the sections by position:
+        self._bits = {}
+        self._sections = []
+        # The masks of the sets of required sections, all of which have a bit:
+        self._masks = {}
+        self._lock = Lock()
+        for section in sections:
+            self._add(section)
+
+    def __len__(self):
+        return len(self._sections)
+
+    def __contains__(self, section):
+        return section in self._bits
+
+    def _add(self, section):
+        """Return the bit of ``section``, assigning it one if necessary."""
+        self._lock.acquire()
+        try:
+            bit = self._bits.get(section)
+            if bit is None:
+                bit = 1L << len(self._sections)
+                # The section is listed before its bit is published, so that
+                # decode() always finds it:
+                self._sections.append(section)
+                self._bits[section] = bit
+            return bit
+        finally:
+            self._lock.release()
+
+    def encode(self, sections):
+        """
+        Return the ``sections`` as a bitmask.
+
+        :rtype: BitmaskSections
+
+        """
+        bits = self._bits
+        mask = 0
+        for section in sections:
+            bit = bits.get(section)
+            if bit is None:
+                bit = self._add(section)
+            mask |= bit
+        return BitmaskSections(mask, self)
+
+    def decode(self, mask):
+        """Return the sections whose bits are set in ``mask``."""
+        return [s for (position, s) in enumerate(self._sections)
+                if (mask >> position) & 1]
+
+    def get_mask(self, sections):
+        """
+        Return the mask of the ``sections`` which have a bit, and whether
+        all of them have one.
+
+        The masks of the frozen sets of sections which have a bit (like those
+        of the built-in predicates) are remembered.
+
+        """
+        try:
+            return self._masks[sections], True
+        except (KeyError, TypeError):
+            pass
+        bits = self._bits
+        mask = 0
+        complete = True
+        for section in sections:
+            bit = bits.get(section)
+            if bit is None:
+                complete = False
+            else:
+                mask |= bit
+        if complete and isinstance(sections, frozenset):
+            if len(self._masks) >= _MASK_CACHE_SIZE:
+                self._masks.clear()
+            self._masks[sections] = mask
+        return mask, complete
+
+
+class BitmaskSections(object):
+    """
+    Tuple-like collection of :term:`sections <section>` encoded as a bitmask
+    by a :class:`SectionIndex`.
+
+    Like :class:`SectionSet`, it's equal to the tuples, lists and sets with the
+    same sections. Checking whether it contains one or many sections only
+    takes a few integer operations, and it only takes the memory of the
+    integer.
+
+    """
+
+    __slots__ = ('mask', 'index')
+
+    def __init__(self, mask, index):
+        """
+        :param mask: The bits of the sections.
+        :type mask: long
+        :param index: The index which assigned the bits.
+        :type index: SectionIndex
+
+        """
+        self.mask = mask
+        self.index = index
+
+    def __contains__(self, section):
+        bit = self.index._bits.get(section)
+        return bit is not None and (self.mask & bit) != 0
+
+    def includes_all(self, sections):
+        """Check whether it contains all the ``sections``."""
+        need, complete = self.index.get_mask(sections)
+        return complete and (self.mask & need) == need
+
+    def includes_any(self, sections):
+        """Check whether it contains at least one of the ``sections``."""
+        return (self.mask & self.index.get_mask(sections)[0]) != 0
+
+    def __iter__(self):
+        return iter(self.index.decode(self.mask))
+
+    def __len__(self):
+        return len(self.index.decode(self.mask))
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __eq__(self, other):
+        if isinstance(other, BitmaskSections) and other.index is self.index:
+            return self.mask == other.mask
+        if isinstance(other, LazySections):
+            other = other._load()
+        if not isinstance(other, (BitmaskSections, tuple, list, set,
+                                  frozenset)):
+            return False
+        return frozenset(self) == frozenset(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(frozenset(self))
+
+    def __repr__(self):
+        return repr(tuple(self))
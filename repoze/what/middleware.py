@@ -22,6 +22,9 @@ use repoze.what.
 """
 
 import os
+import re
+import time
+from threading import Lock
 
 from zope.interface import implements
 from repoze.who.plugins.testutil import make_middleware
@@ -29,9 +32,33 @@ from repoze.who.classifiers import default_challenge_decider, \
                                    default_request_classifier
 from repoze.who.interfaces import IAuthenticator, IMetadataProvider
 
+from repoze.what.adapters import SourceError, UNIVERSAL_ITEM, ANONYMOUS_ITEM
+from repoze.what.cache import TTLCache
+from repoze.what.credentials import Credentials, SectionSet, LazySections, \
+                                    DemandSections, SectionIndex
+from repoze.what.predicates import All, Any, Not, is_user, in_group, \
+                                   in_all_groups, in_any_group, \
+                                   has_permission, has_all_permissions, \
+                                   has_any_permission, is_anonymous, \
+                                   not_anonymous
+
 __all__ = ['AuthorizationMetadata', 'setup_auth']
 
 
+# The setup_auth() keyword arguments which are passed to AuthorizationMetadata
+# instead of repoze.who:
+_METADATA_ARGS = ('permissions_cache_size', 'permissions_cache_ttl',
+                  'credentials_cache_size', 'credentials_cache_ttl',
+                  'credentials_mode', 'permissions_table',
+                  'permissions_table_ttl', 'bypass_paths', 'bypass_patterns',
+                  'nested_groups', 'permission_implications',
+                  'special_sections', 'decision_cache_size',
+                  'decision_cache_ttl', 'bitmask_credentials')
+
+# The ways the groups and permissions of the user may be loaded:
+_CREDENTIALS_MODES = ('eager', 'lazy', 'on-demand')
+
+
 class AuthorizationMetadata(object):
     """
     repoze.who metadata provider to load groups and permissions data for
@@ -45,7 +72,15 @@ class AuthorizationMetadata(object):
     
     implements(IMetadataProvider)
     
-    def __init__(self, group_adapters=None, permission_adapters=None):
+    def __init__(self, group_adapters=None, permission_adapters=None,
+                 permissions_cache_size=None, permissions_cache_ttl=None,
+                 credentials_cache_size=None, credentials_cache_ttl=None,
+                 credentials_mode='eager', permissions_table=False,
+                 permissions_table_ttl=None, bypass_paths=None,
+                 bypass_patterns=None, nested_groups=False,
+                 permission_implications=None, special_sections=False,
+                 decision_cache_size=None, decision_cache_ttl=None,
+                 bitmask_credentials=False):
         """
         Fetch the groups and permissions of the authenticated user.
         
@@ -55,10 +90,454 @@ class AuthorizationMetadata(object):
         :param permission_adapters: Set of adapters that retrieve the
             permissions for the groups, each identified by a keyword.
         :type permission_adapters: dict
+        :param permissions_cache_size: The maximum number of groups whose
+            permissions may be cached at once; if ``None``, the permissions
+            of a group are retrieved every time they're needed.
+        :type permissions_cache_size: int
+        :param permissions_cache_ttl: The number of seconds the permissions
+            of a group may be cached for; if ``None``, they won't expire.
+        :type permissions_cache_ttl: int
+        :param credentials_cache_size: The maximum number of users whose
+            groups and permissions may be cached at once; if ``None``, they
+            are retrieved on every request.
+        :type credentials_cache_size: int
+        :param credentials_cache_ttl: The number of seconds the groups and
+            permissions of a user may be cached for; if ``None``, they won't
+            expire.
+        :type credentials_cache_ttl: int
+        :param credentials_mode: How the groups and permissions of the user
+            are loaded: ``"eager"`` (as soon as the user is authenticated),
+            ``"lazy"`` (the first time a predicate checks them) or
+            ``"on-demand"`` (one by one, as predicates check them).
+        :type credentials_mode: str
+        :param permissions_table: Whether to load the permissions granted to
+            every group when the plugin is created, instead of retrieving
+            them as they're needed.
+        :type permissions_table: bool
+        :param permissions_table_ttl: The number of seconds after which the
+            table of permissions is reloaded; if ``None``, it's only reloaded
+            when a permission is modified through its adapter.
+        :type permissions_table_ttl: int
+        :param bypass_paths: The prefixes of the paths whose requests don't
+            load the groups and permissions of the user unless a predicate
+            checks them (e.g., ``["/static/", "/health"]``).
+        :type bypass_paths: list
+        :param bypass_patterns: The regular expressions for the paths whose
+            requests don't load the groups and permissions of the user unless
+            a predicate checks them; they must match the beginning of the path.
+        :type bypass_patterns: list
+        :param nested_groups: Whether groups may belong to other groups.
+        :type nested_groups: bool
+        :param permission_implications: The permissions implied by each
+            permission, as in ``{"admin": ["edit"], "edit": ["view"]}``.
+        :type permission_implications: dict
+        :param special_sections: Whether to support the universal and
+            anonymous :term:`sections <section>`.
+        :type special_sections: bool
+        :param decision_cache_size: The maximum number of results of
+            predicates which may be cached at once; if ``None``, the
+            predicates are evaluated on every request.
+        :type decision_cache_size: int
+        :param decision_cache_ttl: The number of seconds the result of a
+            predicate may be cached for; if ``None``, they won't expire.
+        :type decision_cache_ttl: int
+        :param bitmask_credentials: Whether to encode the groups and
+            permissions of the authenticated users as bitmasks.
+        :type bitmask_credentials: bool
+        :raise ValueError: If ``credentials_mode`` is not supported or the
+            permissions imply each other.
+        :raise SourceError: If the table of permissions, the hierarchy of
+            groups, the special sections or the indexes of sections could not
+            be loaded, or the groups belong to each other.
+        
+        The permissions granted to a group are the same for every user, so
+        when ``permissions_cache_size`` is set they are shared among all the
+        users and requests. The cache is cleared when a permission is modified
+        through its :term:`permission adapter`.
+        
+        The groups and permissions of each user are cached by their
+        ``repoze.who.userid`` when ``credentials_cache_size`` is set, so the
+        :term:`group adapters <group adapter>` must find the groups of a user
+        from the userid alone. Modifications made through the adapters are
+        taken into account automatically; otherwise, use
+        :meth:`invalidate_user` or :meth:`invalidate_all`.
+        
+        In the ``"lazy"`` mode, the ``groups`` and ``permissions`` items of
+        the ``credentials`` and ``identity`` dictionaries are
+        :class:`repoze.what.credentials.LazySections`, so the requests which
+        don't evaluate groups- or permissions-based predicates don't have to
+        use the adapters at all.
+        
+        When ``permissions_table`` is enabled, all the sections of every
+        :term:`permission adapter` are retrieved at once and indexed by group,
+        so finding the permissions of a user doesn't use the permission
+        adapters at all. This requires :class:`adapters
+        <repoze.what.adapters.BaseSourceAdapter>` which can retrieve all of
+        their sections.
+        
+        When ``nested_groups`` is enabled, the items of a group may be other
+        groups, whose members also belong to the former. For example, if
+        group "developers" is an item of group "staff", the members of
+        "developers" also belong to "staff". The hierarchy of groups is loaded
+        when the plugin is created and kept up-to-date as groups are modified
+        through their adapters, so the adapters are not asked about the
+        groups of the groups on every request. This requires
+        :class:`adapters <repoze.what.adapters.BaseSourceAdapter>` which can
+        retrieve all of their sections, and the names of the users must not
+        be the names of groups.
+        
+        When ``permission_implications`` is set, the users who are granted a
+        permission are also granted the permissions it implies, directly or
+        indirectly. In the example above, the users granted "admin" are also
+        granted "edit" and "view". All the implied permissions are computed
+        when the plugin is created and they are included in the
+        ``permissions`` of the ``credentials``.
+        
+        The requests whose path (``PATH_INFO``) matches ``bypass_paths`` or
+        ``bypass_patterns`` always get the groups and permissions in the
+        ``"lazy"`` mode: That's where static files, health checks and similar
+        resources are usually served.
+        
+        When ``special_sections`` is enabled, the sections which contain the
+        :data:`universal item <repoze.what.adapters.UNIVERSAL_ITEM>` ("_")
+        apply to every authenticated user and those which contain the
+        :data:`anonymous item <repoze.what.adapters.ANONYMOUS_ITEM>` ("-")
+        apply to every anonymous user. For example, every authenticated user
+        belongs to a group which contains "_", and every anonymous user is
+        granted a permission which contains "-". Such groups and permissions
+        are found when the plugin is created, and reloaded when a section is
+        modified through its adapter, so they are merged into the
+        ``credentials`` of each request without using the adapters.
+        
+        When ``decision_cache_size`` is set, the results of the
+        :attr:`cacheable <repoze.what.predicates.Predicate.cacheable>`
+        predicates (like the built-in ones) evaluated with
+        :meth:`is_met() <repoze.what.predicates.Predicate.is_met>` or
+        :meth:`check_authorization()
+        <repoze.what.predicates.Predicate.check_authorization>` are cached by
+        predicate and ``credentials``, and shared among all the requests. The
+        cache is cleared when a group or permission is modified through its
+        adapter, as well as by :meth:`invalidate_user` and
+        :meth:`invalidate_all`. The cache is not used while the groups and
+        permissions of the user have not been loaded (in the ``"lazy"`` and
+        ``"on-demand"`` modes, and on the paths which bypass them), because
+        the results would not reflect the changes made to them directly in
+        the sources.
+        
+        When ``bitmask_credentials`` is enabled, every group and permission
+        is assigned a bit when the plugin is created (see
+        :meth:`load_section_indexes`), and the ``groups`` and ``permissions``
+        of the authenticated users are
+        :class:`repoze.what.credentials.BitmaskSections`: The built-in
+        predicates are then evaluated with a few integer operations (e.g.,
+        :class:`in_all_groups <repoze.what.predicates.in_all_groups>` checks
+        that all the bits of its groups are set), and the cached credentials
+        only take the memory of two integers. The sections created
+        afterwards are assigned a bit when a user is found to have them. This
+        requires :class:`adapters <repoze.what.adapters.BaseSourceAdapter>`
+        which can retrieve all of their sections.
+        
+        In the ``"on-demand"`` mode, the ``groups`` and ``permissions`` are
+        :class:`repoze.what.credentials.DemandSections` instead: Checking
+        whether the user belongs to a group or has a permission only asks the
+        adapters about that group or permission, and the answer is memoised
+        for the rest of the request. To find whether a user belongs to a group,
+        the :term:`group adapters <group adapter>` are expected to use the
+        userids as the items of the groups.
         
         """
+        if credentials_mode not in _CREDENTIALS_MODES:
+            raise ValueError('Unsupported credentials mode: %s' %
+                             credentials_mode)
+        self.credentials_mode = credentials_mode
+        self._is_bypassed = _compile_path_matcher(bypass_paths,
+                                                  bypass_patterns)
         self.group_adapters = group_adapters
         self.permission_adapters = permission_adapters
+        self.permissions_cache = _make_cache(permissions_cache_size,
+                                             permissions_cache_ttl)
+        self.credentials_cache = _make_cache(credentials_cache_size,
+                                             credentials_cache_ttl)
+        self.decision_cache = _make_cache(decision_cache_size,
+                                          decision_cache_ttl)
+        self.permissions_table_ttl = permissions_table_ttl
+        self._timer = time.time
+        self._permissions_table = None
+        self._permissions_table_expiration = None
+        self._permissions_table_lock = Lock()
+        self.use_permissions_table = permissions_table
+        if permissions_table:
+            self.load_permissions_table()
+        # The hierarchy of groups, as in {group: frozenset(related groups)},
+        # where each group is related to itself:
+        self.nested_groups = nested_groups
+        self._group_ancestors = {}
+        self._group_descendants = {}
+        if nested_groups:
+            self.load_group_hierarchy()
+        # The permissions implied by each permission and vice versa, each
+        # including the permission itself:
+        self._implied_permissions = _transitive_closure(
+            permission_implications or {})
+        implying_permissions = {}
+        for (permission, implied) in self._implied_permissions.items():
+            for implied_permission in implied:
+                implying_permissions.setdefault(implied_permission,
+                                                set()).add(permission)
+        self._implying_permissions = implying_permissions
+        # The bits of the groups and permissions:
+        self.bitmask_credentials = bitmask_credentials
+        self.group_index = None
+        self.permission_index = None
+        if bitmask_credentials:
+            self.group_index = SectionIndex()
+            self.permission_index = SectionIndex()
+            self.load_section_indexes()
+        # The groups and permissions of every authenticated user and of every
+        # anonymous user, respectively:
+        self.special_sections = special_sections
+        self._universal_credentials = (SectionSet(), SectionSet())
+        self._anonymous_credentials = (SectionSet(), SectionSet())
+        if special_sections:
+            self.load_special_sections()
+        # Listening to the changes made to the sources, to keep the caches
+        # up-to-date:
+        if self.credentials_cache is not None or nested_groups or \
+           special_sections or self.decision_cache is not None:
+            _add_change_listener(group_adapters, self._groups_changed)
+        if nested_groups:
+            # The cycles are rejected before they reach the sources:
+            for adapter in (group_adapters or {}).values():
+                if hasattr(adapter, 'add_inclusion_validator'):
+                    adapter.add_inclusion_validator(self._check_subgroups)
+        if self.permissions_cache is not None or \
+           self.credentials_cache is not None or permissions_table or \
+           special_sections or self.decision_cache is not None:
+            _add_change_listener(permission_adapters,
+                                 self._permissions_changed)
+    
+    def load_permissions_table(self):
+        """
+        Load the permissions granted to every group.
+        
+        :raise SourceError: If there was a problem with a source.
+        
+        """
+        table = {}
+        for perm_fetcher in self.permission_adapters.values():
+            all_permissions = perm_fetcher.get_all_sections(reload=True)
+            for (permission, groups) in all_permissions.items():
+                for group in groups:
+                    table.setdefault(group, set()).add(permission)
+        for (group, permissions) in table.items():
+            table[group] = frozenset(permissions)
+        if self.permissions_table_ttl is None:
+            self._permissions_table_expiration = None
+        else:
+            self._permissions_table_expiration = self._timer() + \
+                                                 self.permissions_table_ttl
+        self._permissions_table = table
+    
+    def load_group_hierarchy(self):
+        """
+        Load the groups to which each group belongs.
+        
+        :raise SourceError: If there was a problem with a source or there's a
+            cycle in the hierarchy of groups.
+        
+        """
+        all_groups = {}
+        for grp_fetcher in self.group_adapters.values():
+            for (group, items) in grp_fetcher.get_all_sections().items():
+                all_groups.setdefault(group, set()).update(items)
+        parents = {}
+        children = {}
+        for (group, items) in all_groups.items():
+            parents.setdefault(group, set())
+            children.setdefault(group, set())
+            for item in items:
+                if item in all_groups:
+                    parents.setdefault(item, set()).add(group)
+                    children[group].add(item)
+        try:
+            ancestors = _transitive_closure(parents)
+        except ValueError, error:
+            raise SourceError('The groups belong to each other: %s' % error)
+        self._group_descendants = _transitive_closure(children)
+        self._group_ancestors = ancestors
+    
+    def load_special_sections(self):
+        """
+        Load the groups and permissions of every authenticated user and of
+        every anonymous user.
+        
+        :raise SourceError: If there was a problem with a source.
+        
+        """
+        universal_groups = set()
+        anonymous_groups = set()
+        for grp_fetcher in (self.group_adapters or {}).values():
+            universal_groups.update(grp_fetcher.get_universal_sections())
+            anonymous_groups.update(grp_fetcher.get_anonymous_sections())
+        universal_permissions = set()
+        anonymous_permissions = set()
+        for perm_fetcher in (self.permission_adapters or {}).values():
+            universal_permissions.update(perm_fetcher.get_universal_sections())
+            anonymous_permissions.update(perm_fetcher.get_anonymous_sections())
+        groups, permissions = self._expand_sections(universal_groups,
+                                                    universal_permissions)
+        self._universal_credentials = (SectionSet(groups),
+                                       SectionSet(permissions))
+        groups, permissions = self._expand_sections(anonymous_groups,
+                                                    anonymous_permissions)
+        self._anonymous_credentials = (SectionSet(groups),
+                                       SectionSet(permissions))
+    
+    def load_section_indexes(self):
+        """
+        Assign a bit to every group and permission which doesn't have one.
+        
+        :raise SourceError: If there was a problem with a source.
+        
+        """
+        for grp_fetcher in (self.group_adapters or {}).values():
+            self.group_index.encode(grp_fetcher.get_all_sections())
+        permissions = set()
+        for perm_fetcher in (self.permission_adapters or {}).values():
+            permissions.update(perm_fetcher.get_all_sections())
+        for permission in list(permissions):
+            permissions.update(self._implied_permissions.get(permission, ()))
+        self.permission_index.encode(permissions)
+    
+    def _check_subgroups(self, adapter, group, items):
+        """
+        Check that the ``items`` to be included in ``group`` don't make the
+        groups belong to each other.
+        
+        :raise SourceError: If ``group`` belongs to any of the ``items``
+            already, or it's one of them.
+        
+        """
+        ancestors = self._group_ancestors.get(group, frozenset([group]))
+        for item in items:
+            if item in ancestors:
+                msg = 'The groups belong to each other: %s -> %s' % (item,
+                                                                     group)
+                raise SourceError(msg)
+    
+    def _add_subgroup(self, group, subgroup):
+        """
+        Update the hierarchy of groups after ``subgroup`` was included in
+        ``group``.
+        
+        :raise SourceError: If ``group`` already belongs to ``subgroup``.
+        
+        """
+        ancestors = self._group_ancestors
+        descendants = self._group_descendants
+        new_ancestors = ancestors.get(group, frozenset([group]))
+        if subgroup in new_ancestors:
+            msg = 'The groups belong to each other: %s -> %s' % (subgroup,
+                                                                 group)
+            raise SourceError(msg)
+        new_descendants = descendants.get(subgroup, frozenset([subgroup]))
+        for descendant in new_descendants:
+            ancestors[descendant] = ancestors.get(descendant, frozenset(
+                [descendant])) | new_ancestors
+        for ancestor in new_ancestors:
+            descendants[ancestor] = descendants.get(ancestor, frozenset(
+                [ancestor])) | new_descendants
+    
+    def _get_permissions_table(self):
+        """
+        Return the table of permissions, after reloading it if it's outdated.
+        
+        If the table is being reloaded by another thread, the outdated table
+        is returned, if any.
+        
+        """
+        table = self._permissions_table
+        expiration = self._permissions_table_expiration
+        if table is not None and \
+           (expiration is None or expiration > self._timer()):
+            return table
+        blocking = table is None
+        if self._permissions_table_lock.acquire(blocking):
+            try:
+                if self._permissions_table is table:
+                    self.load_permissions_table()
+            finally:
+                self._permissions_table_lock.release()
+        return self._permissions_table
+    
+    def invalidate_user(self, userid):
+        """
+        Forget the cached groups and permissions of the user identified by
+        ``userid``, as well as the cached results of the predicates.
+        
+        """
+        if self.credentials_cache is not None:
+            self.credentials_cache.invalidate(userid)
+        if self.decision_cache is not None:
+            self.decision_cache.clear()
+    
+    def invalidate_all(self):
+        """
+        Forget all the cached groups and permissions, including the table of
+        permissions, as well as the cached results of the predicates.
+        
+        """
+        if self.credentials_cache is not None:
+            self.credentials_cache.clear()
+        if self.decision_cache is not None:
+            self.decision_cache.clear()
+        if self.permissions_cache is not None:
+            self.permissions_cache.clear()
+        if self.use_permissions_table:
+            self._permissions_table = None
+    
+    def find_users(self, predicate, all_userids=None):
+        """
+        Return the userids of the users who meet ``predicate``, according to
+        the adapters.
+        
+        :param predicate: The built-in predicate to be met.
+        :type predicate: :class:`repoze.what.predicates.Predicate`
+        :param all_userids: The userids of all the users, which meet
+            :class:`not_anonymous <repoze.what.predicates.not_anonymous>`
+            and the predicates negated with :class:`Not
+            <repoze.what.predicates.Not>`; by default, the users who belong
+            to at least one group.
+        :return: The userids, each one once.
+        :rtype: iterator
+        :raise ValueError: If ``predicate`` is not made up of built-in
+            predicates.
+        :raise SourceError: If there was a problem with a source.
+        
+        The users are found from the items of the groups and the permissions
+        in the predicate, instead of evaluating the predicate for each user.
+        The groups and permissions needed are retrieved at once from each
+        adapter, with :meth:`get_sections_items
+        <repoze.what.adapters.BaseSourceAdapter.get_sections_items>`. When
+        the predicate is an :class:`Any <repoze.what.predicates.Any>`, the
+        users are returned as they're found for each of its predicates.
+        
+        The nested groups, the implied permissions and the universal
+        sections are taken into account if they are enabled. The group
+        adapters must use the userids as the items of the groups and all the
+        adapters must be :class:`repoze.what.adapters.BaseSourceAdapter`
+        objects.
+        
+        Example::
+        
+            >>> reviewers = plugin.find_users(All(in_group('staff'),
+            ...                                   has_permission('review')))
+            >>> sorted(reviewers)
+            [u'linus', u'rms']
+        
+        """
+        query = _UserQuery(self, predicate, all_userids)
+        return query.iter_users()
     
     def _find_groups(self, identity):
         """
@@ -66,20 +545,253 @@ class AuthorizationMetadata(object):
         the permissions granted to such groups.
         
         """
+        cache = self.credentials_cache
+        if cache is not None:
+            cached_credentials = cache.get(identity['repoze.who.userid'])
+            if cached_credentials is not None:
+                return cached_credentials
         groups = set()
-        permissions = set()
         if self.group_adapters is not None:
-            # repoze.what-2.X group adapters expect to find the
-            # 'repoze.what.userid' key in the credentials
-            credentials = identity.copy()
-            credentials['repoze.what.userid'] = identity['repoze.who.userid']
+            credentials = _make_adapter_credentials(identity)
             # It's using groups/permissions-based authorization
             for grp_fetcher in self.group_adapters.values():
-                groups |= set(grp_fetcher.find_sections(credentials))
-            for group in groups:
-                for perm_fetcher in self.permission_adapters.values():
-                    permissions |= set(perm_fetcher.find_sections(group))
-        return tuple(groups), tuple(permissions)
+                groups.update(grp_fetcher.find_sections(credentials))
+        groups, permissions = self._expand_sections(groups)
+        universal_groups, universal_permissions = self._universal_credentials
+        groups = SectionSet(groups | universal_groups)
+        permissions = SectionSet(permissions | universal_permissions)
+        if self.bitmask_credentials:
+            groups = self.group_index.encode(groups)
+            permissions = self.permission_index.encode(permissions)
+        if cache is not None:
+            cache.set(identity['repoze.who.userid'], (groups, permissions))
+        return groups, permissions
+    
+    def _expand_sections(self, groups, permissions=()):
+        """
+        Return the ``groups`` along with the groups they belong to, as well
+        as the ``permissions`` along with those granted to such groups and
+        those they imply.
+        
+        """
+        groups = set(groups)
+        permissions = set(permissions)
+        if self.nested_groups:
+            ancestors = self._group_ancestors
+            for group in list(groups):
+                groups.update(ancestors.get(group, ()))
+        for group in groups:
+            permissions.update(self._find_permissions(group))
+        if self._implied_permissions:
+            implied = self._implied_permissions
+            for permission in list(permissions):
+                permissions.update(implied.get(permission, ()))
+        return groups, permissions
+    
+    def _find_groups_lazily(self, identity, logger=None):
+        """
+        Return the groups to which the authenticated user belongs, as well as
+        the permissions granted to such groups, as collections which will be
+        loaded the first time they are used.
+        
+        """
+        # Both collections are loaded at once:
+        found = []
+        def load():
+            if not found:
+                groups, permissions = self._find_groups(identity)
+                _log_credentials(logger, groups, permissions)
+                found.append((groups, permissions))
+            return found[0]
+        groups = LazySections(lambda: load()[0])
+        permissions = LazySections(lambda: load()[1])
+        return groups, permissions
+    
+    def _find_groups_on_demand(self, identity, logger=None):
+        """
+        Return the groups to which the authenticated user belongs, as well as
+        the permissions granted to such groups, as collections which only
+        retrieve the sections they are asked about.
+        
+        """
+        if self.credentials_cache is not None:
+            cached_credentials = self.credentials_cache.get(
+                identity['repoze.who.userid'])
+            if cached_credentials is not None:
+                return cached_credentials
+        lazy_groups, lazy_permissions = self._find_groups_lazily(identity,
+                                                                 logger)
+        def is_member(group):
+            return self._is_member(identity, group)
+        groups = DemandSections(lazy_groups._load, is_member)
+        def is_granted(permission):
+            return self._is_granted(permission, groups)
+        permissions = DemandSections(lazy_permissions._load, is_granted)
+        return groups, permissions
+    
+    def _is_member(self, identity, group):
+        """Check whether the authenticated user belongs to ``group``."""
+        if group in self._universal_credentials[0]:
+            return True
+        if self.group_adapters is None:
+            return False
+        if self.nested_groups:
+            # The user may belong to any of its subgroups instead:
+            groups = self._group_descendants.get(group, (group, ))
+        else:
+            groups = (group, )
+        userid = identity['repoze.who.userid']
+        credentials = None
+        for grp_fetcher in self.group_adapters.values():
+            if hasattr(grp_fetcher, 'item_is_included'):
+                for subgroup in groups:
+                    if grp_fetcher.item_is_included(subgroup, userid):
+                        return True
+            else:
+                # It can only find all the groups of the user:
+                if credentials is None:
+                    credentials = _make_adapter_credentials(identity)
+                for found_group in grp_fetcher.find_sections(credentials):
+                    if found_group in groups:
+                        return True
+        return False
+    
+    def _is_granted(self, permission, groups):
+        """
+        Check whether ``permission`` is granted to at least one of the
+        ``groups``.
+        
+        """
+        if permission in self._universal_credentials[1]:
+            return True
+        if self.permission_adapters is None:
+            return False
+        # The permission may be implied by another one instead:
+        permissions = self._implying_permissions.get(permission,
+                                                     (permission, ))
+        for perm_fetcher in self.permission_adapters.values():
+            if hasattr(perm_fetcher, 'item_is_included'):
+                for candidate in permissions:
+                    if not perm_fetcher._section_exists(candidate):
+                        continue
+                    for group in perm_fetcher.get_section_items(candidate):
+                        if group in groups:
+                            return True
+            else:
+                # It can only find all the permissions of a group:
+                for group in groups:
+                    for candidate in perm_fetcher.find_sections(group):
+                        if candidate in permissions:
+                            return True
+        return False
+    
+    def _find_permissions(self, group):
+        """
+        Return the permissions granted to ``group``, using the table of
+        permissions or the cache if enabled.
+        
+        """
+        if self.use_permissions_table:
+            return self._get_permissions_table().get(group, frozenset())
+        cache = self.permissions_cache
+        if cache is not None:
+            permissions = cache.get(group)
+            if permissions is not None:
+                return permissions
+        permissions = set()
+        for perm_fetcher in self.permission_adapters.values():
+            permissions.update(perm_fetcher.find_sections(group))
+        permissions = frozenset(permissions)
+        if cache is not None:
+            cache.set(group, permissions)
+        return permissions
+    
+    def _groups_changed(self, adapter, section, items):
+        """
+        Update the hierarchy of groups and forget the cached credentials of
+        the users affected by a change in a group source.
+        
+        """
+        hierarchy_changed = False
+        if self.nested_groups:
+            if items is None:
+                # The group itself was created, renamed or deleted:
+                self.load_group_hierarchy()
+                hierarchy_changed = True
+            else:
+                ancestors = self._group_ancestors
+                subgroups = [i for i in items if i in ancestors]
+                for subgroup in subgroups:
+                    if section not in ancestors[subgroup]:
+                        self._add_subgroup(section, subgroup)
+                    else:
+                        # It was excluded, so its ancestors are unknown:
+                        self.load_group_hierarchy()
+                        break
+                hierarchy_changed = bool(subgroups)
+        if self.special_sections:
+            self.load_special_sections()
+        if self.decision_cache is not None:
+            self.decision_cache.clear()
+        if self.credentials_cache is None:
+            return
+        if items is None or hierarchy_changed or \
+           UNIVERSAL_ITEM in items:
+            self.credentials_cache.clear()
+        else:
+            for userid in items:
+                self.credentials_cache.invalidate(userid)
+    
+    def _permissions_changed(self, adapter, section, items):
+        """
+        Forget the cached permissions of the groups affected by a change in a
+        permission source, as well as the cached credentials of every user.
+        
+        """
+        if self.permissions_cache is not None:
+            if items is None:
+                # The permission itself was created, renamed or deleted:
+                self.permissions_cache.clear()
+            else:
+                for group in items:
+                    self.permissions_cache.invalidate(group)
+        if self.credentials_cache is not None:
+            self.credentials_cache.clear()
+        if self.decision_cache is not None:
+            self.decision_cache.clear()
+        if self.use_permissions_table:
+            # It'll be reloaded when it's needed:
+            self._permissions_table = None
+        if self.special_sections:
+            self.load_special_sections()
+    
+    def add_anonymous_metadata(self, environ):
+        """
+        Load the groups and permissions of the anonymous user, unless the
+        ``credentials`` have been loaded already.
+        
+        :param environ: The WSGI environment.
+        
+        """
+        if 'repoze.what.credentials' in environ:
+            return
+        groups, permissions = self._anonymous_credentials
+        environ['repoze.what.credentials'] = Credentials(None, groups,
+                                                         permissions)
+        self._add_adapters(environ)
+    
+    def _add_adapters(self, environ):
+        """
+        Make the adapters and, if enabled, the cache of results of predicates
+        available in the WSGI environment.
+        
+        """
+        environ['repoze.what.adapters'] = {
+            'groups': self.group_adapters,
+            'permissions': self.permission_adapters
+            }
+        if self.decision_cache is not None:
+            environ['repoze.what.decisions'] = self.decision_cache
     
     # IMetadataProvider
     def add_metadata(self, environ, identity):
@@ -95,28 +807,398 @@ class AuthorizationMetadata(object):
         """
         logger = environ.get('repoze.who.logger')
         # Finding the groups and permissions:
-        groups, permissions = self._find_groups(identity)
+        if self._is_bypassed and self._is_bypassed(environ.get('PATH_INFO',
+                                                               '')):
+            groups, permissions = self._find_groups_lazily(identity, logger)
+        elif self.credentials_mode == 'lazy':
+            groups, permissions = self._find_groups_lazily(identity, logger)
+        elif self.credentials_mode == 'on-demand':
+            groups, permissions = self._find_groups_on_demand(identity, logger)
+        else:
+            groups, permissions = self._find_groups(identity)
+            _log_credentials(logger, groups, permissions)
         identity['groups'] = groups
         identity['permissions'] = permissions
-        # Adding the groups and permissions to the repoze.what credentials for
-        # forward compatibility:
-        if 'repoze.what.credentials' not in environ:
-            environ['repoze.what.credentials'] = {}
-        environ['repoze.what.credentials']['groups'] = groups
-        environ['repoze.what.credentials']['permissions'] = permissions
-        # Adding the userid:
+        # Adding the userid, groups and permissions to the repoze.what
+        # credentials for forward compatibility:
         userid = identity['repoze.who.userid']
-        environ['repoze.what.credentials']['repoze.what.userid'] = userid
+        credentials = environ.get('repoze.what.credentials')
+        if credentials is None:
+            environ['repoze.what.credentials'] = Credentials(userid, groups,
+                                                             permissions)
+        else:
+            credentials['groups'] = groups
+            credentials['permissions'] = permissions
+            credentials['repoze.what.userid'] = userid
         # Adding the adapters:
-        environ['repoze.what.adapters'] = {
-            'groups': self.group_adapters,
-            'permissions': self.permission_adapters
-            }
-        # Logging
-        logger and logger.info('User belongs to the following groups: %s' %
-                               str(groups))
-        logger and logger.info('User has the following permissions: %s' %
-                               str(permissions))
+        self._add_adapters(environ)
+
+
+class _AnonymousMetadata(object):
+    """
+    WSGI middleware which loads the groups and permissions of the anonymous
+    users, to be used inside :mod:`repoze.who`'s.
+    
+    """
+    
+    def __init__(self, app, authorization):
+        """
+        :param app: The WSGI application.
+        :param authorization: The plugin which loads the credentials.
+        :type authorization: AuthorizationMetadata
+        
+        """
+        self.app = app
+        self.authorization = authorization
+    
+    def __call__(self, environ, start_response):
+        self.authorization.add_anonymous_metadata(environ)
+        return self.app(environ, start_response)
+
+
+class _UserQuery(object):
+    """
+    Query of the users who meet a predicate, according to the adapters.
+    
+    The groups and permissions used in the predicate are retrieved when the
+    query is created.
+    
+    """
+    
+    def __init__(self, authorization, predicate, all_userids=None):
+        """
+        :param authorization: The plugin whose adapters are used.
+        :type authorization: AuthorizationMetadata
+        :param predicate: The built-in predicate to be met.
+        :param all_userids: The userids of all the users, if known.
+        :raise ValueError: If ``predicate`` is not made up of built-in
+            predicates.
+        
+        """
+        self.authorization = authorization
+        self.predicate = predicate
+        if all_userids is None:
+            self._all_userids = None
+        else:
+            self._all_userids = frozenset(all_userids)
+        groups = set()
+        permissions = set()
+        _collect_sections(predicate, groups, permissions)
+        # Finding the groups granted each permission, directly or by
+        # implication:
+        implying_permissions = authorization._implying_permissions
+        candidates = set()
+        for permission in permissions:
+            candidates.update(implying_permissions.get(permission,
+                                                       (permission, )))
+        permission_items = _get_sections_items(
+            authorization.permission_adapters, candidates)
+        self._granted_groups = {}
+        for permission in permissions:
+            granted_groups = set()
+            for candidate in implying_permissions.get(permission,
+                                                      (permission, )):
+                granted_groups.update(permission_items.get(candidate, ()))
+            self._granted_groups[permission] = granted_groups
+            groups.update(granted_groups)
+        # Finding the members of the groups, including their subgroups:
+        group_descendants = authorization._group_descendants
+        subgroups = set()
+        for group in groups:
+            subgroups.update(group_descendants.get(group, (group, )))
+        self._group_items = _get_sections_items(authorization.group_adapters,
+                                                subgroups)
+    
+    def iter_users(self):
+        """Return the userids of the users who meet the predicate."""
+        if type(self.predicate) is Any:
+            found_userids = set()
+            for predicate in self.predicate.predicates:
+                for userid in self._find_users(predicate):
+                    if userid not in found_userids:
+                        found_userids.add(userid)
+                        yield userid
+        else:
+            for userid in self._find_users(self.predicate):
+                yield userid
+    
+    def _find_users(self, predicate):
+        """Return the userids of the users who meet ``predicate``."""
+        finder = _USER_FINDERS[type(predicate)]
+        return finder(self, predicate)
+    
+    def _get_all_userids(self):
+        """Return the userids of all the users."""
+        if self._all_userids is None:
+            userids = set()
+            for grp_fetcher in (self.authorization.group_adapters or
+                                {}).values():
+                for items in grp_fetcher.get_all_sections().values():
+                    userids.update(self._get_users(items))
+            self._all_userids = frozenset(userids)
+        return self._all_userids
+    
+    def _get_users(self, items):
+        """Return the ``items`` of a group which are users."""
+        users = set(items)
+        if self.authorization.nested_groups:
+            users.difference_update(self.authorization._group_ancestors)
+        if self.authorization.special_sections:
+            users.discard(UNIVERSAL_ITEM)
+            users.discard(ANONYMOUS_ITEM)
+        return users
+    
+    def _get_members(self, group):
+        """Return the userids of the members of ``group``."""
+        if group in self.authorization._universal_credentials[0]:
+            return self._get_all_userids()
+        members = set()
+        group_descendants = self.authorization._group_descendants
+        for subgroup in group_descendants.get(group, (group, )):
+            members.update(self._get_users(self._group_items.get(subgroup,
+                                                                 ())))
+        return members
+    
+    def _get_grantees(self, permission):
+        """Return the userids of the users granted ``permission``."""
+        if permission in self.authorization._universal_credentials[1]:
+            return self._get_all_userids()
+        grantees = set()
+        for group in self._granted_groups[permission]:
+            grantees.update(self._get_members(group))
+        return grantees
+    
+    def _find_in_all(self, predicate):
+        # The users who meet the negated predicates are excluded from the
+        # others, so that all the users are only needed if there are no others:
+        included = None
+        excluded = set()
+        for p in predicate.predicates:
+            if type(p) is Not:
+                excluded.update(self._find_users(p.predicate))
+            elif included is None:
+                included = set(self._find_users(p))
+            else:
+                included.intersection_update(self._find_users(p))
+        if included is None:
+            included = set(self._get_all_userids())
+        return included - excluded
+    
+    def _find_in_any(self, predicate):
+        users = set()
+        for p in predicate.predicates:
+            users.update(self._find_users(p))
+        return users
+    
+    def _find_not(self, predicate):
+        return self._get_all_userids() - set(self._find_users(
+            predicate.predicate))
+    
+    def _find_is_user(self, predicate):
+        return set([predicate.user_name])
+    
+    def _find_in_group(self, predicate):
+        return self._get_members(predicate.group_name)
+    
+    def _find_in_all_groups(self, predicate):
+        return _intersect([self._get_members(g) for g in
+                           predicate.group_names], self._get_all_userids)
+    
+    def _find_in_any_group(self, predicate):
+        users = set()
+        for group in predicate.group_names:
+            users.update(self._get_members(group))
+        return users
+    
+    def _find_has_permission(self, predicate):
+        return self._get_grantees(predicate.permission_name)
+    
+    def _find_has_all_permissions(self, predicate):
+        return _intersect([self._get_grantees(p) for p in
+                           predicate.permission_names], self._get_all_userids)
+    
+    def _find_has_any_permission(self, predicate):
+        users = set()
+        for permission in predicate.permission_names:
+            users.update(self._get_grantees(permission))
+        return users
+    
+    def _find_not_anonymous(self, predicate):
+        return self._get_all_userids()
+    
+    def _find_is_anonymous(self, predicate):
+        return set()
+
+
+def _collect_sections(predicate, groups, permissions):
+    """
+    Add the ``groups`` and ``permissions`` used in ``predicate``.
+    
+    :raise ValueError: If ``predicate`` is not made up of built-in
+        predicates.
+    
+    """
+    predicate_class = type(predicate)
+    if predicate_class not in _USER_FINDERS:
+        raise ValueError('The users who meet %r cannot be found from the '
+                         'sources' % predicate)
+    if predicate_class in (All, Any):
+        for p in predicate.predicates:
+            _collect_sections(p, groups, permissions)
+    elif predicate_class is Not:
+        _collect_sections(predicate.predicate, groups, permissions)
+    elif predicate_class is in_group:
+        groups.add(predicate.group_name)
+    elif predicate_class in (in_all_groups, in_any_group):
+        groups.update(predicate.group_names)
+    elif predicate_class is has_permission:
+        permissions.add(predicate.permission_name)
+    elif predicate_class in (has_all_permissions, has_any_permission):
+        permissions.update(predicate.permission_names)
+
+
+def _get_sections_items(adapters, sections):
+    """
+    Return the items of those ``sections`` which exist in any of the
+    ``adapters``, retrieving them at once from each adapter.
+    
+    """
+    sections_items = {}
+    if not sections:
+        return sections_items
+    for adapter in (adapters or {}).values():
+        for (section, items) in adapter.get_sections_items(sections).items():
+            sections_items.setdefault(section, set()).update(items)
+    return sections_items
+
+
+def _intersect(sets, get_all):
+    """
+    Return the intersection of ``sets``, or the result of ``get_all`` if
+    there are none.
+    
+    """
+    if not sets:
+        return get_all()
+    intersection = set(sets[0])
+    for other_set in sets[1:]:
+        intersection.intersection_update(other_set)
+    return intersection
+
+
+# The methods which find the users who meet each type of built-in predicate:
+_USER_FINDERS = {
+    All: _UserQuery._find_in_all,
+    Any: _UserQuery._find_in_any,
+    Not: _UserQuery._find_not,
+    is_user: _UserQuery._find_is_user,
+    in_group: _UserQuery._find_in_group,
+    in_all_groups: _UserQuery._find_in_all_groups,
+    in_any_group: _UserQuery._find_in_any_group,
+    has_permission: _UserQuery._find_has_permission,
+    has_all_permissions: _UserQuery._find_has_all_permissions,
+    has_any_permission: _UserQuery._find_has_any_permission,
+    not_anonymous: _UserQuery._find_not_anonymous,
+    is_anonymous: _UserQuery._find_is_anonymous,
+    }
+
+
+def _make_adapter_credentials(identity):
+    """
+    Return the credentials dictionary to be passed to the group adapters.
+    
+    """
+    # repoze.what-2.X group adapters expect to find the
+    # 'repoze.what.userid' key in the credentials. The identity is used
+    # as is because some adapters need other items from it (e.g., a DN):
+    identity['repoze.what.userid'] = identity['repoze.who.userid']
+    return identity
+
+
+def _log_credentials(logger, groups, permissions):
+    """Log the groups and permissions of the current user."""
+    logger and logger.info('User belongs to the following groups: %s' %
+                           str(groups))
+    logger and logger.info('User has the following permissions: %s' %
+                           str(permissions))
+
+
+def _transitive_closure(graph):
+    """
+    Return the nodes reachable from each node in ``graph``, including the
+    node itself.
+    
+    :param graph: The successors of each node, as in ``{node: successors}``.
+    :type graph: dict
+    :return: The reachable nodes, as in ``{node: frozenset(nodes)}``.
+    :rtype: dict
+    :raise ValueError: If there's a cycle in the graph.
+    
+    """
+    closure = {}
+    for root in graph:
+        if root in closure:
+            continue
+        # Depth-first search, without recursion so that deep graphs are
+        # supported:
+        path = [root]
+        nodes_in_path = set(path)
+        stack = [iter(graph.get(root, ()))]
+        while stack:
+            for node in stack[-1]:
+                if node in closure:
+                    continue
+                if node in nodes_in_path:
+                    cycle = path[path.index(node):] + [node]
+                    raise ValueError(' -> '.join(map(str, cycle)))
+                path.append(node)
+                nodes_in_path.add(node)
+                stack.append(iter(graph.get(node, ())))
+                break
+            else:
+                stack.pop()
+                node = path.pop()
+                nodes_in_path.remove(node)
+                reachable = set([node])
+                for successor in graph.get(node, ()):
+                    reachable |= closure[successor]
+                closure[node] = frozenset(reachable)
+    return closure
+
+
+def _compile_path_matcher(prefixes, patterns):
+    """
+    Return a function that checks whether a path starts with one of the
+    ``prefixes`` or matches one of the ``patterns``, or ``None`` if there are
+    neither prefixes nor patterns.
+    
+    """
+    regexes = [re.escape(prefix) for prefix in prefixes or ()]
+    regexes.extend(patterns or ())
+    if not regexes:
+        return None
+    regex = '|'.join(['(?:%s)' % r for r in regexes])
+    return re.compile(regex).match
+
+
+def _make_cache(max_size, ttl):
+    """Return a cache if ``max_size`` is set, ``None`` otherwise."""
+    if max_size is None:
+        return None
+    return TTLCache(max_size, ttl)
+
+
+def _add_change_listener(adapters, listener):
+    """
+    Register ``listener`` in the ``adapters`` which support change
+    notifications.
+    
+    """
+    if not adapters:
+        return
+    for adapter in adapters.values():
+        if hasattr(adapter, 'add_change_listener'):
+            adapter.add_change_listener(listener)
 
 
 def setup_auth(app, group_adapters=None, permission_adapters=None, **who_args):
@@ -129,7 +1211,8 @@ def setup_auth(app, group_adapters=None, permission_adapters=None, **who_args):
     :param permission_adapters: The permission source adapters to be used.
     :type permission_adapters: dict
     :param who_args: Authentication-related keyword arguments to be passed to
-        :mod:`repoze.who`.
+        :mod:`repoze.who`, as well as the optional arguments of
+        :class:`AuthorizationMetadata` (e.g., ``permissions_cache_size``).
     :return: The WSGI application with authentication and authorization
         middleware.
     
@@ -195,8 +1278,16 @@ def setup_auth(app, group_adapters=None, permission_adapters=None, **who_args):
         internally.
     
     """
+    metadata_args = {}
+    for arg in _METADATA_ARGS:
+        if arg in who_args:
+            metadata_args[arg] = who_args.pop(arg)
     authorization = AuthorizationMetadata(group_adapters,
-                                          permission_adapters)
+                                          permission_adapters,
+                                          **metadata_args)
+    if authorization.special_sections:
+        # The anonymous users don't go through the metadata providers:
+        app = _AnonymousMetadata(app, authorization)
     
     if 'mdproviders' not in who_args:
         who_args['mdproviders'] = []
@@ -23,13 +23,53 @@ original "identity" framework of TurboGears 1, plus others.
 
 """
 
+import time
+from cgi import parse_header
+from StringIO import StringIO
+from weakref import WeakValueDictionary
+try:
+    from tempfile import SpooledTemporaryFile
+except ImportError:
+    # Python < 2.6:
+    SpooledTemporaryFile = None
+try:
+    from urlparse import parse_qsl
+except ImportError:
+    # Python < 2.6:
+    from cgi import parse_qsl
+
 from paste.request import parse_formvars, parse_dict_querystring
 
+from repoze.what.cache import TTLCache
+from repoze.what.credentials import LazySections, BitmaskSections
+
 __all__ = ['Predicate', 'CompoundPredicate', 'All', 'Any', 
            'has_all_permissions', 'has_any_permission', 'has_permission', 
            'in_all_groups', 'in_any_group', 'in_group', 'is_user', 
-           'is_anonymous', 'not_anonymous', 'PredicateError',
-           'NotAuthorizedError']
+           'is_anonymous', 'not_anonymous', 'optimize', 'evaluate_many',
+           'PredicateError', 'NotAuthorizedError']
+
+
+# The orders in which compound predicates may evaluate their predicates:
+_ORDERINGS = (None, 'cost', 'adaptive')
+
+# The number of evaluations after which the predicates are reordered in the
+# "adaptive" ordering:
+_ADAPTIVE_PERIOD = 100
+
+_timer = time.time
+
+# The number of bytes of the body of the request which are read at once by the
+# streaming parser of POST variables:
+_CHUNK_SIZE = 64 * 1024
+
+# The maximum number of bytes of a line of a multipart body returned at once by
+# the streaming parser of POST variables:
+_LINE_SIZE = 64 * 1024
+
+# The number of bytes of the body of the request kept in memory to be read
+# again by the application, after which they are kept in a temporary file:
+_SPOOL_SIZE = 512 * 1024
 
 
 #{ Predicates
@@ -42,8 +82,63 @@ class Predicate(object):
     This is the base predicate class. It won't do anything useful for you, 
     unless you subclass it.
     
+    .. attribute:: cost = 1
+    
+        :type: int
+        
+        The estimated cost of evaluating the predicate, relative to the
+        built-in predicates (whose cost is ``1``). For example, a predicate
+        which queries a database may set it to ``100``.
+    
+    .. attribute:: side_effect_free = False
+    
+        :type: bool
+        
+        Whether evaluating the predicate has no side effects, so that it may
+        be evaluated before or after other predicates, or not at all. It's
+        ``True`` in the built-in predicates.
+    
+    .. attribute:: memoizable = False
+    
+        :type: bool
+        
+        Whether the result of the predicate is the same every time it's
+        evaluated in a request, so that :meth:`is_met` and
+        :meth:`check_authorization` only evaluate it once per request. It's
+        ``True`` in the built-in predicates, and it must be ``False`` in the
+        predicates which depend on the body of the request or on things
+        which may change during the request.
+        
+        Like :attr:`cacheable`, it's ignored if it's inherited from a class
+        whose :meth:`evaluate` method was overridden, so such subclasses of
+        the built-in predicates must set it again.
+    
+    .. attribute:: cacheable = False
+    
+        :type: bool
+        
+        Whether the result of the predicate only depends on the
+        ``credentials``, so that it may be reused in other requests with the
+        same ``credentials`` when the :class:`AuthorizationMetadata
+        <repoze.what.middleware.AuthorizationMetadata>` plugin caches the
+        decisions. It's ``True`` in the built-in predicates, and it must be
+        ``False`` in the predicates which use anything else in the WSGI
+        environment (e.g., the request variables).
+        
+        It's ignored if it's inherited from a class whose :meth:`evaluate`
+        method was overridden: A subclass of a built-in predicate which
+        checks the request is not cached, unless it sets it again.
+    
     """
     
+    cost = 1
+    
+    side_effect_free = False
+    
+    memoizable = False
+    
+    cacheable = False
+    
     def __init__(self, msg=None):
         """
         Create a predicate and use ``msg`` as the error message if it fails.
@@ -194,6 +289,9 @@ class Predicate(object):
         
             3 is not a good month
         
+        The message is only built when the exception is converted into text,
+        using the predicate attributes at that time.
+        
         .. versionadded:: 1.0.2
         
         .. versionchanged:: 1.0.4
@@ -208,13 +306,7 @@ class Predicate(object):
             message = msg
         else:
             message = self.message
-        # Let's convert it into unicode because it may be just a class, as a 
-        # Pylons' "lazy" translation message:
-        message = unicode(message)
-        # Include the predicate attributes in the placeholders:
-        all_placeholders = self.__dict__.copy()
-        all_placeholders.update(placeholders)
-        raise NotAuthorizedError(message % all_placeholders)
+        raise NotAuthorizedError(_UnmetMessage(message, self, placeholders))
 
     def check_authorization(self, environ):
         """
@@ -239,11 +331,20 @@ class Predicate(object):
         """
         logger = environ.get('repoze.who.logger')
         credentials = environ.get('repoze.what.credentials', {})
-        try:
-            self.evaluate(environ, credentials)
-        except NotAuthorizedError, error:
-            logger and logger.info(u'Authorization denied: %s' % error)
-            raise
+        result = None
+        if _has_flag(self, 'memoizable') or _has_flag(self, 'cacheable'):
+            result = _recall_decision(self, environ, credentials)
+        if result is not True:
+            try:
+                if isinstance(result, NotAuthorizedError):
+                    raise result
+                self.evaluate(environ, credentials)
+            except NotAuthorizedError, error:
+                if error is not result:
+                    _store_decision(self, environ, credentials, error)
+                logger and logger.info(u'Authorization denied: %s' % error)
+                raise
+            _store_decision(self, environ, credentials, True)
         logger and logger.info('Authorization granted')
 
     def is_met(self, environ):
@@ -267,11 +368,152 @@ class Predicate(object):
         
         """
         credentials = environ.get('repoze.what.credentials', {})
+        if not (_has_flag(self, 'memoizable') or _has_flag(self, 'cacheable')):
+            return _check(self, environ, credentials)
+        result = _recall_decision(self, environ, credentials)
+        if result is None:
+            result = _check(self, environ, credentials)
+            _store_decision(self, environ, credentials, result)
+        return result is True
+    
+    def check(self, environ, credentials):
+        """
+        Find whether the predicate is met, without raising an exception.
+        
+        :param environ: The WSGI environment.
+        :param credentials: The :mod:`repoze.what` ``credentials`` dictionary
+            of the current user, if any.
+        :type credentials: dict
+        :return: Whether the predicate is met or not.
+        :rtype: bool
+        
+        This is what :meth:`is_met` and the compound predicates use. By
+        default, it calls :meth:`evaluate` and catches the exception, but
+        predicates may define it too so that no exception (nor message) is
+        built when they are not met. It must be consistent with
+        :meth:`evaluate`, which is still used by
+        :meth:`check_authorization`.
+        
+        For example, the ``is_month`` predicate above may define::
+        
+            def check(self, environ, credentials):
+                return date.today().month == self.right_month
+        
+        If a subclass overrides :meth:`evaluate` but not this method, this
+        method is ignored for the subclass and :meth:`evaluate` is used
+        instead.
+        
+        """
         try:
             self.evaluate(environ, credentials)
+        except NotAuthorizedError:
+            return False
+        return True
+    
+    def compile(self):
+        """
+        Return a function which finds whether the predicate is met.
+        
+        :return: A function which receives the WSGI environment and the
+            :mod:`repoze.what` ``credentials`` (or ``None``) and returns
+            whether the predicate is met.
+        :rtype: callable
+        
+        The built-in predicates, and any combination of them, are turned into
+        a single boolean expression which neither raises exceptions nor
+        evaluates the predicates one by one. Other predicates are evaluated
+        as usual within the expression.
+        
+        The predicate should be compiled once and the function reused, as
+        in::
+        
+            p = All(not_anonymous(), in_any_group('admins', 'editors'))
+            is_editor = p.compile()
+            # ...
+            credentials = environ.get('repoze.what.credentials')
+            if is_editor(environ, credentials):
+                # ...
+        
+        Note that the function won't take into account the changes made to
+        the predicate after it was compiled.
+        
+        """
+        return _PredicateCompiler().compile(self)
+    
+    def _compile_expression(self, compiler):
+        """
+        Return the Python expression which finds whether the predicate is met.
+        
+        :param compiler: The compiler of the predicate.
+        :type compiler: _PredicateCompiler
+        
+        Predicates which define :meth:`evaluate` but not this method are
+        evaluated as usual in the expression.
+        
+        """
+        return compiler.fallback(self)
+    
+    def __eq__(self, other):
+        """
+        Check whether ``other`` is the same predicate.
+        
+        The built-in predicates are equal to the built-in predicates of the
+        same type which are defined the same way (e.g., ``in_group('admins')``
+        is equal to any other ``in_group('admins')``), while the other
+        predicates (including the built-in ones defined with unhashable
+        values, like lists) are only equal to themselves.
+        
+        """
+        if self is other:
             return True
-        except NotAuthorizedError, error:
+        if not isinstance(other, Predicate) or hash(self) != hash(other):
             return False
+        structure = _get_cached_structure(self)
+        return structure is not None and \
+               structure == _get_cached_structure(other)
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        """
+        Return the hash of the predicate.
+        
+        It's computed once, so predicates must not be modified after they are
+        hashed (e.g., after they are used as dictionary keys).
+        
+        """
+        try:
+            return self.__dict__['_hash']
+        except KeyError:
+            structure = _get_cached_structure(self)
+            if structure is None:
+                predicate_hash = id(self)
+            else:
+                predicate_hash = hash(structure)
+            self.__dict__['_hash'] = predicate_hash
+            return predicate_hash
+    
+    @classmethod
+    def interned(cls, *args, **kwargs):
+        """
+        Return the predicate created with the arguments passed, reusing the
+        equal predicate created previously with this method, if any.
+        
+        For example, ``in_group.interned('admins')`` always returns the same
+        object while it's in use, no matter how many controllers create it.
+        
+        Predicates which are not built-in are not reused.
+        
+        """
+        predicate = cls(*args, **kwargs)
+        structure = _get_structure(predicate)
+        if structure is None:
+            return predicate
+        interned_predicate = _interned_predicates.get(structure)
+        if interned_predicate is None:
+            _interned_predicates[structure] = interned_predicate = predicate
+        return interned_predicate
     
     def parse_variables(self, environ):
         """
@@ -306,31 +548,246 @@ class Predicate(object):
         But note that the ``named_args`` and ``positional_args`` items depend
         completely on how you configured the dispatcher.
         
+        The variables are parsed once per request and each item is only
+        parsed the first time it's used, so the body of the request is not
+        read by the predicates which only use the ``wsgiorg.routing_args``.
+        The same dictionary is returned to every predicate in the request, so
+        it must not be modified.
+        
         .. versionadded:: 1.0.4
         
         """
-        get_vars = parse_dict_querystring(environ) or {}
-        try:
-            post_vars = parse_formvars(environ, False) or {}
-        except KeyError:
-            post_vars = {}
-        routing_args = environ.get('wsgiorg.routing_args', ([], {}))
-        positional_args = routing_args[0] or ()
-        named_args = routing_args[1] or {}
-        variables = {
-            'post': post_vars,
-            'get': get_vars,
-            'positional_args': positional_args,
-            'named_args': named_args}
+        cached_variables = environ.get('repoze.what.variables')
+        sources = _get_variable_sources(environ)
+        if cached_variables is not None and \
+           _are_same_sources(cached_variables[1], sources):
+            return cached_variables[0]
+        variables = _RequestVariables(environ)
+        environ['repoze.what.variables'] = (variables, sources)
         return variables
+    
+    def parse_post_variables(self, environ, names, max_size=None):
+        """
+        Return the POST variables called ``names``, reading the body of the
+        request only until they're found.
+        
+        :param environ: The WSGI environ.
+        :param names: The names of the POST variables.
+        :param max_size: The maximum number of bytes of the body to be read;
+            if ``None``, the whole body may be read.
+        :type max_size: int
+        :return: The value of each variable found (its first value, if it's
+            repeated).
+        :rtype: dict
+        
+        Unlike :meth:`parse_variables`, this method parses the body as it's
+        read and stops once all the variables are found, without keeping the
+        contents of the uploaded files in memory; the files are never
+        returned. The variables after the first ``max_size`` bytes of the body
+        are not found, and the rest of the body is not read during the
+        request.
+        
+        The part of the body which is read is kept (in a temporary file if
+        it's large), so the application can read the whole body as usual.
+        Other calls to this method in the same request resume the parsing
+        where it stopped, even if it stopped at ``max_size``.
+        
+        Example::
+        
+            >>> p = Predicate()
+            >>> p.parse_post_variables(environ, ['blog_id'], 1024)
+            {'blog_id': '5'}
+        
+        """
+        parsed_formvars = environ.get('paste.parsed_formvars')
+        if parsed_formvars and \
+           parsed_formvars[1] is environ.get('wsgi.input'):
+            # The whole body has been parsed already:
+            return _get_form_variables(parsed_formvars[0], names)
+        parser = environ.get('repoze.what.form_parser')
+        if parser is None or parser.input is not environ.get('wsgi.input'):
+            parser = environ['repoze.what.form_parser'] = _FormParser(environ)
+        return parser.parse(names, max_size)
 
 
 class CompoundPredicate(Predicate):
-    """A predicate composed of other predicates."""
+    """
+    A predicate composed of other predicates.
+    
+    :param ordering: The order in which the predicates are evaluated: ``None``
+        (the order they were passed in), ``"cost"`` (the cheapest ones first,
+        according to their :attr:`Predicate.cost`) or ``"adaptive"`` (the
+        ones which are expected to decide the result sooner first, according
+        to how often they have been met and how long they took).
+    :type ordering: str
+    :raise ValueError: If the ``ordering`` is not supported.
+    
+    The predicates are only reordered if all of them are
+    :attr:`side-effect free <Predicate.side_effect_free>`. Note that if many
+    of them are not met, the exception raised may be a different one than
+    in the original order.
+    
+    In the ``"adaptive"`` mode, the predicates are reordered every 100
+    evaluations, according to approximate statistics which are shared among
+    all the requests.
+    
+    Whether it's :attr:`memoizable <Predicate.memoizable>` and
+    :attr:`cacheable <Predicate.cacheable>` is found from its predicates the
+    first time it's needed, like its hash, so they must not be modified
+    afterwards.
+    
+    """
+    
+    ordering = None
     
     def __init__(self, *predicates, **kwargs):
+        ordering = kwargs.pop('ordering', None)
+        if ordering not in _ORDERINGS:
+            raise ValueError('Unsupported ordering: %s' % ordering)
         super(CompoundPredicate, self).__init__(**kwargs)
         self.predicates = predicates
+        if ordering:
+            self.ordering = ordering
+            # The predicates for which the order was found, the order itself
+            # and the number of evaluations left until it's found again:
+            self._order = (None, None, 0)
+            # The evaluations, successes and duration of the evaluations
+            # (in seconds) of each predicate, when the order is adaptive:
+            self._statistics = None
+    
+    @property
+    def cost(self):
+        cost = 0
+        for p in self.predicates:
+            cost += p.cost
+        return cost
+    
+    @property
+    def side_effect_free(self):
+        for p in self.predicates:
+            if not p.side_effect_free:
+                return False
+        return True
+    
+    @property
+    def memoizable(self):
+        # It's found once, like the hash:
+        try:
+            return self.__dict__['_memoizable']
+        except KeyError:
+            memoizable = True
+            for p in self.predicates:
+                if not _has_flag(p, 'memoizable'):
+                    memoizable = False
+                    break
+            self.__dict__['_memoizable'] = memoizable
+            return memoizable
+    
+    @property
+    def cacheable(self):
+        try:
+            return self.__dict__['_cacheable']
+        except KeyError:
+            cacheable = True
+            for p in self.predicates:
+                if not _has_flag(p, 'cacheable'):
+                    cacheable = False
+                    break
+            self.__dict__['_cacheable'] = cacheable
+            return cacheable
+    
+    def _get_order(self):
+        """
+        Return the positions of the predicates in the order they must be
+        evaluated.
+        
+        """
+        predicates = self.predicates
+        evaluated_predicates, order, evaluations_left = self._order
+        if evaluated_predicates is predicates:
+            if self.ordering != 'adaptive':
+                return order
+            if evaluations_left > 0:
+                self._order = (predicates, order, evaluations_left - 1)
+                return order
+        else:
+            # They have not been ordered yet or they were replaced:
+            self._statistics = [[0, 0, 0.0] for p in predicates]
+        order = range(len(predicates))
+        if self.side_effect_free:
+            if self.ordering == 'adaptive':
+                keys = self._get_adaptive_keys(predicates)
+            else:
+                keys = [p.cost for p in predicates]
+            order.sort(key=keys.__getitem__)
+        self._order = (predicates, order, _ADAPTIVE_PERIOD)
+        return order
+    
+    def _get_adaptive_keys(self, predicates):
+        """
+        Return the expected cost of deciding the result with each predicate,
+        according to the statistics.
+        
+        """
+        statistics = self._statistics
+        # The seconds per unit of cost, to estimate the duration of the
+        # predicates which have not been evaluated:
+        units = 0
+        seconds = 0.0
+        for (p, (evaluations, successes, duration)) in zip(predicates,
+                                                           statistics):
+            units += p.cost * evaluations
+            seconds += duration
+        keys = []
+        for (p, (evaluations, successes, duration)) in zip(predicates,
+                                                           statistics):
+            if evaluations:
+                cost = duration / evaluations
+            elif units:
+                cost = p.cost * seconds / units
+            else:
+                cost = p.cost
+            if self._decisive_result:
+                decisions = successes
+            else:
+                decisions = evaluations - successes
+            probability = (decisions + 1.0) / (evaluations + 2.0)
+            keys.append(cost / probability)
+        return keys
+    
+    def _check_predicate(self, position, environ, credentials):
+        """Check the predicate at ``position``, recording the statistics."""
+        predicate = self.predicates[position]
+        if self.ordering != 'adaptive':
+            return _check(predicate, environ, credentials)
+        start = _timer()
+        met = _check(predicate, environ, credentials)
+        self._record(position, met, _timer() - start)
+        return met
+    
+    def _evaluate_predicate(self, position, environ, credentials):
+        """
+        Evaluate the predicate at ``position``, recording the statistics.
+        
+        """
+        predicate = self.predicates[position]
+        if self.ordering != 'adaptive':
+            predicate.evaluate(environ, credentials)
+            return
+        start = _timer()
+        try:
+            predicate.evaluate(environ, credentials)
+        except NotAuthorizedError:
+            self._record(position, False, _timer() - start)
+            raise
+        self._record(position, True, _timer() - start)
+    
+    def _record(self, position, met, duration):
+        """Record the result of evaluating the predicate at ``position``."""
+        statistics = self._statistics[position]
+        statistics[0] += 1
+        statistics[1] += met
+        statistics[2] += duration
 
 
 class Not(Predicate):
@@ -351,12 +808,34 @@ class Not(Predicate):
         super(Not, self).__init__(**kwargs)
         self.predicate = predicate
     
+    @property
+    def cost(self):
+        return self.predicate.cost
+    
+    @property
+    def side_effect_free(self):
+        return self.predicate.side_effect_free
+    
+    @property
+    def memoizable(self):
+        return _has_flag(self.predicate, 'memoizable')
+    
+    @property
+    def cacheable(self):
+        return _has_flag(self.predicate, 'cacheable')
+    
     def evaluate(self, environ, credentials):
         try:
             self.predicate.evaluate(environ, credentials)
         except NotAuthorizedError, error:
             return
         self.unmet()
+    
+    def check(self, environ, credentials):
+        return not _check(self.predicate, environ, credentials)
+    
+    def _compile_expression(self, compiler):
+        return '(not %s)' % compiler.expression(self.predicate)
 
 
 class All(CompoundPredicate):
@@ -373,6 +852,9 @@ class All(CompoundPredicate):
     
     """
     
+    # The result of a predicate which decides the result of this one:
+    _decisive_result = False
+    
     def evaluate(self, environ, credentials):
         """
         Evaluate all the predicates it contains.
@@ -382,8 +864,30 @@ class All(CompoundPredicate):
         :raises NotAuthorizedError: If one of the predicates is not met.
         
         """
-        for p in self.predicates:
-            p.evaluate(environ, credentials)
+        if self.ordering is None:
+            for p in self.predicates:
+                p.evaluate(environ, credentials)
+            return
+        for position in self._get_order():
+            self._evaluate_predicate(position, environ, credentials)
+    
+    def check(self, environ, credentials):
+        if self.ordering is None:
+            for p in self.predicates:
+                if not _check(p, environ, credentials):
+                    return False
+            return True
+        for position in self._get_order():
+            if not self._check_predicate(position, environ, credentials):
+                return False
+        return True
+    
+    def _compile_expression(self, compiler):
+        if not self.predicates:
+            return 'True'
+        expressions = [compiler.expression(p) for p in
+                       _get_ordered_predicates(self)]
+        return '(%s)' % ' and '.join(expressions)
 
 
 class Any(CompoundPredicate):
@@ -402,6 +906,9 @@ class Any(CompoundPredicate):
     message = u"At least one of the following predicates must be met: " \
                "%(failed_predicates)s"
     
+    # The result of a predicate which decides the result of this one:
+    _decisive_result = True
+    
     def evaluate(self, environ, credentials):
         """
         Evaluate all the predicates it contains.
@@ -412,14 +919,39 @@ class Any(CompoundPredicate):
         
         """
         errors = []
-        for p in self.predicates:
-            try:
-                p.evaluate(environ, credentials)
-                return
-            except NotAuthorizedError, exc:
-                errors.append(unicode(exc))
-        failed_predicates = ', '.join(errors)
-        self.unmet(failed_predicates=failed_predicates)
+        if self.ordering is None:
+            for p in self.predicates:
+                try:
+                    p.evaluate(environ, credentials)
+                    return
+                except NotAuthorizedError, exc:
+                    errors.append(exc)
+        else:
+            for position in self._get_order():
+                try:
+                    self._evaluate_predicate(position, environ, credentials)
+                    return
+                except NotAuthorizedError, exc:
+                    errors.append(exc)
+        self.unmet(failed_predicates=_FailedPredicates(errors))
+    
+    def check(self, environ, credentials):
+        if self.ordering is None:
+            for p in self.predicates:
+                if _check(p, environ, credentials):
+                    return True
+            return False
+        for position in self._get_order():
+            if self._check_predicate(position, environ, credentials):
+                return True
+        return False
+    
+    def _compile_expression(self, compiler):
+        if not self.predicates:
+            return 'False'
+        expressions = [compiler.expression(p) for p in
+                       _get_ordered_predicates(self)]
+        return '(%s)' % ' or '.join(expressions)
 
 
 class is_user(Predicate):
@@ -436,6 +968,12 @@ class is_user(Predicate):
     """
     
     message = u'The current user must be "%(user_name)s"'
+    
+    side_effect_free = True
+    
+    memoizable = True
+    
+    cacheable = True
 
     def __init__(self, user_name, **kwargs):
         super(is_user, self).__init__(**kwargs)
@@ -446,6 +984,14 @@ class is_user(Predicate):
            self.user_name == credentials.get('repoze.what.userid'):
             return
         self.unmet()
+    
+    def check(self, environ, credentials):
+        return bool(credentials) and \
+               self.user_name == credentials.get('repoze.what.userid')
+    
+    def _compile_expression(self, compiler):
+        return '(authenticated and userid == %s)' % \
+               compiler.constant(self.user_name)
 
 
 class in_group(Predicate):
@@ -462,15 +1008,31 @@ class in_group(Predicate):
     """
     
     message = u'The current user must belong to the group "%(group_name)s"'
+    
+    side_effect_free = True
+    
+    memoizable = True
+    
+    cacheable = True
 
     def __init__(self, group_name, **kwargs):
         super(in_group, self).__init__(**kwargs)
         self.group_name = group_name
 
     def evaluate(self, environ, credentials):
-        if credentials and self.group_name in credentials.get('groups'):
+        # The anonymous users may belong to groups too, so their (false)
+        # credentials are checked as well:
+        if credentials is not None and \
+           self.group_name in credentials.get('groups', ()):
             return
         self.unmet()
+    
+    def check(self, environ, credentials):
+        return credentials is not None and \
+               self.group_name in credentials.get('groups', ())
+    
+    def _compile_expression(self, compiler):
+        return '(%s in groups)' % compiler.constant(self.group_name)
 
 
 class in_all_groups(All):
@@ -483,12 +1045,46 @@ class in_all_groups(All):
     
         p = in_all_groups('developers', 'designers')
     
+    It's met if the groups of the user are a superset of the specified ones.
+    If it's not met, the message is the one of :class:`in_group` for the first
+    group the user doesn't belong to.
+    
     """
     
+    cost = 1
+    
+    side_effect_free = True
+    
+    memoizable = True
+    
+    cacheable = True
     
     def __init__(self, *groups, **kwargs):
-        group_predicates = [in_group(g) for g in groups]
-        super(in_all_groups,self).__init__(*group_predicates, **kwargs)
+        # CompoundPredicate.__init__ is skipped because the predicates are
+        # only created when they are requested:
+        Predicate.__init__(self, **kwargs)
+        self.group_names = groups
+        self._group_set = frozenset(groups)
+    
+    @property
+    def predicates(self):
+        return tuple([in_group(g) for g in self.group_names])
+    
+    def evaluate(self, environ, credentials):
+        groups = _get_sections(credentials, 'groups')
+        if _includes_all(self._group_set, groups):
+            return
+        for group in self.group_names:
+            if group not in groups:
+                self.unmet(in_group.message, group_name=group)
+    
+    def check(self, environ, credentials):
+        return _includes_all(self._group_set,
+                             _get_sections(credentials, 'groups'))
+    
+    def _compile_expression(self, compiler):
+        return '%s(%s, groups)' % (compiler.constant(_includes_all),
+                                   compiler.constant(self._group_set))
 
 
 class in_any_group(Any):
@@ -505,11 +1101,40 @@ class in_any_group(Any):
     
     message = u"The member must belong to at least one of the following " \
                "groups: %(group_list)s"
+    
+    cost = 1
+    
+    side_effect_free = True
+    
+    memoizable = True
+    
+    cacheable = True
 
     def __init__(self, *groups, **kwargs):
         self.group_list = ", ".join(groups)
-        group_predicates = [in_group(g) for g in groups]
-        super(in_any_group,self).__init__(*group_predicates, **kwargs)
+        # CompoundPredicate.__init__ is skipped because the predicates are
+        # only created when they are requested:
+        Predicate.__init__(self, **kwargs)
+        self.group_names = groups
+        self._group_set = frozenset(groups)
+    
+    @property
+    def predicates(self):
+        return tuple([in_group(g) for g in self.group_names])
+    
+    def evaluate(self, environ, credentials):
+        if not self.check(environ, credentials):
+            failed_predicates = _MissingSections(in_group, 'group_name',
+                                                 self.group_names)
+            self.unmet(failed_predicates=failed_predicates)
+    
+    def check(self, environ, credentials):
+        return _includes_any(self._group_set,
+                             _get_sections(credentials, 'groups'))
+    
+    def _compile_expression(self, compiler):
+        return '%s(%s, groups)' % (compiler.constant(_includes_any),
+                                   compiler.constant(self._group_set))
 
 
 class is_anonymous(Predicate):
@@ -526,10 +1151,22 @@ class is_anonymous(Predicate):
     """
     
     message = u"The current user must be anonymous"
+    
+    side_effect_free = True
+    
+    memoizable = True
+    
+    cacheable = True
 
     def evaluate(self, environ, credentials):
         if credentials:
             self.unmet()
+    
+    def check(self, environ, credentials):
+        return not credentials
+    
+    def _compile_expression(self, compiler):
+        return '(not authenticated)'
 
 
 class not_anonymous(Predicate):
@@ -544,10 +1181,22 @@ class not_anonymous(Predicate):
     """
     
     message = u"The current user must have been authenticated"
+    
+    side_effect_free = True
+    
+    memoizable = True
+    
+    cacheable = True
 
     def evaluate(self, environ, credentials):
         if not credentials:
             self.unmet()
+    
+    def check(self, environ, credentials):
+        return bool(credentials)
+    
+    def _compile_expression(self, compiler):
+        return 'authenticated'
 
 
 class has_permission(Predicate):
@@ -563,16 +1212,29 @@ class has_permission(Predicate):
     
     """
     message = u'The user must have the "%(permission_name)s" permission'
+    
+    side_effect_free = True
+    
+    memoizable = True
+    
+    cacheable = True
 
     def __init__(self, permission_name, **kwargs):
         super(has_permission, self).__init__(**kwargs)
         self.permission_name = permission_name
 
     def evaluate(self, environ, credentials):
-        if credentials and \
-           self.permission_name in credentials.get('permissions'):
+        if credentials is not None and \
+           self.permission_name in credentials.get('permissions', ()):
             return
         self.unmet()
+    
+    def check(self, environ, credentials):
+        return credentials is not None and \
+               self.permission_name in credentials.get('permissions', ())
+    
+    def _compile_expression(self, compiler):
+        return '(%s in permissions)' % compiler.constant(self.permission_name)
 
 
 class has_all_permissions(All):
@@ -589,10 +1251,40 @@ class has_all_permissions(All):
     
     """
     
+    cost = 1
+    
+    side_effect_free = True
+    
+    memoizable = True
+    
+    cacheable = True
+    
     def __init__(self, *permissions, **kwargs):
-        permission_predicates = [has_permission(p) for p in permissions]
-        super(has_all_permissions, self).__init__(*permission_predicates,
-                                                  **kwargs)
+        # CompoundPredicate.__init__ is skipped because the predicates are
+        # only created when they are requested:
+        Predicate.__init__(self, **kwargs)
+        self.permission_names = permissions
+        self._permission_set = frozenset(permissions)
+    
+    @property
+    def predicates(self):
+        return tuple([has_permission(p) for p in self.permission_names])
+    
+    def evaluate(self, environ, credentials):
+        permissions = _get_sections(credentials, 'permissions')
+        if _includes_all(self._permission_set, permissions):
+            return
+        for permission in self.permission_names:
+            if permission not in permissions:
+                self.unmet(has_permission.message, permission_name=permission)
+    
+    def check(self, environ, credentials):
+        return _includes_all(self._permission_set,
+                             _get_sections(credentials, 'permissions'))
+    
+    def _compile_expression(self, compiler):
+        return '%s(%s, permissions)' % (compiler.constant(_includes_all),
+                                        compiler.constant(self._permission_set))
 
 
 class has_any_permission(Any):
@@ -610,49 +1302,1413 @@ class has_any_permission(Any):
     
     message = u"The user must have at least one of the following " \
                "permissions: %(permission_list)s"
+    
+    cost = 1
+    
+    side_effect_free = True
+    
+    memoizable = True
+    
+    cacheable = True
 
     def __init__(self, *permissions, **kwargs):
         self.permission_list = ", ".join(permissions)
-        permission_predicates = [has_permission(p) for p in permissions]
-        super(has_any_permission,self).__init__(*permission_predicates,
-                                                **kwargs)
+        # CompoundPredicate.__init__ is skipped because the predicates are
+        # only created when they are requested:
+        Predicate.__init__(self, **kwargs)
+        self.permission_names = permissions
+        self._permission_set = frozenset(permissions)
+    
+    @property
+    def predicates(self):
+        return tuple([has_permission(p) for p in self.permission_names])
+    
+    def evaluate(self, environ, credentials):
+        if not self.check(environ, credentials):
+            failed_predicates = _MissingSections(has_permission,
+                                                 'permission_name',
+                                                 self.permission_names)
+            self.unmet(failed_predicates=failed_predicates)
+    
+    def check(self, environ, credentials):
+        return _includes_any(self._permission_set,
+                             _get_sections(credentials, 'permissions'))
+    
+    def _compile_expression(self, compiler):
+        return '%s(%s, permissions)' % (compiler.constant(_includes_any),
+                                        compiler.constant(self._permission_set))
 
 
-#{ Exceptions
+#{ Optimization of predicates
 
 
-class PredicateError(Exception):
+def optimize(predicate):
     """
-    Former exception raised by a :class:`Predicate` if it's not met.
+    Return a predicate equivalent to ``predicate`` which is faster to
+    evaluate.
+    
+    :param predicate: The predicate to be optimized; it's not modified.
+    :type predicate: Predicate
+    :return: The optimized predicate.
+    :rtype: Predicate
+    
+    The following optimizations are made on the :class:`All`, :class:`Any`
+    and :class:`Not` predicates, recursively:
+    
+    * The :class:`All` predicates in an :class:`All` predicate are replaced
+      by their own predicates, and so are the :class:`Any` predicates in an
+      :class:`Any` predicate.
+    * Double negations are removed, as in ``Not(Not(in_group('admins')))``.
+    * Repeated built-in predicates are removed (e.g., the second
+      ``in_group('admins')`` in ``All(in_group('admins'), not_anonymous(),
+      in_group('admins'))``).
+    * Consecutive :class:`in_group` and :class:`has_permission` predicates
+      are merged into :class:`in_all_groups`, :class:`in_any_group`,
+      :class:`has_all_permissions` or :class:`has_any_permission`
+      predicates.
+    
+    Whether the predicate is met is not affected and the predicates are still
+    evaluated in the same order, so they raise the same exceptions. However,
+    if the predicate is not met because of an :class:`Any` or :class:`Not`
+    predicate, the message of the :class:`NotAuthorizedError` may be worded
+    differently.
+    
+    Instances of subclasses of the built-in predicates are never optimized.
     
-    .. deprecated:: 1.0.4
-        Deprecated in favor of :class:`NotAuthorizedError`, for forward
-        compatibility with :mod:`repoze.what` v2.
+    Example::
+    
+        p = optimize(All(in_group('admins'), All(in_group('staff'))))
+        # p is equivalent to in_all_groups('admins', 'staff')
     
     """
+    optimizer = _OPTIMIZERS.get(type(predicate))
+    if optimizer is None:
+        return predicate
+    return optimizer(predicate)
+
+
+def _optimize_not(predicate):
+    """Optimize a :class:`Not` predicate."""
+    negated = optimize(predicate.predicate)
+    message = predicate.__dict__.get('message')
+    if type(negated) is Not and not message:
+        return negated.predicate
+    return Not(negated, msg=message)
+
+
+def _optimize_compound(predicate):
+    """Optimize an :class:`All` or :class:`Any` predicate."""
+    compound_class = type(predicate)
+    predicates = []
+    found_predicates = set()
+    for child in predicate.predicates:
+        child = optimize(child)
+        if type(child) is compound_class and \
+           'message' not in child.__dict__ and \
+           child.ordering == predicate.ordering:
+            # It's been flattened already:
+            grandchildren = child.predicates
+        else:
+            grandchildren = (child, )
+        for grandchild in grandchildren:
+            key = _get_structure(grandchild)
+            if key is not None:
+                if key in found_predicates:
+                    continue
+                found_predicates.add(key)
+            predicates.append(grandchild)
+    predicates = _merge_leaves(compound_class, predicates)
+    message = predicate.__dict__.get('message')
+    if len(predicates) == 1 and not message:
+        return predicates[0]
+    return compound_class(msg=message, ordering=predicate.ordering,
+                          *predicates)
+
+
+def _merge_leaves(compound_class, predicates):
+    """
+    Merge the consecutive predicates on groups or permissions in
+    ``predicates``.
     
-    # Ugly workaround for Python < 2.6:
-    if not hasattr(Exception, '__unicode__'):
-        def __unicode__(self):
-            return unicode(self.args and self.args[0] or '')
+    """
+    merged_predicates = []
+    run = []
+    run_kind = None
+    for predicate in predicates + [None]:
+        kind, sections = _get_leaf_sections(compound_class, predicate)
+        if run and kind != run_kind:
+            if len(run) == 1:
+                merged_predicates.append(run[0][0])
+            else:
+                names = []
+                for (leaf, leaf_sections) in run:
+                    names.extend([s for s in leaf_sections if s not in names])
+                leaf_class = _MERGED_LEAVES[compound_class][run_kind]
+                merged_predicates.append(leaf_class(*names))
+            run = []
+        if kind is None:
+            if predicate is not None:
+                merged_predicates.append(predicate)
+        else:
+            run.append((predicate, sections))
+        run_kind = kind
+    return merged_predicates
 
 
-class NotAuthorizedError(PredicateError):
+def _get_leaf_sections(compound_class, predicate):
     """
-    Exception raised by :meth:`Predicate.check_authorization` if the subject 
-    is not allowed to access the requested source.
+    Return the kind of sections checked by ``predicate`` and their names, if
+    it can be merged with similar predicates in ``compound_class``.
     
-    This exception deprecates :class:`PredicateError` as of v1.0.4, but
-    extends it to avoid breaking backwards compatibility.
+    """
+    predicate_class = type(predicate)
+    if predicate is None or 'message' in predicate.__dict__:
+        return None, None
+    if predicate_class is in_group:
+        return 'groups', (predicate.group_name, )
+    if predicate_class is has_permission:
+        return 'permissions', (predicate.permission_name, )
+    merged_leaves = _MERGED_LEAVES[compound_class]
+    if predicate_class is merged_leaves['groups']:
+        return 'groups', predicate.group_names
+    if predicate_class is merged_leaves['permissions']:
+        return 'permissions', predicate.permission_names
+    return None, None
+
+
+def _get_cached_structure(predicate):
+    """
+    Return the structure of ``predicate``, which is only computed the first
+    time, like its hash.
     
-    .. versionchanged:: 1.0.4
-        This exception was defined at :mod:`repoze.what.authorize` until
-        version 1.0.3, but is still imported into that module to keep backwards
-        compatibility with v1.X releases -- but it won't work in
-        :mod:`repoze.what` v2.
+    """
+    try:
+        return predicate.__dict__['_structure']
+    except KeyError:
+        structure = predicate.__dict__['_structure'] = _get_structure(predicate)
+        return structure
+
+
+def _get_structure(predicate):
+    """
+    Return a hashable representation of ``predicate``, or ``None`` if it's not
+    a built-in predicate or it's defined with unhashable values (e.g., a list
+    of groups).
     
+    Two predicates with the same structure are evaluated the same way.
+    
+    """
+    predicate_class = type(predicate)
+    attribute = _STRUCTURE_ATTRIBUTES.get(predicate_class)
+    if attribute is None:
+        return None
+    if predicate_class is Not:
+        value = _get_structure(predicate.predicate)
+        if value is None:
+            return None
+    elif predicate_class in (All, Any):
+        value = []
+        for child in predicate.predicates:
+            child_structure = _get_structure(child)
+            if child_structure is None:
+                return None
+            value.append(child_structure)
+        # The order of evaluation may change the error raised:
+        value = (predicate.ordering, tuple(value))
+    elif attribute:
+        value = getattr(predicate, attribute)
+    else:
+        value = None
+    structure = (predicate_class, predicate.__dict__.get('message'), value)
+    try:
+        if attribute in ('predicate', 'predicates'):
+            # The structures of the predicates were checked already:
+            hash(structure[1])
+        else:
+            hash(structure)
+    except TypeError:
+        # Such predicates are only equal to themselves:
+        return None
+    return structure
+
+
+# The functions which optimize each type of predicate:
+_OPTIMIZERS = {
+    All: _optimize_compound,
+    Any: _optimize_compound,
+    Not: _optimize_not,
+    }
+
+# The predicates on many groups or permissions into which in_group and
+# has_permission predicates are merged, by compound predicate:
+_MERGED_LEAVES = {
+    All: {'groups': in_all_groups, 'permissions': has_all_permissions},
+    Any: {'groups': in_any_group, 'permissions': has_any_permission},
+    }
+
+# The built-in predicates and the attribute that defines each one, if any:
+_STRUCTURE_ATTRIBUTES = {
+    Not: 'predicate',
+    All: 'predicates',
+    Any: 'predicates',
+    is_user: 'user_name',
+    in_group: 'group_name',
+    has_permission: 'permission_name',
+    in_all_groups: 'group_names',
+    in_any_group: 'group_names',
+    has_all_permissions: 'permission_names',
+    has_any_permission: 'permission_names',
+    is_anonymous: '',
+    not_anonymous: '',
+    }
+
+
+# The predicates created with Predicate.interned(), by structure:
+_interned_predicates = WeakValueDictionary()
+
+
+#{ Batch evaluation of predicates
+
+
+def evaluate_many(predicates, environ):
     """
-    pass
+    Find whether each of the ``predicates`` is met.
+    
+    :param predicates: The predicates to be evaluated.
+    :param environ: The WSGI environment.
+    :return: Whether each predicate is met, in the same order.
+    :rtype: list
+    
+    The predicates are evaluated as a network where each distinct predicate
+    is evaluated once, even if it's shared by many of the ``predicates``
+    (e.g., ``not_anonymous()`` in most of the items of a menu). The
+    built-in predicates are distinct if they are defined differently, while
+    the other predicates are distinct if they are different objects.
+    
+    The network is cached, so it's not built again when an equal list of
+    predicates is evaluated later (e.g., a menu whose built-in predicates are
+    created again in each request). For this reason, predicates must not be
+    modified after they are evaluated with this function.
+    
+    Example::
+    
+        menu = [
+            ('Home', None),
+            ('Profile', not_anonymous()),
+            ('Admin', All(not_anonymous(), in_group('admins'))),
+            ]
+        visible = evaluate_many([p for (title, p) in menu if p], environ)
+    
+    """
+    predicates = tuple(predicates)
+    network = _networks.get(predicates)
+    if network is None or not network.is_for(predicates):
+        network = _PredicateNetwork(predicates)
+        _networks.set(predicates, network)
+    credentials = environ.get('repoze.what.credentials', {})
+    return network.evaluate(environ, credentials)
+
+
+class _PredicateNetwork(object):
+    """
+    The network of the distinct predicates in some predicates, including
+    their sub-predicates.
+    
+    """
+    
+    def __init__(self, predicates):
+        """
+        :param predicates: The predicates to be evaluated.
+        :type predicates: tuple
+        
+        """
+        self.predicates = predicates
+        # The operation of each distinct predicate and the position of its
+        # sub-predicates or, if it's evaluated as a whole, the predicate
+        # itself. Sub-predicates come before the predicates that contain them:
+        self.nodes = []
+        self._positions = {}
+        self.roots = [self._add(p) for p in predicates]
+        del self._positions
+    
+    def is_for(self, predicates):
+        """
+        Check whether the network is made up of ``predicates``, which must be
+        the same objects unless they are built-in predicates.
+        
+        """
+        if len(predicates) != len(self.predicates):
+            return False
+        for (p1, p2) in zip(predicates, self.predicates):
+            if p1 is p2:
+                continue
+            if _get_cached_structure(p1) is None or p1 != p2:
+                return False
+        return True
+    
+    def _add(self, predicate):
+        """
+        Add ``predicate`` to the network, unless it's there already, and
+        return its position.
+        
+        """
+        position = self._positions.get(predicate)
+        if position is not None:
+            return position
+        predicate_class = type(predicate)
+        if predicate_class in (All, Any) and predicate.ordering is None:
+            positions = tuple([self._add(p) for p in predicate.predicates])
+            if predicate_class is All:
+                node = ('all', positions)
+            else:
+                node = ('any', positions)
+        elif predicate_class is Not:
+            node = ('not', self._add(predicate.predicate))
+        else:
+            node = ('check', predicate)
+        self.nodes.append(node)
+        position = self._positions[predicate] = len(self.nodes) - 1
+        return position
+    
+    def evaluate(self, environ, credentials):
+        """Find whether each predicate is met."""
+        nodes = self.nodes
+        results = [None] * len(nodes)
+        def evaluate_node(position):
+            result = results[position]
+            if result is not None:
+                return result
+            operation, operand = nodes[position]
+            if operation == 'check':
+                result = _check(operand, environ, credentials)
+            elif operation == 'not':
+                result = not evaluate_node(operand)
+            elif operation == 'all':
+                result = True
+                for sub_position in operand:
+                    if not evaluate_node(sub_position):
+                        result = False
+                        break
+            else:
+                result = False
+                for sub_position in operand:
+                    if evaluate_node(sub_position):
+                        result = True
+                        break
+            results[position] = result
+            return result
+        return [evaluate_node(position) for position in self.roots]
+
+
+# The networks of the predicates evaluated with evaluate_many(), by such
+# predicates:
+_networks = TTLCache(100)
+
+
+#{ Fast evaluation of predicates
+
+
+class _PredicateCompiler(object):
+    """
+    Turn a predicate into a function which evaluates a single boolean
+    expression.
+    
+    """
+    
+    # The template of the function; the variables it defines are available
+    # in the expressions of the predicates:
+    template = '\n'.join([
+        'def evaluate(environ, credentials):',
+        '    if credentials is None:',
+        '        credentials = {}',
+        '    authenticated = bool(credentials)',
+        '    userid = credentials.get("repoze.what.userid")',
+        '    groups = credentials.get("groups", ())',
+        '    permissions = credentials.get("permissions", ())',
+        '    return bool(%s)',
+        ''])
+    
+    # The number of nested predicates turned into expressions, beyond which
+    # they're evaluated through _check(): The parser of Python fails on
+    # deeply nested expressions.
+    max_depth = 30
+    
+    def __init__(self):
+        # The objects used in the expressions:
+        self.namespace = {'_check': _check}
+        self.depth = 0
+    
+    def compile(self, predicate):
+        """Return the function which finds whether ``predicate`` is met."""
+        source = self.template % self.expression(predicate)
+        try:
+            code = compile(source, '<compiled predicate>', 'exec')
+        except (MemoryError, SyntaxError, RuntimeError):
+            # The expression is still too complex for the parser:
+            source = self.template % self.fallback(predicate)
+            code = compile(source, '<compiled predicate>', 'exec')
+        exec code in self.namespace
+        return self.namespace['evaluate']
+    
+    def expression(self, predicate):
+        """Return the Python expression which evaluates ``predicate``."""
+        if self.depth >= self.max_depth or \
+           not _is_native(type(predicate), '_compile_expression'):
+            return self.fallback(predicate)
+        self.depth += 1
+        try:
+            return predicate._compile_expression(self)
+        finally:
+            self.depth -= 1
+    
+    def constant(self, value):
+        """Return the name of the variable bound to ``value``."""
+        name = '_v%s' % len(self.namespace)
+        self.namespace[name] = value
+        return name
+    
+    def fallback(self, predicate):
+        """
+        Return the expression which evaluates ``predicate`` through its
+        :meth:`Predicate.check` method.
+        
+        """
+        return '_check(%s, environ, credentials)' % self.constant(predicate)
+
+
+def _is_native(cls, method_name):
+    """
+    Check whether the ``method_name`` method of ``cls`` was defined along with
+    its :meth:`Predicate.evaluate` method, or after it.
+    
+    Otherwise, that method doesn't take into account how the predicate is
+    actually evaluated.
+    
+    """
+    for klass in cls.__mro__:
+        if method_name in klass.__dict__:
+            return True
+        if 'evaluate' in klass.__dict__:
+            return False
+    return False
+
+
+# Whether the check() method of each predicate class can be used:
+_native_checks = {}
+
+
+def _has_flag(predicate, flag):
+    """
+    Return the ``flag`` of ``predicate`` (its ``memoizable`` or ``cacheable``
+    attribute), unless it's inherited from a class whose
+    :meth:`Predicate.evaluate` method was overridden.
+    
+    The flags of :class:`All` and :class:`Any` are found from their
+    predicates, so they're valid as long as their evaluation is not
+    overridden.
+    
+    """
+    if flag in predicate.__dict__:
+        return predicate.__dict__[flag]
+    cls = predicate.__class__
+    try:
+        native = _native_flags[cls, flag]
+    except KeyError:
+        native = _is_native(cls, flag) or \
+                 _get_evaluating_class(cls) in (All, Any)
+        _native_flags[cls, flag] = native
+    return native and getattr(predicate, flag)
+
+
+def _get_evaluating_class(cls):
+    """Return the class of ``cls`` which defines its evaluate() method."""
+    for klass in cls.__mro__:
+        if 'evaluate' in klass.__dict__:
+            return klass
+    return None
+
+
+# Whether the memoizable and cacheable attributes of each predicate class can
+# be used, by class and attribute:
+_native_flags = {}
+
+
+def _check(predicate, environ, credentials):
+    """
+    Find whether ``predicate`` is met, using its :meth:`Predicate.check`
+    method unless it's inconsistent with its :meth:`Predicate.evaluate`.
+    
+    """
+    cls = predicate.__class__
+    try:
+        native = _native_checks[cls]
+    except KeyError:
+        native = _native_checks[cls] = _is_native(cls, 'check')
+    if native:
+        return predicate.check(environ, credentials)
+    return Predicate.check(predicate, environ, credentials)
+
+
+def _get_ordered_predicates(compound_predicate):
+    """
+    Return the predicates of ``compound_predicate`` in the order they must be
+    evaluated.
+    
+    """
+    predicates = compound_predicate.predicates
+    if compound_predicate.ordering is None:
+        return predicates
+    return [predicates[i] for i in compound_predicate._get_order()]
+
+
+def _get_memo(environ):
+    """
+    Return the results of the predicates evaluated in the request, which are
+    forgotten if the ``credentials`` are replaced.
+    
+    """
+    credentials = environ.get('repoze.what.credentials')
+    memo = environ.get('repoze.what.memo')
+    if memo is None or memo[0] is not credentials:
+        memo = environ['repoze.what.memo'] = (credentials, {})
+    return memo[1]
+
+
+def _recall(memo, predicate):
+    """
+    Return the result of ``predicate`` in the ``memo``: ``True``, the
+    exception raised, ``False`` if it's not known, or ``None`` if it has not
+    been evaluated.
+    
+    The predicates are the keys of the ``memo``, so the built-in ones are
+    found by structure (with their cached hash) and the others by identity.
+    
+    """
+    return memo.get(predicate)
+
+
+def _memorize(memo, predicate, result):
+    """Store the ``result`` of ``predicate`` in the ``memo``."""
+    memo[predicate] = result
+
+
+def _recall_decision(predicate, environ, credentials):
+    """
+    Return the result of ``predicate`` found previously in the request or,
+    if enabled, in another request with the same ``credentials``.
+    
+    The result is represented like in :func:`_recall`.
+    
+    """
+    memo = None
+    if _has_flag(predicate, 'memoizable'):
+        memo = _get_memo(environ)
+        result = _recall(memo, predicate)
+        if result is not None:
+            return result
+    decisions = environ.get('repoze.what.decisions')
+    if decisions is None or not _has_flag(predicate, 'cacheable'):
+        return None
+    fingerprint = _get_fingerprint(credentials)
+    if fingerprint is None:
+        return None
+    result = decisions.get((predicate, fingerprint))
+    if result is not None and memo is not None:
+        _memorize(memo, predicate, result)
+    return result
+
+
+def _store_decision(predicate, environ, credentials, result):
+    """
+    Store the ``result`` of ``predicate`` for the rest of the request and, if
+    enabled, for the other requests with the same ``credentials``.
+    
+    """
+    if _has_flag(predicate, 'memoizable'):
+        _memorize(_get_memo(environ), predicate, result)
+    decisions = environ.get('repoze.what.decisions')
+    if decisions is not None and _has_flag(predicate, 'cacheable'):
+        fingerprint = _get_fingerprint(credentials)
+        if fingerprint is not None:
+            decisions.set((predicate, fingerprint), result)
+
+
+def _get_fingerprint(credentials):
+    """
+    Return a hashable representation of the ``credentials``, or ``None`` if
+    their groups or permissions have not been loaded yet.
+    
+    The sections which are loaded lazily are not loaded just to be
+    represented, so the results of the predicates are not cached for them
+    until they are loaded: The userid alone would not tell the changes made
+    to them in the sources. The sections encoded as bitmasks are represented
+    by their mask.
+    
+    """
+    if credentials is None:
+        return (None, frozenset(), frozenset())
+    fingerprint = [credentials.get('repoze.what.userid')]
+    for key in ('groups', 'permissions'):
+        sections = credentials.get(key, ())
+        if isinstance(sections, LazySections):
+            if not sections.loaded:
+                return None
+            sections = sections._sections
+        if isinstance(sections, BitmaskSections):
+            fingerprint.append(sections.mask)
+        elif isinstance(sections, frozenset):
+            fingerprint.append(sections)
+        else:
+            fingerprint.append(frozenset(sections))
+    return tuple(fingerprint)
+
+
+def _get_sections(credentials, key):
+    """Return the groups or permissions in the ``credentials``, if any."""
+    if credentials is None:
+        return ()
+    return credentials.get(key, ())
+
+
+def _includes_all(required_sections, sections):
+    """
+    Check whether ``sections`` include all the ``required_sections``.
+    
+    The sections encoded as bitmasks are checked with a mask test, and those
+    which are not sets are searched one by one, so that the collections
+    which load the sections on demand are not loaded entirely.
+    
+    """
+    if isinstance(sections, BitmaskSections):
+        return sections.includes_all(required_sections)
+    if isinstance(sections, (set, frozenset)):
+        return required_sections.issubset(sections)
+    for section in required_sections:
+        if section not in sections:
+            return False
+    return True
+
+
+def _includes_any(required_sections, sections):
+    """
+    Check whether ``sections`` include at least one of the
+    ``required_sections``.
+    
+    """
+    if isinstance(sections, BitmaskSections):
+        return sections.includes_any(required_sections)
+    if isinstance(sections, (set, frozenset)):
+        return bool(required_sections & sections)
+    for section in required_sections:
+        if section in sections:
+            return True
+    return False
+
+
+#{ Request variables
+
+
+class _RequestVariables(dict):
+    """
+    The GET and POST variables and the ``wsgiorg.routing_args`` arguments of
+    a request, which are only parsed the first time each item is used.
+    
+    Using the dictionary in any other way (e.g., iterating over it) parses
+    all the items.
+    
+    """
+    
+    def __init__(self, environ):
+        """
+        :param environ: The WSGI environment.
+        
+        """
+        dict.__init__(self)
+        self._environ = environ
+    
+    def _load(self):
+        """Parse the items which have not been parsed yet."""
+        if self._environ is not None:
+            for key in _VARIABLE_PARSERS:
+                self[key]
+            self._environ = None
+    
+    def __getitem__(self, key):
+        if self._environ is not None and key in _VARIABLE_PARSERS and \
+           not dict.__contains__(self, key):
+            parser = _VARIABLE_PARSERS[key]
+            dict.__setitem__(self, key, parser(self._environ))
+        return dict.__getitem__(self, key)
+    
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+    
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return True
+        return self._environ is not None and key in _VARIABLE_PARSERS
+    
+    has_key = __contains__
+    
+    def __iter__(self):
+        self._load()
+        return dict.__iter__(self)
+    
+    def __len__(self):
+        self._load()
+        return dict.__len__(self)
+    
+    def __eq__(self, other):
+        self._load()
+        return dict.__eq__(self, other)
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __repr__(self):
+        self._load()
+        return dict.__repr__(self)
+    
+    def __delitem__(self, key):
+        self._load()
+        dict.__delitem__(self, key)
+    
+    def keys(self):
+        self._load()
+        return dict.keys(self)
+    
+    def values(self):
+        self._load()
+        return dict.values(self)
+    
+    def items(self):
+        self._load()
+        return dict.items(self)
+    
+    def iterkeys(self):
+        self._load()
+        return dict.iterkeys(self)
+    
+    def itervalues(self):
+        self._load()
+        return dict.itervalues(self)
+    
+    def iteritems(self):
+        self._load()
+        return dict.iteritems(self)
+    
+    def copy(self):
+        self._load()
+        return dict.copy(self)
+    
+    def pop(self, key, *default):
+        self._load()
+        return dict.pop(self, key, *default)
+    
+    def setdefault(self, key, default=None):
+        self._load()
+        return dict.setdefault(self, key, default)
+    
+    def clear(self):
+        self._environ = None
+        dict.clear(self)
+
+
+def _parse_get_variables(environ):
+    """Return the variables in the query string."""
+    return parse_dict_querystring(environ) or {}
+
+
+def _parse_post_variables(environ):
+    """Return the variables in the body of the request."""
+    try:
+        return parse_formvars(environ, False) or {}
+    except KeyError:
+        return {}
+
+
+def _get_positional_args(environ):
+    """Return the positional ``wsgiorg.routing_args`` arguments."""
+    return environ.get('wsgiorg.routing_args', ([], {}))[0] or ()
+
+
+def _get_named_args(environ):
+    """Return the named ``wsgiorg.routing_args`` arguments."""
+    return environ.get('wsgiorg.routing_args', ([], {}))[1] or {}
+
+
+def _get_variable_sources(environ):
+    """
+    Return the items of the WSGI environment from which the variables of the
+    request are parsed.
+    
+    """
+    return (environ.get('QUERY_STRING'), environ.get('wsgi.input'),
+            environ.get('wsgiorg.routing_args'))
+
+
+def _are_same_sources(sources1, sources2):
+    """Check whether the sources of the variables have not been replaced."""
+    query_string1, input1, routing_args1 = sources1
+    query_string2, input2, routing_args2 = sources2
+    return query_string1 == query_string2 and input1 is input2 and \
+           routing_args1 is routing_args2
+
+
+# The functions which parse each item of the request variables:
+_VARIABLE_PARSERS = {
+    'get': _parse_get_variables,
+    'post': _parse_post_variables,
+    'positional_args': _get_positional_args,
+    'named_args': _get_named_args,
+    }
+
+
+class _FormParser(object):
+    """
+    Streaming parser of the POST variables in the body of a request.
+    
+    The input of the request is replaced with a :class:`_ReplayableInput`,
+    so that the body can be read again by the application.
+    
+    """
+    
+    def __init__(self, environ):
+        """
+        :param environ: The WSGI environment.
+        
+        """
+        self.variables = {}
+        content_type, parameters = parse_header(environ.get('CONTENT_TYPE',
+                                                            ''))
+        try:
+            content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        input = environ.get('wsgi.input')
+        if input is None or content_length <= 0 or \
+           content_type not in _FORM_PARSERS or \
+           (content_type == 'multipart/form-data' and
+            not parameters.get('boundary')):
+            self.input = input
+            self.reader = None
+            self._variables = iter(())
+            return
+        self.input = environ['wsgi.input'] = _ReplayableInput(input,
+                                                              content_length)
+        self.reader = _BodyReader(self.input)
+        iter_variables = _FORM_PARSERS[content_type]
+        self._variables = iter_variables(self.reader, parameters)
+    
+    def parse(self, names, max_size=None):
+        """
+        Return the variables called ``names``, parsing the body until they're
+        found or it's read up to ``max_size`` bytes.
+        
+        """
+        if self.reader is not None:
+            self.reader.max_size = max_size
+            self.reader.truncated = False
+        missing_names = [n for n in names if n not in self.variables]
+        while missing_names:
+            try:
+                variable = self._variables.next()
+            except StopIteration:
+                break
+            if variable is None:
+                # The body was read up to max_size; the parsing is resumed
+                # in the next call if it's larger:
+                break
+            name, value = variable
+            if name not in self.variables:
+                self.variables[name] = value
+            if name in missing_names:
+                missing_names.remove(name)
+        return _get_form_variables(self.variables, names)
+
+
+class _ReplayableInput(object):
+    """
+    WSGI input which keeps the part of the body read by :class:`_FormParser`,
+    so that it's read again by the application.
+    
+    """
+    
+    def __init__(self, input, content_length):
+        """
+        :param input: The original WSGI input.
+        :param content_length: The length of the body.
+        :type content_length: int
+        
+        """
+        self._input = input
+        # The number of bytes that have not been read from the original input:
+        self._unread = content_length
+        # The bytes read by the parser:
+        if SpooledTemporaryFile is None:
+            self._spool = StringIO()
+        else:
+            self._spool = SpooledTemporaryFile(_SPOOL_SIZE)
+        self._spool_size = 0
+        # The position of the application in the body:
+        self._position = 0
+        # Whether the application has read more than the parser:
+        self._overtaken = False
+    
+    def fetch(self, size):
+        """
+        Read up to ``size`` bytes of the body which have not been read yet,
+        keeping them for the application.
+        
+        """
+        if self._overtaken:
+            return ''
+        data = self._read_input(size)
+        self._spool.seek(self._spool_size)
+        self._spool.write(data)
+        self._spool_size += len(data)
+        return data
+    
+    def _read_input(self, size, line=False):
+        """Read up to ``size`` bytes from the original input."""
+        if size < 0 or size > self._unread:
+            size = self._unread
+        if size <= 0:
+            return ''
+        if line:
+            data = self._input.readline(size)
+        else:
+            data = self._input.read(size)
+        if data:
+            self._unread -= len(data)
+        else:
+            # The body is shorter than expected:
+            self._unread = 0
+        return data
+    
+    def _read_remaining(self, size, line=False):
+        """Read the part of the body which has not been read by the parser."""
+        data = self._read_input(size, line)
+        if data:
+            self._overtaken = True
+        return data
+    
+    def read(self, size=-1):
+        data = ''
+        kept_size = self._spool_size - self._position
+        if kept_size > 0:
+            self._spool.seek(self._position)
+            if 0 <= size < kept_size:
+                data = self._spool.read(size)
+            else:
+                data = self._spool.read(kept_size)
+        if size < 0:
+            data += self._read_remaining(-1)
+        elif len(data) < size:
+            data += self._read_remaining(size - len(data))
+        self._position += len(data)
+        return data
+    
+    def readline(self, size=-1):
+        line = ''
+        kept_size = self._spool_size - self._position
+        if kept_size > 0:
+            self._spool.seek(self._position)
+            if 0 <= size < kept_size:
+                line = self._spool.readline(size)
+            else:
+                line = self._spool.readline(kept_size)
+        if not line.endswith('\n'):
+            if size < 0:
+                line += self._read_remaining(-1, True)
+            elif len(line) < size:
+                line += self._read_remaining(size - len(line), True)
+        self._position += len(line)
+        return line
+    
+    def readlines(self, hint=None):
+        return list(self)
+    
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+
+class _BodyReader(object):
+    """
+    Buffered reader of the body of a request, which stops after
+    ``max_size`` bytes.
+    
+    """
+    
+    def __init__(self, input):
+        """
+        :param input: The input of the request.
+        :type input: _ReplayableInput
+        
+        """
+        self.input = input
+        self.max_size = None
+        # Whether the body was not read completely because of max_size:
+        self.truncated = False
+        self._buffer = ''
+        self._size = 0
+    
+    def _fill(self):
+        """Read the next chunk of the body, if any; return whether it was."""
+        size = _CHUNK_SIZE
+        if self.max_size is not None:
+            if self._size >= self.max_size:
+                # The body may have been read completely anyway:
+                self.truncated = self.input._unread > 0
+                return False
+            size = min(size, self.max_size - self._size)
+        data = self.input.fetch(size)
+        if not data:
+            return False
+        self._size += len(data)
+        self._buffer += data
+        return True
+    
+    def read(self, size=None):
+        """Return up to ``size`` bytes (a chunk by default)."""
+        if size is None:
+            size = _CHUNK_SIZE
+        while len(self._buffer) < size and self._fill():
+            pass
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+    
+    def readline(self, size=_LINE_SIZE):
+        """
+        Return the next line, or up to ``size`` bytes of it.
+        
+        If the body was truncated in the middle of the line, nothing is
+        returned, so the whole line is returned once the body is read further.
+        
+        """
+        end = self._buffer.find('\n', 0, size)
+        while end < 0 and len(self._buffer) < size and self._fill():
+            end = self._buffer.find('\n', 0, size)
+        if end < 0:
+            if len(self._buffer) < size and self.truncated:
+                return ''
+            end = size
+        else:
+            end += 1
+        line = self._buffer[:end]
+        self._buffer = self._buffer[end:]
+        return line
+
+
+def _iter_urlencoded_variables(reader, parameters):
+    """
+    Return the variables in a ``application/x-www-form-urlencoded`` body, or
+    ``None`` each time it's truncated.
+    
+    """
+    pending = ''
+    while True:
+        chunk = reader.read()
+        if not chunk:
+            if not reader.truncated:
+                break
+            # Waiting for the rest of the body:
+            yield None
+            continue
+        pairs = (pending + chunk).split('&')
+        pending = pairs.pop()
+        for pair in pairs:
+            for variable in parse_qsl(pair, True):
+                yield variable
+    if pending:
+        for variable in parse_qsl(pending, True):
+            yield variable
+
+
+def _iter_multipart_variables(reader, parameters):
+    """
+    Return the variables in a ``multipart/form-data`` body, skipping the
+    uploaded files, or ``None`` each time it's truncated.
+    
+    """
+    delimiter = '--' + parameters['boundary']
+    close_delimiter = delimiter + '--'
+    # The part of the body being parsed: "preamble", "headers" or "contents":
+    state = 'preamble'
+    for line in _iter_lines(reader):
+        if line is None:
+            # Waiting for the rest of the body:
+            yield None
+        elif state == 'preamble':
+            if line.rstrip() == close_delimiter:
+                return
+            if line.rstrip() == delimiter:
+                headers = {}
+                state = 'headers'
+        elif state == 'headers':
+            if line.rstrip('\r\n'):
+                if ':' in line:
+                    (header, value) = line.split(':', 1)
+                    headers[header.strip().lower()] = value.strip()
+                continue
+            disposition, disposition_parameters = parse_header(
+                headers.get('content-disposition', ''))
+            name = disposition_parameters.get('name')
+            is_value = name is not None and \
+                       'filename' not in disposition_parameters
+            value_lines = []
+            at_line_start = True
+            state = 'contents'
+        elif at_line_start and line.rstrip() in (delimiter, close_delimiter):
+            # The contents of the part end at the next delimiter:
+            if is_value:
+                value = ''.join(value_lines)
+                if value.endswith('\r\n'):
+                    value = value[:-2]
+                elif value.endswith('\n'):
+                    value = value[:-1]
+                yield (name, value)
+            if line.rstrip() == close_delimiter:
+                return
+            headers = {}
+            state = 'headers'
+        else:
+            if is_value:
+                value_lines.append(line)
+            at_line_start = line.endswith('\n')
+    # The body is incomplete otherwise.
+
+
+def _iter_lines(reader):
+    """Return the lines of the body, or ``None`` each time it's truncated."""
+    while True:
+        line = reader.readline()
+        if line:
+            yield line
+        elif reader.truncated:
+            yield None
+        else:
+            return
+
+
+def _get_form_variables(variables, names):
+    """Return the variables called ``names`` which are not files."""
+    found_variables = {}
+    for name in names:
+        if name in variables:
+            value = variables[name]
+            if not hasattr(value, 'filename'):
+                found_variables[name] = value
+    return found_variables
+
+
+# The streaming parsers of POST variables, by content type:
+_FORM_PARSERS = {
+    'application/x-www-form-urlencoded': _iter_urlencoded_variables,
+    'multipart/form-data': _iter_multipart_variables,
+    }
+
+
+#{ Messages
+
+
+class _UnmetMessage(object):
+    """
+    The message of a predicate which is not met, which is only built the first
+    time it's converted into text.
+    
+    """
+    
+    __slots__ = ('_template', '_predicate', '_placeholders', '_text')
+    
+    def __init__(self, template, predicate, placeholders):
+        """
+        :param template: The message with the placeholders.
+        :param predicate: The predicate whose attributes are placeholders too.
+        :type predicate: Predicate
+        :param placeholders: The other placeholders.
+        :type placeholders: dict
+        
+        """
+        self._template = template
+        self._predicate = predicate
+        self._placeholders = placeholders
+        self._text = None
+    
+    def __unicode__(self):
+        # The message may be shared by the threads and the requests through
+        # the cache of decisions, so the text is built locally and only then
+        # assigned, and the fields it's built from are kept:
+        text = self._text
+        if text is None:
+            # Let's convert it into unicode because it may be just a class, as
+            # a Pylons' "lazy" translation message:
+            template = unicode(self._template)
+            # Include the predicate attributes in the placeholders:
+            all_placeholders = self._predicate.__dict__.copy()
+            all_placeholders.update(self._placeholders)
+            text = template % all_placeholders
+            if self._is_constant():
+                self._text = text
+        return text
+    
+    def _is_constant(self):
+        """
+        Check whether the text is always the same, unlike the "lazy"
+        translations, which depend on the language of the request.
+        
+        """
+        if not isinstance(self._template, basestring):
+            return False
+        for value in self._placeholders.values():
+            if not isinstance(value, _CONSTANT_TYPES):
+                return False
+        return True
+    
+    def __str__(self):
+        return str(unicode(self))
+    
+    def __repr__(self):
+        return repr(unicode(self))
+    
+    def __eq__(self, other):
+        return unicode(self) == other
+    
+    def __ne__(self, other):
+        return unicode(self) != other
+    
+    def __hash__(self):
+        return hash(unicode(self))
+
+
+# The types of the placeholders whose text doesn't change:
+_CONSTANT_TYPES = (basestring, int, long, float, type(None))
+
+
+class _FailedPredicates(object):
+    """
+    The messages of the predicates that were not met, which are only joined
+    when they are converted into text.
+    
+    """
+    
+    __slots__ = ('errors', )
+    
+    def __init__(self, errors):
+        """
+        :param errors: The exceptions raised by the predicates.
+        :type errors: list
+        
+        """
+        self.errors = errors
+    
+    def __unicode__(self):
+        return u', '.join([unicode(error) for error in self.errors])
+    
+    def __str__(self):
+        return str(unicode(self))
+
+
+class _MissingSections(object):
+    """
+    The messages of the single-section predicates which were not met by a
+    predicate on many sections, only built when they are converted into text.
+    
+    """
+    
+    __slots__ = ('predicate_class', 'placeholder', 'sections')
+    
+    def __init__(self, predicate_class, placeholder, sections):
+        """
+        :param predicate_class: The single-section predicate.
+        :param placeholder: The name of the section in the message of the
+            single-section predicate.
+        :type placeholder: str
+        :param sections: The sections that were not found.
+        
+        """
+        self.predicate_class = predicate_class
+        self.placeholder = placeholder
+        self.sections = sections
+    
+    def __unicode__(self):
+        template = unicode(self.predicate_class.message)
+        return u', '.join([template % {self.placeholder: section}
+                           for section in self.sections])
+    
+    def __str__(self):
+        return str(unicode(self))
+
+
+#{ Exceptions
+
+
+class PredicateError(Exception):
+    """
+    Former exception raised by a :class:`Predicate` if it's not met.
+    
+    .. deprecated:: 1.0.4
+        Deprecated in favor of :class:`NotAuthorizedError`, for forward
+        compatibility with :mod:`repoze.what` v2.
+    
+    """
+    
+    # Ugly workaround for Python < 2.6:
+    if not hasattr(Exception, '__unicode__'):
+        def __unicode__(self):
+            return unicode(self.args and self.args[0] or '')
+
+
+class NotAuthorizedError(PredicateError):
+    """
+    Exception raised by :meth:`Predicate.check_authorization` if the subject 
+    is not allowed to access the requested source.
+    
+    This exception deprecates :class:`PredicateError` as of v1.0.4, but
+    extends it to avoid breaking backwards compatibility.
+    
+    When it's raised by :meth:`Predicate.unmet`, its message is only built
+    when the exception is converted into text (e.g., with ``unicode(error)``)
+    or when its ``args`` or ``message`` are accessed, which are always text.
+    
+    .. versionchanged:: 1.0.4
+        This exception was defined at :mod:`repoze.what.authorize` until
+        version 1.0.3, but is still imported into that module to keep backwards
+        compatibility with v1.X releases -- but it won't work in
+        :mod:`repoze.what` v2.
+    
+    """
+    
+    def __init__(self, *args):
+        PredicateError.__init__(self, *args)
+        self._unmet_args = args
+    
+    def _get_args(self):
+        args = []
+        for arg in self._unmet_args:
+            if isinstance(arg, _UnmetMessage):
+                arg = unicode(arg)
+            args.append(arg)
+        return tuple(args)
+    
+    def _set_args(self, args):
+        self._unmet_args = tuple(args)
+    
+    args = property(_get_args, _set_args)
+    
+    def _get_message(self):
+        args = self.args
+        if len(args) == 1:
+            return args[0]
+        return ''
+    
+    message = property(_get_message)
 
 
 #}
@@ -57,6 +57,37 @@ class TestBaseSourceAdapter(unittest.TestCase):
                          self.adapter.fake_sections)
         self.assertEqual(self.adapter.all_sections_loaded, True)
     
+    def test_reloading_all_sections(self):
+        self.adapter.get_all_sections()
+        self.adapter.fake_sections = {u'trolls': set([u'sballmer'])}
+        self.assertEqual(self.adapter.get_all_sections(reload=True),
+                         self.adapter.fake_sections)
+    
+    def test_universal_sections(self):
+        self.assertEqual(self.adapter.get_universal_sections(), frozenset())
+        self.adapter.fake_sections[u'python'].add(u'_')
+        self.adapter.fake_sections[u'php'].add(u'_')
+        self.assertEqual(self.adapter.get_universal_sections(),
+                         frozenset([u'python', u'php']))
+    
+    def test_anonymous_sections(self):
+        self.assertEqual(self.adapter.get_anonymous_sections(), frozenset())
+        self.adapter.fake_sections[u'trolls'].add(u'-')
+        self.assertEqual(self.adapter.get_anonymous_sections(),
+                         frozenset([u'trolls']))
+    
+    def test_getting_many_sections_items(self):
+        self.adapter.get_section_items(u'trolls')
+        self.adapter.fake_sections[u'trolls'] = set([u'linus'])
+        sections = self.adapter.get_sections_items([u'trolls', u'admins',
+                                                    u'designers'])
+        # The cached section is reused and the unknown one is skipped:
+        self.assertEqual(sections, {u'trolls': set([u'sballmer']),
+                                    u'admins': set([u'rms'])})
+        self.assertEqual(self.adapter.loaded_sections, sections)
+        self.adapter.get_all_sections()
+        self.assertEqual(self.adapter.get_sections_items([u'designers']), {})
+    
     def test_getting_section_items(self):
         self.assertEqual(self.adapter.get_section_items(u'trolls'), 
                          self.adapter.fake_sections[u'trolls'])
@@ -81,6 +112,18 @@ class TestBaseSourceAdapter(unittest.TestCase):
         self.assertEqual(self.adapter.get_section_items(u'developers'),
                          set(items))
     
+    def test_checking_whether_item_is_included(self):
+        assert self.adapter.item_is_included(u'developers', u'linus')
+        assert not self.adapter.item_is_included(u'developers', u'sballmer')
+        assert not self.adapter.item_is_included(u'designers', u'linus')
+        # The section wasn't loaded:
+        self.assertEqual(self.adapter.loaded_sections, {})
+    
+    def test_checking_whether_item_is_included_in_loaded_section(self):
+        self.adapter.get_section_items(u'developers')
+        del self.adapter.fake_sections[u'developers']
+        assert self.adapter.item_is_included(u'developers', u'linus')
+    
     def test_getting_sections_by_criteria(self):
         credentials = {'repoze.what.userid': u'sballmer'}
         sections = set([u'trolls'])
@@ -179,6 +222,47 @@ class TestBaseSourceAdapter(unittest.TestCase):
                           self.adapter.get_section_items,
                           u'developers')
     
+    def test_listeners_are_notified_of_included_items(self):
+        changes = []
+        self.adapter.add_change_listener(
+            lambda adapter, section, items: changes.append((section, items)))
+        self.adapter.include_item(u'developers', u'guido')
+        self.assertEqual(changes, [(u'developers', set([u'guido']))])
+    
+    def test_listeners_are_notified_of_excluded_items(self):
+        changes = []
+        self.adapter.add_change_listener(
+            lambda adapter, section, items: changes.append((section, items)))
+        self.adapter.exclude_item(u'developers', u'linus')
+        self.assertEqual(changes, [(u'developers', set([u'linus']))])
+    
+    def test_inclusions_may_be_rejected(self):
+        changes = []
+        self.adapter.add_change_listener(
+            lambda adapter, section, items: changes.append((section, items)))
+        def reject(adapter, section, items):
+            if u'sballmer' in items:
+                raise SourceError('sballmer is not welcome')
+        self.adapter.add_inclusion_validator(reject)
+        self.assertRaises(SourceError, self.adapter.include_items,
+                          u'developers', [u'guido', u'sballmer'])
+        assert not self.adapter.item_is_included(u'developers', u'guido')
+        self.assertEqual(changes, [])
+        self.adapter.include_item(u'developers', u'guido')
+        self.assertEqual(changes, [(u'developers', set([u'guido']))])
+    
+    def test_listeners_are_notified_of_section_changes(self):
+        changes = []
+        self.adapter.add_change_listener(
+            lambda adapter, section, items: changes.append((section, items)))
+        self.adapter.create_section(u'sysadmins')
+        self.adapter.edit_section(u'sysadmins', u'operators')
+        self.adapter.delete_section(u'operators')
+        self.assertEqual(changes, [(u'sysadmins', None),
+                                   (u'sysadmins', None),
+                                   (u'operators', None),
+                                   (u'operators', None)])
+    
     def test_checking_section_existence(self):
         # Existing section:
         self.adapter._check_section_existence(u'developers')
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2008-2009, Gustavo Narea <me@gustavonarea.net>
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+"""
+Tests for the evaluation of predicates for many users at once.
+
+"""
+
+import unittest
+
+from nose.plugins.skip import SkipTest
+
+from repoze.what import bulk
+from repoze.what.bulk import CredentialsMatrix
+from repoze.what.credentials import Credentials
+from repoze.what.predicates import Predicate, All, Any, Not, is_user, \
+                                   in_group, in_all_groups, in_any_group, \
+                                   has_permission, has_all_permissions, \
+                                   has_any_permission, is_anonymous, \
+                                   not_anonymous
+
+
+class TestCredentialsMatrix(unittest.TestCase):
+    
+    use_numpy = False
+    
+    def setUp(self):
+        self.credentials = [
+            Credentials(u'rms', (u'admins', u'developers'),
+                        (u'edit-site', u'commit')),
+            Credentials(u'linus', (u'developers', ), (u'commit', )),
+            Credentials(u'sballmer', (u'trolls', ), ()),
+            Credentials(None, (), (u'see-site', )),
+            Credentials(u'guido', (u'developers', u'admins'),
+                        (u'edit-site', u'commit', u'see-site')),
+            ]
+        self.matrix = CredentialsMatrix(self.credentials, self.use_numpy)
+    
+    def _check_users(self, predicate, expected_userids):
+        self.assertEqual(self.matrix.find_users(predicate), expected_userids)
+        # The results must be the ones of the predicate itself:
+        userids = [c.userid for c in self.credentials
+                   if predicate.is_met({'repoze.what.credentials': c})]
+        self.assertEqual(userids, expected_userids)
+    
+    def test_groups_and_permissions(self):
+        self._check_users(in_group(u'developers'),
+                          [u'rms', u'linus', u'guido'])
+        self._check_users(in_group(u'designers'), [])
+        self._check_users(has_permission(u'see-site'), [None, u'guido'])
+        self._check_users(in_all_groups(u'admins', u'developers'),
+                          [u'rms', u'guido'])
+        self._check_users(in_any_group(u'admins', u'trolls'),
+                          [u'rms', u'sballmer', u'guido'])
+        self._check_users(has_all_permissions(u'commit', u'see-site'),
+                          [u'guido'])
+        self._check_users(has_any_permission(u'edit-site', u'unknown'),
+                          [u'rms', u'guido'])
+    
+    def test_users(self):
+        self._check_users(is_user(u'linus'), [u'linus'])
+        self._check_users(is_anonymous(), [None])
+        self._check_users(not_anonymous(),
+                          [u'rms', u'linus', u'sballmer', u'guido'])
+    
+    def test_compound_predicates(self):
+        self._check_users(All(in_group(u'developers'),
+                              Not(has_permission(u'edit-site'))),
+                          [u'linus'])
+        self._check_users(Any(is_user(u'sballmer'),
+                              All(not_anonymous(), has_permission(u'see-site')),
+                              Not(All())),
+                          [u'sballmer', u'guido'])
+        self._check_users(All(), [u'rms', u'linus', u'sballmer', None,
+                                  u'guido'])
+    
+    def test_custom_predicates(self):
+        self._check_users(All(in_group(u'developers'), LongUserid()),
+                          [u'linus', u'guido'])
+    
+    def test_shared_predicates_are_evaluated_once(self):
+        evaluated = []
+        p = CountingPredicate(evaluated)
+        self.matrix.evaluate(Any(All(in_group(u'admins'), p), p))
+        self.assertEqual(len(evaluated), len(self.credentials))
+    
+    def test_no_users(self):
+        matrix = CredentialsMatrix([], self.use_numpy)
+        self.assertEqual(matrix.find_users(Not(in_group(u'admins'))), [])
+
+
+class TestNumPyCredentialsMatrix(TestCredentialsMatrix):
+    
+    use_numpy = True
+    
+    def setUp(self):
+        if bulk.numpy is None:
+            raise SkipTest('NumPy is not available')
+        super(TestNumPyCredentialsMatrix, self).setUp()
+
+
+class TestBitColumns(unittest.TestCase):
+    
+    def test_many_users(self):
+        columns = bulk._BitColumns(200)
+        positions = [0, 3, 64, 65, 199]
+        column = columns.make(positions)
+        self.assertEqual(columns.positions(column), positions)
+        self.assertEqual(columns.positions(columns.complement(column)),
+                         [i for i in range(200) if i not in positions])
+        self.assertEqual(columns.positions(columns.none()), [])
+    
+    def test_numpy_is_required(self):
+        if bulk.numpy is not None:
+            raise SkipTest('NumPy is available')
+        self.assertRaises(ValueError, CredentialsMatrix, [], True)
+
+
+#{ Mock definitions
+
+
+class LongUserid(Predicate):
+    """Mock predicate met by the users whose userid is long."""
+    
+    message = 'The userid must be long'
+    
+    def evaluate(self, environ, credentials):
+        if len(credentials.get('repoze.what.userid') or '') < 5:
+            self.unmet()
+
+
+class CountingPredicate(Predicate):
+    """Mock predicate which records its evaluations."""
+    
+    def __init__(self, evaluated):
+        super(CountingPredicate, self).__init__()
+        self.evaluated = evaluated
+    
+    def evaluate(self, environ, credentials):
+        self.evaluated.append(credentials)
+
+
+#}
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2008-2009, Gustavo Narea <me@gustavonarea.net>
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+"""
+Tests for the in-memory caches.
+
+"""
+
+import unittest
+
+from repoze.what.cache import TTLCache
+
+
+class FakeTimer(object):
+    """Mock clock whose time only changes when told to."""
+    
+    def __init__(self):
+        self.now = 1000
+    
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+    
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.cache = TTLCache(max_size=3, ttl=10, timer=self.timer)
+    
+    def test_missing_key(self):
+        self.assertEqual(self.cache.get('foo'), None)
+        self.assertEqual(self.cache.get('foo', 'bar'), 'bar')
+        assert 'foo' not in self.cache
+    
+    def test_setting_and_getting(self):
+        self.cache.set('foo', 'bar')
+        self.assertEqual(self.cache.get('foo'), 'bar')
+        assert 'foo' in self.cache
+        self.assertEqual(len(self.cache), 1)
+    
+    def test_entries_expire(self):
+        self.cache.set('foo', 'bar')
+        self.timer.now += 9
+        self.assertEqual(self.cache.get('foo'), 'bar')
+        self.timer.now += 1
+        self.assertEqual(self.cache.get('foo'), None)
+        self.assertEqual(len(self.cache), 0)
+    
+    def test_entries_dont_expire_without_ttl(self):
+        cache = TTLCache(ttl=None, timer=self.timer)
+        cache.set('foo', 'bar')
+        self.timer.now += 10 ** 9
+        self.assertEqual(cache.get('foo'), 'bar')
+    
+    def test_oldest_entry_is_evicted(self):
+        for key in ('a', 'b', 'c', 'd'):
+            self.cache.set(key, key.upper())
+        self.assertEqual(len(self.cache), 3)
+        assert 'a' not in self.cache
+        self.assertEqual(self.cache.get('d'), 'D')
+    
+    def test_replacing_entry_doesnt_evict(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, key.upper())
+        self.cache.set('a', 'A2')
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.get('a'), 'A2')
+    
+    def test_replaced_entry_is_evicted_by_its_new_age(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, key.upper())
+        self.cache.set('a', 'A2')
+        self.cache.set('d', 'D')
+        assert 'b' not in self.cache
+        self.assertEqual(self.cache.get('a'), 'A2')
+    
+    def test_invalidating(self):
+        self.cache.set('foo', 'bar')
+        self.cache.invalidate('foo')
+        self.cache.invalidate('non-existing')
+        assert 'foo' not in self.cache
+    
+    def test_clearing(self):
+        self.cache.set('foo', 'bar')
+        self.cache.set('baz', 'qux')
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2008-2009, Gustavo Narea <me@gustavonarea.net>
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+"""
+Tests for the containers of groups and permissions.
+
+"""
+
+import unittest
+
+from repoze.what.credentials import Credentials, SectionSet, LazySections, \
+                                    DemandSections, SectionIndex, \
+                                    BitmaskSections
+
+
+class TestCredentials(unittest.TestCase):
+    
+    def test_it_is_a_dictionary(self):
+        credentials = Credentials('rms', SectionSet(['admins']), SectionSet())
+        expected_credentials = {
+            'repoze.what.userid': 'rms',
+            'groups': ('admins', ),
+            'permissions': ()
+            }
+        self.assertEqual(credentials, expected_credentials)
+    
+    def test_attributes(self):
+        credentials = Credentials('rms', SectionSet(['admins']),
+                                  SectionSet(['commit']))
+        self.assertEqual(credentials.userid, 'rms')
+        self.assertEqual(credentials.groups, ('admins', ))
+        self.assertEqual(credentials.permissions, ('commit', ))
+    
+    def test_anonymous_credentials_are_false(self):
+        assert Credentials('rms')
+        assert not Credentials(None, SectionSet(['guests']))
+    
+    def test_instances_have_no_dict(self):
+        credentials = Credentials('rms')
+        self.assertRaises(AttributeError, setattr, credentials, 'foo', 'bar')
+
+
+class TestSectionSet(unittest.TestCase):
+    
+    def setUp(self):
+        self.sections = SectionSet(['developers', 'admins'])
+    
+    def test_membership(self):
+        assert 'developers' in self.sections
+        assert 'designers' not in self.sections
+    
+    def test_comparison_with_tuples_and_lists(self):
+        self.assertEqual(self.sections, ('admins', 'developers'))
+        self.assertEqual(('developers', 'admins'), self.sections)
+        self.assertEqual(self.sections, ['admins', 'developers'])
+        assert self.sections != ('admins', )
+        assert self.sections != ('admins', 'developers', 'designers')
+    
+    def test_comparison_with_sets(self):
+        self.assertEqual(self.sections, set(['admins', 'developers']))
+        self.assertEqual(hash(self.sections),
+                         hash(frozenset(['admins', 'developers'])))
+    
+    def test_indexing(self):
+        self.assertEqual(set([self.sections[0], self.sections[1]]),
+                         set(self.sections))
+        self.assertEqual(set(self.sections[:]), set(self.sections))
+
+
+class TestLazySections(unittest.TestCase):
+    
+    def setUp(self):
+        self.calls = []
+        self.sections = LazySections(self._load)
+    
+    def _load(self):
+        self.calls.append(None)
+        return set(['developers', 'admins'])
+    
+    def test_not_loaded_initially(self):
+        assert not self.sections.loaded
+        self.assertEqual(repr(self.sections), '<LazySections (not loaded)>')
+        self.assertEqual(self.calls, [])
+    
+    def test_membership(self):
+        assert 'developers' in self.sections
+        assert 'designers' not in self.sections
+        assert self.sections.loaded
+        self.assertEqual(len(self.calls), 1)
+    
+    def test_iteration(self):
+        self.assertEqual(set(self.sections), set(['developers', 'admins']))
+        self.assertEqual(len(self.sections), 2)
+        self.assertEqual(len(self.calls), 1)
+    
+    def test_indexing(self):
+        assert self.sections[0] in ('developers', 'admins')
+    
+    def test_loaded_sections_are_a_set(self):
+        assert isinstance(self.sections._load(), SectionSet)
+    
+    def test_comparison(self):
+        sections = tuple(self.sections)
+        self.assertEqual(self.sections, sections)
+        assert self.sections != ()
+        self.assertEqual(self.sections, LazySections(lambda: sections))
+
+
+class TestDemandSections(unittest.TestCase):
+    
+    def setUp(self):
+        self.loads = []
+        self.checks = []
+        self.sections = DemandSections(self._load, self._check)
+    
+    def _load(self):
+        self.loads.append(None)
+        return set(['developers', 'admins'])
+    
+    def _check(self, section):
+        self.checks.append(section)
+        return section in ('developers', 'admins')
+    
+    def test_membership_is_checked_individually(self):
+        assert 'developers' in self.sections
+        assert 'designers' not in self.sections
+        assert not self.sections.loaded
+        self.assertEqual(self.checks, ['developers', 'designers'])
+    
+    def test_answers_are_memoised(self):
+        assert 'developers' in self.sections
+        assert 'developers' in self.sections
+        self.assertEqual(self.checks, ['developers'])
+    
+    def test_all_sections_are_loaded_when_needed(self):
+        self.assertEqual(len(self.sections), 2)
+        assert 'admins' in self.sections
+        self.assertEqual(self.checks, [])
+        self.assertEqual(len(self.loads), 1)
+
+
+
+class TestSectionIndex(unittest.TestCase):
+    
+    def setUp(self):
+        self.index = SectionIndex(['admins', 'developers'])
+    
+    def test_known_sections(self):
+        self.assertEqual(len(self.index), 2)
+        assert 'admins' in self.index
+        assert 'trolls' not in self.index
+    
+    def test_encoding(self):
+        sections = self.index.encode(['developers'])
+        self.assertEqual(sections.mask, 2)
+        assert sections.index is self.index
+        self.assertEqual(self.index.decode(3), ['admins', 'developers'])
+    
+    def test_unknown_sections_are_assigned_a_bit(self):
+        sections = self.index.encode(['trolls', 'admins'])
+        self.assertEqual(sections.mask, 5)
+        self.assertEqual(len(self.index), 3)
+        # The bits don't change:
+        self.assertEqual(self.index.encode(['trolls']).mask, 4)
+    
+    def test_masks(self):
+        required_sections = frozenset(['admins', 'developers'])
+        self.assertEqual(self.index.get_mask(required_sections), (3, True))
+        self.assertEqual(self.index.get_mask(['admins', 'trolls']),
+                         (1, False))
+    
+    def test_masks_of_new_sections(self):
+        required_sections = frozenset(['admins', 'trolls'])
+        self.assertEqual(self.index.get_mask(required_sections), (1, False))
+        self.index.encode(['trolls'])
+        self.assertEqual(self.index.get_mask(required_sections), (5, True))
+
+
+class TestBitmaskSections(unittest.TestCase):
+    
+    def setUp(self):
+        self.index = SectionIndex(['admins', 'developers', 'trolls'])
+        self.sections = self.index.encode(['developers', 'admins'])
+    
+    def test_membership(self):
+        assert 'admins' in self.sections
+        assert 'trolls' not in self.sections
+        assert 'designers' not in self.sections
+    
+    def test_inclusion_of_many_sections(self):
+        assert self.sections.includes_all(frozenset(['admins', 'developers']))
+        assert not self.sections.includes_all(frozenset(['admins', 'trolls']))
+        assert not self.sections.includes_all(frozenset(['designers']))
+        assert self.sections.includes_any(frozenset(['designers', 'admins']))
+        assert not self.sections.includes_any(frozenset(['trolls']))
+    
+    def test_iteration(self):
+        self.assertEqual(sorted(self.sections), ['admins', 'developers'])
+        self.assertEqual(len(self.sections), 2)
+        self.assertEqual(self.sections[0], 'admins')
+    
+    def test_comparison(self):
+        self.assertEqual(self.sections, ('developers', 'admins'))
+        self.assertEqual(self.sections, SectionSet(['admins', 'developers']))
+        self.assertEqual(SectionSet(['admins', 'developers']), self.sections)
+        self.assertEqual(self.sections,
+                         self.index.encode(['admins', 'developers']))
+        self.assertNotEqual(self.sections, ['admins'])
+        self.assertNotEqual(self.sections, 'admins')
+        self.assertEqual(hash(self.sections),
+                         hash(frozenset(['admins', 'developers'])))
+    
+    def test_lazy_sections_keep_the_bitmask(self):
+        lazy_sections = LazySections(lambda: self.sections)
+        assert 'admins' in lazy_sections
+        assert lazy_sections._load() is self.sections
+    
+    def test_instances_have_no_dict(self):
+        assert not hasattr(self.sections, '__dict__')
@@ -33,6 +33,12 @@ from repoze.who.plugins.testutil import AuthenticationForgerPlugin, \
                                         AuthenticationForgerMiddleware
 
 from repoze.what.middleware import AuthorizationMetadata, setup_auth
+from repoze.what.predicates import Predicate, All, Any, Not, is_user, \
+                                   in_group, in_all_groups, in_any_group, \
+                                   has_permission, has_all_permissions, \
+                                   is_anonymous, not_anonymous
+from repoze.what.credentials import Credentials, SectionSet, BitmaskSections
+from repoze.what.adapters import SourceError
 
 from base import FakeAuthenticator, FakeGroupSourceAdapter, \
                  FakePermissionSourceAdapter, FakeLogger
@@ -56,6 +62,33 @@ class FakeGroupFetcher3(object):
         return ('graphic-designers', 'sysadmins')
 
 
+class CountingPermissionSourceAdapter(FakePermissionSourceAdapter):
+    """Permission adapter which records the calls to its abstract methods."""
+    def __init__(self, *args, **kwargs):
+        super(CountingPermissionSourceAdapter, self).__init__(*args, **kwargs)
+        self.calls = []
+    
+    def _get_all_sections(self):
+        self.calls.append('_get_all_sections')
+        sections = super(CountingPermissionSourceAdapter, self)
+        return sections._get_all_sections().copy()
+    
+    def _find_sections(self, hint):
+        self.calls.append('_find_sections')
+        sections = super(CountingPermissionSourceAdapter, self)
+        return sections._find_sections(hint)
+
+
+class CountingGroupFetcher(FakeGroupFetcher1):
+    """Group fetcher which records the users it's asked about."""
+    def __init__(self):
+        self.userids = []
+    
+    def find_sections(self, credentials):
+        self.userids.append(credentials['repoze.what.userid'])
+        return super(CountingGroupFetcher, self).find_sections(credentials)
+
+
 class FakePermissionFetcher1(object):
     def find_sections(self, group):
         if group == 'sysadmins':
@@ -79,6 +112,16 @@ class FakePermissionFetcher3(object):
         return ('contact', )
 
 
+class CountingPermissionFetcher(FakePermissionFetcher1):
+    """Permission fetcher which records the groups it's asked about."""
+    def __init__(self):
+        self.hints = []
+    
+    def find_sections(self, group):
+        self.hints.append(group)
+        return super(CountingPermissionFetcher, self).find_sections(group)
+
+
 #{ The tests themselves
 
 
@@ -140,6 +183,32 @@ class TestAuthorizationMetadata(unittest.TestCase):
         self.assertEqual(environ['repoze.what.credentials'],
                          expected_credentials)
     
+    def test_credentials_type(self):
+        environ = {}
+        identity = {'repoze.who.userid': 'rms'}
+        plugin = AuthorizationMetadata({'groups': FakeGroupSourceAdapter()},
+                                       {'perms': FakePermissionSourceAdapter()})
+        plugin.add_metadata(environ, identity)
+        credentials = environ['repoze.what.credentials']
+        assert isinstance(credentials, Credentials)
+        assert isinstance(credentials['groups'], SectionSet)
+        assert isinstance(credentials['permissions'], SectionSet)
+        assert identity['groups'] is credentials['groups']
+    
+    def test_existing_credentials_are_updated(self):
+        environ = {'repoze.what.credentials': {'foo': 'bar'}}
+        identity = {'repoze.who.userid': 'someone'}
+        plugin = AuthorizationMetadata()
+        plugin.add_metadata(environ, identity)
+        expected_credentials = {
+            'foo': 'bar',
+            'repoze.what.userid': 'someone',
+            'groups': (),
+            'permissions': ()
+            }
+        self.assertEqual(environ['repoze.what.credentials'],
+                         expected_credentials)
+    
     def test_no_groups_and_permissions(self):
         """Groups/permissions-based authorization is optional"""
         environ = {}
@@ -245,6 +314,698 @@ class TestAuthorizationMetadata(unittest.TestCase):
         self._check_groups_and_permissions(environ, identity, expected_groups,
                                            expected_permissions)
 
+    
+    def test_permissions_are_cached_per_group(self):
+        permission_adapter = CountingPermissionFetcher()
+        plugin = AuthorizationMetadata({'tech-team': FakeGroupFetcher1()},
+                                       {'perms': permission_adapter},
+                                       permissions_cache_size=10)
+        for userid in ('rms', 'linus'):
+            identity = {'repoze.who.userid': userid}
+            environ = {}
+            plugin.add_metadata(environ, identity)
+            self._check_groups_and_permissions(
+                environ, identity, ('directors', 'sysadmins'),
+                ('view-users', 'edit-users', 'add-users'))
+        # Each group was only looked up once:
+        self.assertEqual(sorted(permission_adapter.hints),
+                         ['directors', 'sysadmins'])
+    
+    def test_permissions_are_not_cached_by_default(self):
+        permission_adapter = CountingPermissionFetcher()
+        plugin = AuthorizationMetadata({'tech-team': FakeGroupFetcher1()},
+                                       {'perms': permission_adapter})
+        plugin.add_metadata({}, {'repoze.who.userid': 'rms'})
+        plugin.add_metadata({}, {'repoze.who.userid': 'linus'})
+        self.assertEqual(len(permission_adapter.hints), 4)
+    
+    def test_cached_permissions_are_updated_with_the_source(self):
+        permission_adapter = FakePermissionSourceAdapter()
+        plugin = AuthorizationMetadata({'groups': FakeGroupSourceAdapter()},
+                                       {'perms': permission_adapter},
+                                       permissions_cache_size=10)
+        identity = {'repoze.who.userid': 'linus'}
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', ),
+                                           ('edit-site', 'commit'))
+        # Modifying the permissions of the group:
+        permission_adapter.exclude_item(u'commit', u'developers')
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', ), ('edit-site', ))
+        # Creating a permission:
+        permission_adapter.create_section(u'release')
+        permission_adapter.include_item(u'release', u'developers')
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', ),
+                                           ('edit-site', 'release'))
+
+    
+    def test_credentials_are_cached_per_user(self):
+        group_adapter = CountingGroupFetcher()
+        plugin = AuthorizationMetadata({'tech-team': group_adapter},
+                                       {'perms': FakePermissionFetcher2()},
+                                       credentials_cache_size=10)
+        for i in range(3):
+            identity = {'repoze.who.userid': 'rms'}
+            environ = {}
+            plugin.add_metadata(environ, identity)
+            self._check_groups_and_permissions(environ, identity,
+                                               ('directors', 'sysadmins'),
+                                               ('hire', 'fire'))
+        self.assertEqual(group_adapter.userids, ['rms'])
+        plugin.add_metadata({}, {'repoze.who.userid': 'linus'})
+        self.assertEqual(group_adapter.userids, ['rms', 'linus'])
+    
+    def test_invalidating_cached_credentials(self):
+        group_adapter = CountingGroupFetcher()
+        plugin = AuthorizationMetadata({'tech-team': group_adapter},
+                                       {'perms': FakePermissionFetcher2()},
+                                       credentials_cache_size=10)
+        plugin.add_metadata({}, {'repoze.who.userid': 'rms'})
+        plugin.add_metadata({}, {'repoze.who.userid': 'linus'})
+        # Only rms' credentials must be reloaded:
+        plugin.invalidate_user('rms')
+        plugin.add_metadata({}, {'repoze.who.userid': 'rms'})
+        plugin.add_metadata({}, {'repoze.who.userid': 'linus'})
+        self.assertEqual(group_adapter.userids, ['rms', 'linus', 'rms'])
+        # Now everybody's credentials must be reloaded:
+        plugin.invalidate_all()
+        plugin.add_metadata({}, {'repoze.who.userid': 'rms'})
+        plugin.add_metadata({}, {'repoze.who.userid': 'linus'})
+        self.assertEqual(group_adapter.userids,
+                         ['rms', 'linus', 'rms', 'rms', 'linus'])
+    
+    def test_cached_credentials_are_updated_with_the_sources(self):
+        group_adapter = FakeGroupSourceAdapter()
+        permission_adapter = FakePermissionSourceAdapter()
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': permission_adapter},
+                                       credentials_cache_size=10)
+        identity = {'repoze.who.userid': 'linus'}
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', ),
+                                           ('edit-site', 'commit'))
+        # Modifying the groups of the user:
+        group_adapter.include_item(u'trolls', u'linus')
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', 'trolls'),
+                                           ('edit-site', 'commit', 'see-site'))
+        # Modifying the permissions of one of its groups:
+        permission_adapter.exclude_item(u'see-site', u'trolls')
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', 'trolls'),
+                                           ('edit-site', 'commit'))
+    
+    def test_decisions_are_not_cached_by_default(self):
+        plugin = AuthorizationMetadata({'groups': FakeGroupSourceAdapter()},
+                                       {'perms': FakePermissionFetcher2()})
+        environ = {}
+        plugin.add_metadata(environ, {'repoze.who.userid': 'linus'})
+        assert plugin.decision_cache is None
+        assert 'repoze.what.decisions' not in environ
+    
+    def test_decisions_are_cached(self):
+        plugin = AuthorizationMetadata({'groups': FakeGroupSourceAdapter()},
+                                       {'perms': FakePermissionFetcher2()},
+                                       decision_cache_size=10)
+        for i in range(2):
+            environ = {}
+            plugin.add_metadata(environ, {'repoze.who.userid': 'linus'})
+            assert environ['repoze.what.decisions'] is plugin.decision_cache
+            assert in_group('developers').is_met(environ)
+            assert not in_group('admins').is_met(environ)
+        self.assertEqual(len(plugin.decision_cache), 2)
+        plugin.invalidate_user('rms')
+        self.assertEqual(len(plugin.decision_cache), 0)
+        assert in_group('developers').is_met(environ)
+        plugin.invalidate_all()
+        self.assertEqual(len(plugin.decision_cache), 0)
+    
+    def test_cached_decisions_are_updated_with_the_sources(self):
+        group_adapter = FakeGroupSourceAdapter()
+        permission_adapter = FakePermissionSourceAdapter()
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': permission_adapter},
+                                       decision_cache_size=10)
+        environ = {}
+        plugin.add_metadata(environ, {'repoze.who.userid': 'linus'})
+        assert in_group('developers').is_met(environ)
+        group_adapter.include_item(u'trolls', u'linus')
+        self.assertEqual(len(plugin.decision_cache), 0)
+        assert in_group('developers').is_met(environ)
+        permission_adapter.exclude_item(u'see-site', u'trolls')
+        self.assertEqual(len(plugin.decision_cache), 0)
+    
+    def test_decisions_on_lazy_credentials_follow_the_sources(self):
+        group_adapter = FakeGroupSourceAdapter()
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': FakePermissionSourceAdapter()},
+                                       credentials_mode='lazy',
+                                       decision_cache_size=10)
+        results = []
+        for i in range(2):
+            environ = {}
+            plugin.add_metadata(environ, {'repoze.who.userid': 'linus'})
+            results.append(in_group('developers').is_met(environ))
+            # The group is revoked behind the adapter's back:
+            group_adapter.fake_sections[u'developers'].discard(u'linus')
+        self.assertEqual(results, [True, False])
+    
+    def test_bitmask_credentials_are_disabled_by_default(self):
+        plugin = AuthorizationMetadata({'groups': FakeGroupSourceAdapter()},
+                                       {'perms': FakePermissionFetcher2()})
+        identity = {'repoze.who.userid': 'linus'}
+        plugin.add_metadata({}, identity)
+        assert plugin.group_index is None
+        assert plugin.permission_index is None
+        assert isinstance(identity['groups'], SectionSet)
+    
+    def test_bitmask_credentials(self):
+        plugin = AuthorizationMetadata(
+            {'groups': FakeGroupSourceAdapter()},
+            {'perms': FakePermissionSourceAdapter()},
+            permission_implications={'commit': ['push']},
+            bitmask_credentials=True)
+        # Every section was assigned a bit at startup:
+        self.assertEqual(len(plugin.group_index), 5)
+        self.assertEqual(len(plugin.permission_index), 4)
+        identity = {'repoze.who.userid': 'rms'}
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('admins', 'developers'),
+                                           ('edit-site', 'commit', 'push'))
+        credentials = environ['repoze.what.credentials']
+        assert isinstance(credentials['groups'], BitmaskSections)
+        assert isinstance(credentials['permissions'], BitmaskSections)
+        assert in_all_groups('admins', 'developers').is_met(environ)
+        assert not in_any_group('trolls', 'python').is_met(environ)
+        assert has_all_permissions('commit', 'push').is_met(environ)
+        assert not has_permission('see-site').is_met(environ)
+    
+    def test_bitmask_credentials_with_new_sections(self):
+        group_adapter = FakeGroupSourceAdapter()
+        plugin = AuthorizationMetadata(
+            {'groups': group_adapter},
+            {'perms': FakePermissionSourceAdapter()},
+            credentials_cache_size=10,
+            bitmask_credentials=True)
+        environ = {}
+        plugin.add_metadata(environ, {'repoze.who.userid': 'rms'})
+        old_credentials = environ['repoze.what.credentials']
+        group_adapter.create_section(u'designers')
+        group_adapter.include_item(u'designers', u'rms')
+        environ = {}
+        plugin.add_metadata(environ, {'repoze.who.userid': 'rms'})
+        assert in_all_groups('designers', 'admins').is_met(environ)
+        self.assertEqual(len(plugin.group_index), 6)
+        # The credentials encoded before are still valid:
+        self.assertEqual(old_credentials['groups'], ('admins', 'developers'))
+
+    
+    def test_lazy_credentials(self):
+        group_adapter = CountingGroupFetcher()
+        logger = FakeLogger()
+        environ = {'repoze.who.logger': logger}
+        identity = {'repoze.who.userid': 'rms'}
+        plugin = AuthorizationMetadata({'tech-team': group_adapter},
+                                       {'perms': FakePermissionFetcher2()},
+                                       credentials_mode='lazy')
+        plugin.add_metadata(environ, identity)
+        credentials = environ['repoze.what.credentials']
+        self.assertEqual(credentials['repoze.what.userid'], 'rms')
+        # Nothing has been loaded yet:
+        self.assertEqual(group_adapter.userids, [])
+        self.assertEqual(logger.messages['info'], [])
+        # But it's loaded as soon as it's needed:
+        assert 'hire' in credentials['permissions']
+        self.assertEqual(group_adapter.userids, ['rms'])
+        self._check_groups_and_permissions(environ, identity,
+                                           ('directors', 'sysadmins'),
+                                           ('hire', 'fire'))
+        self.assertEqual(group_adapter.userids, ['rms'])
+        assert "hire" in "; ".join(logger.messages['info'])
+    
+    def test_on_demand_credentials(self):
+        group_adapter = FakeGroupSourceAdapter()
+        permission_adapter = FakePermissionSourceAdapter()
+        environ = {}
+        identity = {'repoze.who.userid': 'linus'}
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': permission_adapter},
+                                       credentials_mode='on-demand')
+        plugin.add_metadata(environ, identity)
+        credentials = environ['repoze.what.credentials']
+        assert 'developers' in credentials['groups']
+        assert 'admins' not in credentials['groups']
+        assert 'non-existing' not in credentials['groups']
+        assert 'commit' in credentials['permissions']
+        assert 'see-site' not in credentials['permissions']
+        # The groups and permissions were not retrieved altogether:
+        assert not credentials['groups'].loaded
+        assert not credentials['permissions'].loaded
+        self.assertEqual(group_adapter.all_sections_loaded, False)
+        # But they can be:
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', ),
+                                           ('edit-site', 'commit'))
+    
+    def test_on_demand_credentials_with_basic_adapters(self):
+        """Adapters which can't answer point questions must work too"""
+        environ = {}
+        identity = {'repoze.who.userid': 'whatever'}
+        group_adapters = {
+            'tech-team': FakeGroupFetcher1(),
+            'executive': FakeGroupFetcher3()
+            }
+        permission_adapters = {'perms1': FakePermissionFetcher2()}
+        plugin = AuthorizationMetadata(group_adapters, permission_adapters,
+                                       credentials_mode='on-demand')
+        plugin.add_metadata(environ, identity)
+        credentials = environ['repoze.what.credentials']
+        assert 'graphic-designers' in credentials['groups']
+        assert 'webdesigners' not in credentials['groups']
+        assert 'upload-images' in credentials['permissions']
+        assert 'contact' not in credentials['permissions']
+    
+    def test_permissions_table(self):
+        permission_adapter = CountingPermissionSourceAdapter()
+        plugin = AuthorizationMetadata({'groups': FakeGroupSourceAdapter()},
+                                       {'perms': permission_adapter},
+                                       permissions_table=True)
+        # The permissions were loaded at startup:
+        self.assertEqual(permission_adapter.calls, ['_get_all_sections'])
+        for userid in ('rms', 'linus', 'sballmer'):
+            plugin.add_metadata({}, {'repoze.who.userid': userid})
+        identity = {'repoze.who.userid': 'rms'}
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('admins', 'developers'),
+                                           ('edit-site', 'commit'))
+        # The permission adapter was not used on the requests:
+        self.assertEqual(permission_adapter.calls, ['_get_all_sections'])
+    
+    def test_permissions_table_is_reloaded_on_changes(self):
+        permission_adapter = CountingPermissionSourceAdapter()
+        plugin = AuthorizationMetadata({'groups': FakeGroupSourceAdapter()},
+                                       {'perms': permission_adapter},
+                                       permissions_table=True)
+        permission_adapter.include_item(u'see-site', u'developers')
+        identity = {'repoze.who.userid': 'linus'}
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', ),
+                                           ('edit-site', 'commit', 'see-site'))
+        self.assertEqual(permission_adapter.calls.count('_get_all_sections'),
+                         2)
+    
+    def test_permissions_table_expires(self):
+        permission_adapter = CountingPermissionSourceAdapter()
+        plugin = AuthorizationMetadata({'groups': FakeGroupSourceAdapter()},
+                                       {'perms': permission_adapter},
+                                       permissions_table=True,
+                                       permissions_table_ttl=60)
+        now = [plugin._timer()]
+        plugin._timer = lambda: now[0]
+        plugin.load_permissions_table()
+        # The table is modified behind the adapter's back:
+        permission_adapter.fake_sections[u'see-site'].add(u'developers')
+        identity = {'repoze.who.userid': 'linus'}
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', ),
+                                           ('edit-site', 'commit'))
+        # And it's taken into account once the table expires:
+        now[0] += 60
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', ),
+                                           ('edit-site', 'commit', 'see-site'))
+    
+    def test_bypassed_paths(self):
+        group_adapter = CountingGroupFetcher()
+        plugin = AuthorizationMetadata({'tech-team': group_adapter},
+                                       {'perms': FakePermissionFetcher2()},
+                                       bypass_paths=['/static/', '/health'],
+                                       bypass_patterns=[r'.*\.ico$'])
+        for path in ('/static/logo.png', '/health', '/favicon.ico'):
+            environ = {'PATH_INFO': path}
+            plugin.add_metadata(environ, {'repoze.who.userid': 'rms'})
+            credentials = environ['repoze.what.credentials']
+            self.assertEqual(credentials['repoze.what.userid'], 'rms')
+            assert not credentials['groups'].loaded
+        self.assertEqual(group_adapter.userids, [])
+        # The groups and permissions are still available:
+        assert 'directors' in credentials['groups']
+        self.assertEqual(group_adapter.userids, ['rms'])
+    
+    def test_non_bypassed_paths(self):
+        group_adapter = CountingGroupFetcher()
+        plugin = AuthorizationMetadata({'tech-team': group_adapter},
+                                       {'perms': FakePermissionFetcher2()},
+                                       bypass_paths=['/static/'],
+                                       bypass_patterns=[r'.*\.ico$'])
+        for path in ('/', '/about/static/', '/favicon.icon'):
+            environ = {'PATH_INFO': path}
+            plugin.add_metadata(environ, {'repoze.who.userid': 'rms'})
+        plugin.add_metadata({}, {'repoze.who.userid': 'rms'})
+        self.assertEqual(len(group_adapter.userids), 4)
+    
+    def test_nested_groups(self):
+        identity = {'repoze.who.userid': 'linus'}
+        environ = {}
+        plugin = AuthorizationMetadata({'groups': self._make_nested_groups()},
+                                       {'perms': FakePermissionSourceAdapter()},
+                                       nested_groups=True)
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', 'staff', 'everyone'),
+                                           ('edit-site', 'commit'))
+    
+    def test_nested_groups_on_demand(self):
+        identity = {'repoze.who.userid': 'linus'}
+        environ = {}
+        plugin = AuthorizationMetadata({'groups': self._make_nested_groups()},
+                                       {'perms': FakePermissionSourceAdapter()},
+                                       nested_groups=True,
+                                       credentials_mode='on-demand')
+        plugin.add_metadata(environ, identity)
+        groups = environ['repoze.what.credentials']['groups']
+        assert 'everyone' in groups
+        assert 'staff' in groups
+        assert 'admins' not in groups
+        assert not groups.loaded
+    
+    def test_nested_groups_are_updated_with_the_source(self):
+        group_adapter = self._make_nested_groups()
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': FakePermissionSourceAdapter()},
+                                       nested_groups=True)
+        identity = {'repoze.who.userid': 'sballmer'}
+        # Including a group in another one:
+        group_adapter.include_item(u'staff', u'trolls')
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('trolls', 'staff', 'everyone'),
+                                           ('see-site', ))
+        # Excluding a group from another one:
+        group_adapter.exclude_item(u'everyone', u'staff')
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('trolls', 'staff'),
+                                           ('see-site', ))
+        # Deleting a group:
+        group_adapter.delete_section(u'staff')
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity, ('trolls', ),
+                                           ('see-site', ))
+    
+    def test_cycles_in_nested_groups(self):
+        group_adapter = self._make_nested_groups()
+        group_adapter.fake_sections[u'developers'].add(u'everyone')
+        self.assertRaises(SourceError, AuthorizationMetadata,
+                          {'groups': group_adapter},
+                          {'perms': FakePermissionSourceAdapter()},
+                          nested_groups=True)
+    
+    def test_creating_cycles_in_nested_groups(self):
+        group_adapter = self._make_nested_groups()
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': FakePermissionSourceAdapter()},
+                                       nested_groups=True)
+        self.assertRaises(SourceError, group_adapter.include_item,
+                          u'developers', u'everyone')
+        # The source was not modified, so the plugin can still be created:
+        assert u'everyone' not in group_adapter.fake_sections[u'developers']
+        AuthorizationMetadata({'groups': group_adapter},
+                              {'perms': FakePermissionSourceAdapter()},
+                              nested_groups=True)
+    
+    def test_setting_items_which_create_cycles(self):
+        group_adapter = self._make_nested_groups()
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': FakePermissionSourceAdapter()},
+                                       nested_groups=True)
+        self.assertRaises(SourceError, group_adapter.set_section_items,
+                          u'developers', [u'everyone'])
+        # Nothing was removed either:
+        self.assertEqual(group_adapter.fake_sections[u'developers'],
+                         set([u'rms', u'linus']))
+    
+    def test_creating_a_group_which_belongs_to_itself(self):
+        group_adapter = self._make_nested_groups()
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': FakePermissionSourceAdapter()},
+                                       nested_groups=True)
+        self.assertRaises(SourceError, group_adapter.include_items,
+                          u'staff', [u'staff', u'rms'])
+        assert u'rms' not in group_adapter.fake_sections[u'staff']
+    
+    def test_permission_implications(self):
+        identity = {'repoze.who.userid': 'linus'}
+        environ = {}
+        implications = {
+            u'edit-site': [u'view-site'],
+            u'view-site': [u'see-site'],
+            u'fire': [u'hire'],
+            }
+        plugin = AuthorizationMetadata({'groups': FakeGroupSourceAdapter()},
+                                       {'perms': FakePermissionSourceAdapter()},
+                                       permission_implications=implications)
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', ),
+                                           ('edit-site', 'view-site',
+                                            'see-site', 'commit'))
+    
+    def test_permission_implications_on_demand(self):
+        identity = {'repoze.who.userid': 'linus'}
+        environ = {}
+        implications = {u'edit-site': [u'view-site'],
+                        u'view-site': [u'see-site']}
+        plugin = AuthorizationMetadata({'groups': FakeGroupSourceAdapter()},
+                                       {'perms': FakePermissionSourceAdapter()},
+                                       permission_implications=implications,
+                                       credentials_mode='on-demand')
+        plugin.add_metadata(environ, identity)
+        permissions = environ['repoze.what.credentials']['permissions']
+        assert 'see-site' in permissions
+        assert 'view-site' in permissions
+        assert 'commit' in permissions
+        assert 'hire' not in permissions
+        assert not permissions.loaded
+    
+    def test_cycles_in_permission_implications(self):
+        implications = {u'edit-site': [u'view-site'],
+                        u'view-site': [u'edit-site']}
+        self.assertRaises(ValueError, AuthorizationMetadata,
+                          permission_implications=implications)
+    
+    def test_universal_sections(self):
+        identity = {'repoze.who.userid': 'linus'}
+        environ = {}
+        group_adapter = FakeGroupSourceAdapter()
+        group_adapter.fake_sections[u'python'].add(u'_')
+        permission_adapter = FakePermissionSourceAdapter()
+        permission_adapter.fake_sections[u'see-site'].add(u'_')
+        permission_adapter.fake_sections[u'hire'] = set([u'python'])
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': permission_adapter},
+                                       special_sections=True)
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', 'python'),
+                                           ('edit-site', 'commit',
+                                            'see-site', 'hire'))
+    
+    def test_universal_sections_on_demand(self):
+        identity = {'repoze.who.userid': 'linus'}
+        environ = {}
+        group_adapter = FakeGroupSourceAdapter()
+        group_adapter.fake_sections[u'python'].add(u'_')
+        permission_adapter = FakePermissionSourceAdapter()
+        permission_adapter.fake_sections[u'hire'] = set([u'_'])
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': permission_adapter},
+                                       special_sections=True,
+                                       credentials_mode='on-demand')
+        plugin.add_metadata(environ, identity)
+        credentials = environ['repoze.what.credentials']
+        assert 'python' in credentials['groups']
+        assert 'php' not in credentials['groups']
+        assert 'hire' in credentials['permissions']
+        assert not credentials['permissions'].loaded
+    
+    def test_special_sections_are_disabled_by_default(self):
+        identity = {'repoze.who.userid': 'linus'}
+        environ = {}
+        group_adapter = FakeGroupSourceAdapter()
+        group_adapter.fake_sections[u'python'].add(u'_')
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': FakePermissionSourceAdapter()})
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', ),
+                                           ('edit-site', 'commit'))
+        plugin.add_anonymous_metadata(environ)
+        self.assertEqual(environ['repoze.what.credentials'].userid, 'linus')
+    
+    def test_special_sections_are_updated_with_the_source(self):
+        identity = {'repoze.who.userid': 'linus'}
+        group_adapter = FakeGroupSourceAdapter()
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': FakePermissionSourceAdapter()},
+                                       special_sections=True,
+                                       credentials_cache_size=10)
+        plugin.add_metadata({}, identity)
+        group_adapter.include_item(u'trolls', u'_')
+        environ = {}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', 'trolls'),
+                                           ('edit-site', 'commit',
+                                            'see-site'))
+        group_adapter.include_item(u'php', u'-')
+        environ = {}
+        plugin.add_anonymous_metadata(environ)
+        self.assertEqual(environ['repoze.what.credentials']['groups'],
+                         ('php', ))
+    
+    def test_anonymous_sections(self):
+        environ = {}
+        group_adapter = FakeGroupSourceAdapter()
+        group_adapter.fake_sections[u'php'].add(u'-')
+        permission_adapter = FakePermissionSourceAdapter()
+        permission_adapter.fake_sections[u'register'] = set([u'-'])
+        permission_adapter.fake_sections[u'see-site'].add(u'php')
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': permission_adapter},
+                                       special_sections=True)
+        plugin.add_anonymous_metadata(environ)
+        credentials = environ['repoze.what.credentials']
+        self.assertEqual(credentials.userid, None)
+        assert not credentials
+        self.assertEqual(credentials['groups'], ('php', ))
+        self.assertEqual(set(credentials['permissions']),
+                         set(['register', 'see-site']))
+        self.assertEqual(environ['repoze.what.adapters']['groups'],
+                         {'groups': group_adapter})
+        # The anonymous sections don't apply to authenticated users:
+        environ = {}
+        identity = {'repoze.who.userid': 'linus'}
+        plugin.add_metadata(environ, identity)
+        self._check_groups_and_permissions(environ, identity,
+                                           ('developers', ),
+                                           ('edit-site', 'commit'))
+        plugin.add_anonymous_metadata(environ)
+        self.assertEqual(environ['repoze.what.credentials'].userid, 'linus')
+    
+    def test_finding_users(self):
+        plugin = AuthorizationMetadata({'groups': FakeGroupSourceAdapter()},
+                                       {'perms': FakePermissionSourceAdapter()})
+        def find_users(predicate, all_userids=None):
+            return sorted(plugin.find_users(predicate, all_userids))
+        self.assertEqual(find_users(in_group(u'developers')),
+                         [u'linus', u'rms'])
+        self.assertEqual(find_users(has_permission(u'see-site')),
+                         [u'sballmer'])
+        self.assertEqual(find_users(All(has_permission(u'edit-site'),
+                                        Not(in_group(u'admins')))),
+                         [u'linus'])
+        self.assertEqual(find_users(Any(is_user(u'guido'),
+                                        in_any_group(u'trolls', u'php'))),
+                         [u'guido', u'sballmer'])
+        self.assertEqual(find_users(has_all_permissions(u'commit',
+                                                        u'see-site')), [])
+        self.assertEqual(find_users(Not(in_group(u'developers'))),
+                         [u'sballmer'])
+        self.assertEqual(find_users(not_anonymous(), [u'rms', u'guido']),
+                         [u'guido', u'rms'])
+        self.assertEqual(find_users(is_anonymous()), [])
+        self.assertRaises(ValueError, plugin.find_users,
+                          All(in_group(u'admins'), FakePredicate()))
+    
+    def test_finding_users_fetches_sections_at_once(self):
+        group_adapter = FakeGroupSourceAdapter()
+        permission_adapter = FakePermissionSourceAdapter()
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': permission_adapter})
+        requests = []
+        def get_sections_items(sections):
+            requests.append(sorted(sections))
+            return FakeGroupSourceAdapter._get_sections_items(group_adapter,
+                                                              sections)
+        group_adapter._get_sections_items = get_sections_items
+        users = plugin.find_users(Any(in_group(u'trolls'),
+                                      has_permission(u'commit')))
+        self.assertEqual(requests, [[u'developers', u'trolls']])
+        self.assertEqual(sorted(users), [u'linus', u'rms', u'sballmer'])
+    
+    def test_finding_users_with_nested_groups_and_implications(self):
+        group_adapter = self._make_nested_groups()
+        group_adapter.fake_sections[u'python'].add(u'guido')
+        permission_adapter = FakePermissionSourceAdapter()
+        permission_adapter.fake_sections[u'view-site'] = set([u'python'])
+        plugin = AuthorizationMetadata(
+            {'groups': group_adapter}, {'perms': permission_adapter},
+            nested_groups=True,
+            permission_implications={u'edit-site': [u'view-site']})
+        self.assertEqual(sorted(plugin.find_users(in_group(u'everyone'))),
+                         [u'linus', u'rms'])
+        self.assertEqual(sorted(plugin.find_users(
+                                has_permission(u'view-site'))),
+                         [u'guido', u'linus', u'rms'])
+        self.assertEqual(sorted(plugin.find_users(Not(in_group(u'staff')))),
+                         [u'guido', u'sballmer'])
+    
+    def test_finding_users_with_universal_sections(self):
+        group_adapter = FakeGroupSourceAdapter()
+        group_adapter.fake_sections[u'python'].add(u'_')
+        permission_adapter = FakePermissionSourceAdapter()
+        permission_adapter.fake_sections[u'hire'] = set([u'python'])
+        permission_adapter.fake_sections[u'commit'].add(u'-')
+        plugin = AuthorizationMetadata({'groups': group_adapter},
+                                       {'perms': permission_adapter},
+                                       special_sections=True)
+        self.assertEqual(sorted(plugin.find_users(has_permission(u'hire'))),
+                         [u'linus', u'rms', u'sballmer'])
+        self.assertEqual(sorted(plugin.find_users(has_permission(u'commit'))),
+                         [u'linus', u'rms'])
+    
+    def _make_nested_groups(self):
+        """
+        Return a group adapter where "developers" belongs to "staff" and
+        "staff" belongs to "everyone".
+        
+        """
+        group_adapter = FakeGroupSourceAdapter()
+        group_adapter.fake_sections[u'staff'] = set([u'developers'])
+        group_adapter.fake_sections[u'everyone'] = set([u'staff'])
+        return group_adapter
+    
+    def test_unsupported_credentials_mode(self):
+        self.assertRaises(ValueError, AuthorizationMetadata,
+                          credentials_mode='psychic')
+
 
 class TestSetupAuth(unittest.TestCase):
     """Tests for the setup_auth() function"""
@@ -363,6 +1124,41 @@ class TestSetupAuth(unittest.TestCase):
         self.assertEqual(authorization_md.group_adapters, None)
         self.assertEqual(authorization_md.permission_adapters, None)
 
+    def test_authorization_arguments(self):
+        """Some arguments must be passed to AuthorizationMetadata"""
+        groups = {'groups': FakeGroupSourceAdapter()}
+        permissions = {'perms': FakePermissionSourceAdapter()}
+        app = self._makeApp(groups, permissions, permissions_cache_size=20,
+                            permissions_cache_ttl=60)
+        if not hasattr(app, 'name_registry'):
+            environ = self._makeEnviron()
+            name_registry = app.api_factory(environ).name_registry
+        else:
+            name_registry = app.name_registry
+        authorization_md = name_registry['authorization_md']
+        self.assertEqual(authorization_md.permissions_cache.max_size, 20)
+        self.assertEqual(authorization_md.permissions_cache.ttl, 60)
+
+    def test_special_sections(self):
+        """Anonymous users must get the anonymous sections"""
+        group_adapter = FakeGroupSourceAdapter()
+        group_adapter.fake_sections[u'php'].add(u'-')
+        app = self._makeApp({'groups': group_adapter},
+                            {'perms': FakePermissionSourceAdapter()},
+                            special_sections=True)
+        environs = []
+        def inner_app(environ, start_response):
+            environs.append(environ)
+            start_response('200 OK', [])
+            return []
+        app.app.app = inner_app
+        environ = self._makeEnviron({'REQUEST_METHOD': 'GET',
+                                     'PATH_INFO': '/'})
+        app(environ, lambda status, headers, exc_info=None: None)
+        credentials = environs[0]['repoze.what.credentials']
+        self.assertEqual(credentials.userid, None)
+        self.assertEqual(credentials['groups'], ('php', ))
+
     def test_without_authentication(self):
         groups = [FakeGroupSourceAdapter()]
         permissions = [FakePermissionSourceAdapter()]
@@ -383,6 +1179,13 @@ class TestSetupAuth(unittest.TestCase):
         assert isinstance(classifier,
                           default_request_classifier.__class__)
 
+class FakePredicate(Predicate):
+    """Mock predicate which is always met."""
+    
+    def evaluate(self, environ, credentials):
+        pass
+
+
 class DummyApp:
     environ = None
     def __call__(self, environ, start_response):
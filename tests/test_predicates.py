@@ -23,6 +23,9 @@ Tests for the predicates.
 import unittest
 
 from repoze.what import predicates
+from repoze.what.cache import TTLCache
+from repoze.what.credentials import Credentials, SectionSet, LazySections, \
+                                    DemandSections, SectionIndex
 
 from tests.base import FakeLogger, encode_multipart_formdata
 
@@ -34,6 +37,9 @@ class BasePredicateTester(unittest.TestCase):
         """Evaluate a predicate that should be met"""
         self.assertEqual(p.check_authorization(environ), None)
         self.assertEqual(p.is_met(environ), True)
+        credentials = environ.get('repoze.what.credentials', {})
+        self.assertEqual(p.check(environ, credentials), True)
+        self.assertEqual(p.compile()(environ, credentials), True)
     
     def eval_unmet_predicate(self, p, environ, expected_error):
         """Evaluate a predicate that should not be met"""
@@ -47,6 +53,10 @@ class BasePredicateTester(unittest.TestCase):
             self.assertEqual(unicode(error), expected_error)
         # Testing is_met:
         self.assertEqual(p.is_met(environ), False)
+        # Testing check:
+        self.assertEqual(p.check(environ, credentials), False)
+        # Testing the compiled predicate:
+        self.assertEqual(p.compile()(environ, credentials), False)
 
 
 #{ The test suite itself
@@ -172,6 +182,43 @@ class TestPredicate(BasePredicateTester):
             }
         self.assertEqual(p.parse_variables(environ), expected_variables)
     
+    def test_variables_are_parsed_once_per_request(self):
+        from StringIO import StringIO
+        content_type, body = encode_multipart_formdata([('postvar1', 'valA')])
+        environ = {
+            'QUERY_STRING': 'getvar1=val1',
+            'REQUEST_METHOD':'POST',
+            'wsgi.input': StringIO(body),
+            'CONTENT_TYPE': content_type,
+            'CONTENT_LENGTH': len(body)}
+        variables = EqualsFour().parse_variables(environ)
+        self.assertEqual(variables['post'], {'postvar1': 'valA'})
+        assert EqualsTwo().parse_variables(environ) is variables
+        # The query string has changed:
+        environ['QUERY_STRING'] = 'getvar1=val2'
+        variables = EqualsFour().parse_variables(environ)
+        self.assertEqual(variables['get'], {'getvar1': 'val2'})
+        self.assertEqual(variables['post'], {'postvar1': 'valA'})
+    
+    def test_variables_are_parsed_lazily(self):
+        environ = {
+            'QUERY_STRING': 'getvar1=val1',
+            'REQUEST_METHOD': 'POST',
+            'wsgi.input': UnreadableInput(),
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'CONTENT_LENGTH': '20',
+            'wsgiorg.routing_args': ((), {'language': 'es'})}
+        variables = EqualsFour().parse_variables(environ)
+        self.assertEqual(variables['named_args'], {'language': 'es'})
+        self.assertEqual(variables.get('positional_args'), ())
+        self.assertEqual(variables['get'], {'getvar1': 'val1'})
+        assert 'post' in variables
+        assert 'unknown' not in variables
+        self.assertEqual(variables.get('unknown'), None)
+        self.assertRaises(KeyError, variables.__getitem__, 'unknown')
+        # Using it as a whole parses the body:
+        self.assertRaises(AssertionError, variables.keys)
+    
     def test_credentials_dict_when_anonymous(self):
         """The credentials must be a dict even if the user is anonymous"""
         class CredentialsPredicate(predicates.Predicate):
@@ -187,6 +234,168 @@ class TestPredicate(BasePredicateTester):
         self.assertEqual(True, p.is_met(environ))
 
 
+class TestStreamingPostVariables(BasePredicateTester):
+    
+    def setUp(self):
+        self.boundary = '----------ThIs_Is_tHe_bouNdaRY_$'
+        self.upload = 'x' * 100000 + '\r\n--' + 'y' * 100000
+        self.body = '\r\n'.join([
+            'This is the preamble',
+            '--' + self.boundary,
+            'Content-Disposition: form-data; name="blog_id"',
+            '',
+            '5',
+            '--' + self.boundary,
+            'Content-Disposition: form-data; name="picture"; '
+            'filename="picture.png"',
+            'Content-Type: image/png',
+            '',
+            self.upload,
+            '--' + self.boundary,
+            'Content-Disposition: form-data; name="contents"',
+            '',
+            'Line 1\r\nLine 2\r\n',
+            '--' + self.boundary,
+            'Content-Disposition: form-data; name="blog_id"',
+            '',
+            '6',
+            '--' + self.boundary + '--',
+            '',
+            ])
+        self.environ = make_post_environ(
+            self.body, 'multipart/form-data; boundary="%s"' % self.boundary)
+        self.input = self.environ['wsgi.input']
+    
+    def test_multipart_variables(self):
+        variables = EqualsFour().parse_post_variables(
+            self.environ, ['blog_id', 'picture', 'contents', 'unknown'])
+        self.assertEqual(variables, {'blog_id': '5',
+                                     'contents': 'Line 1\r\nLine 2\r\n'})
+        self.assertEqual(self.environ['wsgi.input'].read(), self.body)
+    
+    def test_parsing_stops_when_the_variables_are_found(self):
+        variables = EqualsFour().parse_post_variables(self.environ,
+                                                      ['blog_id'])
+        self.assertEqual(variables, {'blog_id': '5'})
+        assert self.input.tell() <= predicates._CHUNK_SIZE
+        # The application gets the whole body anyway:
+        input = self.environ['wsgi.input']
+        self.assertEqual(input.read(10), self.body[:10])
+        self.assertEqual(input.readline(), self.body[10:22])
+        self.assertEqual(input.read(), self.body[22:])
+        self.assertEqual(input.read(), '')
+    
+    def test_parsing_is_resumed(self):
+        p = EqualsFour()
+        self.assertEqual(p.parse_post_variables(self.environ, ['blog_id']),
+                         {'blog_id': '5'})
+        self.assertEqual(p.parse_post_variables(self.environ, ['contents']),
+                         {'contents': 'Line 1\r\nLine 2\r\n'})
+        assert isinstance(self.environ['repoze.what.form_parser'].input,
+                          predicates._ReplayableInput)
+        self.assertEqual(''.join(self.environ['wsgi.input']), self.body)
+    
+    def test_parsing_is_resumed_after_the_maximum_size(self):
+        p = EqualsFour()
+        # The body is truncated in the middle of the contents:
+        max_size = self.body.index('Line 2')
+        self.assertEqual(p.parse_post_variables(self.environ, ['contents'],
+                                                max_size),
+                         {})
+        self.assertEqual(self.input.tell(), max_size)
+        self.assertEqual(p.parse_post_variables(self.environ, ['contents'],
+                                                max_size + 3),
+                         {})
+        self.assertEqual(p.parse_post_variables(self.environ, ['contents']),
+                         {'contents': 'Line 1\r\nLine 2\r\n'})
+        self.assertEqual(self.environ['wsgi.input'].read(), self.body)
+    
+    def test_maximum_size(self):
+        variables = EqualsFour().parse_post_variables(
+            self.environ, ['blog_id', 'contents'], 1000)
+        self.assertEqual(variables, {'blog_id': '5'})
+        self.assertEqual(self.input.tell(), 1000)
+        self.assertEqual(self.environ['wsgi.input'].read(), self.body)
+    
+    def test_small_chunks(self):
+        original_chunk_size = predicates._CHUNK_SIZE
+        predicates._CHUNK_SIZE = 3
+        try:
+            variables = EqualsFour().parse_post_variables(
+                self.environ, ['contents', 'picture'])
+        finally:
+            predicates._CHUNK_SIZE = original_chunk_size
+        self.assertEqual(variables, {'contents': 'Line 1\r\nLine 2\r\n'})
+    
+    def test_variables_are_parsed_afterwards_as_usual(self):
+        p = EqualsFour()
+        p.parse_post_variables(self.environ, ['blog_id'])
+        variables = p.parse_variables(self.environ)
+        self.assertEqual(variables['post'].getall('blog_id'), ['5', '6'])
+        self.assertEqual(variables['post']['picture'].value, self.upload)
+        # The variables parsed by Paste are used then:
+        self.assertEqual(p.parse_post_variables(self.environ,
+                                                ['contents', 'picture']),
+                         {'contents': 'Line 1\r\nLine 2\r\n'})
+    
+    def test_urlencoded_variables(self):
+        original_chunk_size = predicates._CHUNK_SIZE
+        predicates._CHUNK_SIZE = 4
+        body = 'blog_id=5&contents=Hello+world%21&empty=&blog_id=6&last=yes'
+        environ = make_post_environ(body, 'application/x-www-form-urlencoded')
+        try:
+            variables = EqualsFour().parse_post_variables(
+                environ, ['blog_id', 'contents', 'empty', 'last', 'unknown'])
+        finally:
+            predicates._CHUNK_SIZE = original_chunk_size
+        self.assertEqual(variables, {'blog_id': '5',
+                                     'contents': 'Hello world!',
+                                     'empty': '',
+                                     'last': 'yes'})
+        self.assertEqual(environ['wsgi.input'].read(), body)
+    
+    def test_urlencoded_variables_up_to_the_maximum_size(self):
+        body = 'a=1&b=2'
+        environ = make_post_environ(body, 'application/x-www-form-urlencoded')
+        variables = EqualsFour().parse_post_variables(environ, ['a', 'b'],
+                                                      len(body))
+        self.assertEqual(variables, {'a': '1', 'b': '2'})
+        # But the last variable is not found if the body is longer:
+        environ = make_post_environ(body + '&c=3',
+                                    'application/x-www-form-urlencoded')
+        variables = EqualsFour().parse_post_variables(environ, ['a', 'b'],
+                                                      len(body))
+        self.assertEqual(variables, {'a': '1'})
+    
+    def test_truncated_urlencoded_variables(self):
+        body = 'blog_id=5&contents=Hello+world'
+        environ = make_post_environ(body, 'application/x-www-form-urlencoded')
+        variables = EqualsFour().parse_post_variables(
+            environ, ['blog_id', 'contents'], 20)
+        self.assertEqual(variables, {'blog_id': '5'})
+        self.assertEqual(environ['wsgi.input'].read(), body)
+    
+    def test_urlencoded_parsing_is_resumed_after_the_maximum_size(self):
+        body = 'a=1&b=2&c=3&d=4'
+        environ = make_post_environ(body, 'application/x-www-form-urlencoded')
+        p = EqualsFour()
+        self.assertEqual(p.parse_post_variables(environ, ['b'], 4), {})
+        self.assertEqual(p.parse_post_variables(environ, ['d'], 100),
+                         {'d': '4'})
+        self.assertEqual(p.parse_post_variables(environ, ['a', 'b']),
+                         {'a': '1', 'b': '2'})
+        self.assertEqual(environ['wsgi.input'].read(), body)
+    
+    def test_other_bodies(self):
+        environ = make_post_environ('{"blog_id": 5}', 'application/json')
+        input = environ['wsgi.input']
+        self.assertEqual(EqualsFour().parse_post_variables(environ,
+                                                           ['blog_id']), {})
+        assert environ['wsgi.input'] is input
+        self.assertEqual(EqualsFour().parse_post_variables({}, ['blog_id']),
+                         {})
+
+
 class TestDeprecatedPredicate(BasePredicateTester):
     """
     Test that predicates using the deprecated ``_eval_with_environ()`` and
@@ -343,6 +552,13 @@ class TestInGroupPredicate(BasePredicateTester):
         p = predicates.in_group('designers')
         self.eval_unmet_predicate(p, environ,
                     'The current user must belong to the group "designers"')
+    
+    def test_anonymous_user_belongs_to_group(self):
+        environ = {'repoze.what.credentials': Credentials(None, ['guests'])}
+        p = predicates.in_group('guests')
+        self.eval_met_predicate(p, environ)
+        self.eval_unmet_predicate(predicates.not_anonymous(), environ,
+                         'The current user must have been authenticated')
 
 
 class TestInAllGroupsPredicate(BasePredicateTester):
@@ -385,6 +601,87 @@ class TestInAnyGroupsPredicate(BasePredicateTester):
         self.eval_met_predicate(p, environ)
 
 
+class TestSetPredicates(BasePredicateTester):
+    """Tests for the predicates on many groups or permissions."""
+    
+    def test_sets_of_sections(self):
+        credentials = Credentials('gustavo', SectionSet(['admins', 'users']),
+                                  SectionSet(['eat']))
+        environ = {'repoze.what.credentials': credentials}
+        self.eval_met_predicate(predicates.in_all_groups('users', 'admins'),
+                                environ)
+        self.eval_met_predicate(predicates.in_any_group('x', 'users'),
+                                environ)
+        self.eval_unmet_predicate(predicates.in_all_groups('users', 'x', 'y'),
+                                  environ, 'The current user must belong to '
+                                  'the group "x"')
+        self.eval_met_predicate(predicates.has_all_permissions('eat'),
+                                environ)
+        self.eval_unmet_predicate(predicates.has_any_permission('jump', 'run'),
+                                  environ, 'The user must have at least one '
+                                  'of the following permissions: jump, run')
+    
+    def test_sections_loaded_on_demand(self):
+        groups = DemandSections(list, lambda g: g == 'admins')
+        credentials = Credentials('gustavo', groups)
+        environ = {'repoze.what.credentials': credentials}
+        assert predicates.in_any_group('users', 'admins').is_met(environ)
+        assert not predicates.in_all_groups('users', 'admins').is_met(environ)
+        assert not groups.loaded
+    
+    def test_sections_encoded_as_bitmasks(self):
+        group_index = SectionIndex(['users', 'admins', 'x'])
+        permission_index = SectionIndex(['eat', 'jump'])
+        credentials = Credentials('gustavo',
+                                  group_index.encode(['users', 'admins']),
+                                  permission_index.encode(['eat']))
+        environ = {'repoze.what.credentials': credentials}
+        self.eval_met_predicate(predicates.in_all_groups('users', 'admins'),
+                                environ)
+        self.eval_met_predicate(predicates.in_any_group('y', 'users'),
+                                environ)
+        self.eval_unmet_predicate(predicates.in_all_groups('users', 'x', 'y'),
+                                  environ, 'The current user must belong to '
+                                  'the group "x"')
+        self.eval_unmet_predicate(predicates.in_all_groups('users', 'y'),
+                                  environ, 'The current user must belong to '
+                                  'the group "y"')
+        self.eval_met_predicate(predicates.has_all_permissions('eat'),
+                                environ)
+        self.eval_unmet_predicate(predicates.has_any_permission('jump', 'run'),
+                                  environ, 'The user must have at least one '
+                                  'of the following permissions: jump, run')
+        p = predicates.All(predicates.in_group('admins'),
+                           predicates.Not(predicates.has_permission('jump')))
+        self.eval_met_predicate(p, environ)
+    
+    def test_decisions_on_sections_encoded_as_bitmasks(self):
+        index = SectionIndex(['users', 'admins'])
+        decisions = TTLCache(10)
+        p = predicates.in_group('admins')
+        for groups in (['users', 'admins'], ['users']):
+            credentials = Credentials('gustavo', index.encode(groups))
+            environ = {'repoze.what.credentials': credentials,
+                       'repoze.what.decisions': decisions}
+            self.assertEqual(p.is_met(environ), 'admins' in groups)
+        self.assertEqual(len(decisions), 2)
+    
+    def test_predicates_are_available(self):
+        p = predicates.has_any_permission('jump', 'run')
+        self.assertEqual(len(p.predicates), 2)
+        assert isinstance(p.predicates[0], predicates.has_permission)
+        self.assertEqual(p.predicates[1].permission_name, 'run')
+        assert isinstance(p, predicates.Any)
+    
+    def test_failed_predicates_in_custom_message(self):
+        environ = make_environ('gustavo', ['users'])
+        p = predicates.in_any_group('admins', 'developers',
+                                    msg='Denied: %(failed_predicates)s')
+        self.eval_unmet_predicate(p, environ, 'Denied: The current user must '
+                                  'belong to the group "admins", The current '
+                                  'user must belong to the group "developers"')
+
+
 class TestIsAnonymousPredicate(BasePredicateTester):
     
     def test_authenticated_user(self):
@@ -425,6 +722,12 @@ class TestHasPermissionPredicate(BasePredicateTester):
         p = predicates.has_permission('eat')
         self.eval_unmet_predicate(p, environ,
                                   'The user must have the "eat" permission')
+    
+    def test_anonymous_user_has_permission(self):
+        credentials = Credentials(None, permissions=['watch-tv'])
+        environ = {'repoze.what.credentials': credentials}
+        p = predicates.has_permission('watch-tv')
+        self.eval_met_predicate(p, environ)
 
 
 class TestHasAllPermissionsPredicate(BasePredicateTester):
@@ -473,6 +776,662 @@ class TestUserHasAnyPermissionsPredicate(BasePredicateTester):
         self.eval_met_predicate(p, environ)
 
 
+class TestOptimization(BasePredicateTester):
+    
+    def test_flattening(self):
+        p = predicates.All(predicates.All(predicates.not_anonymous(),
+                                          predicates.All(EqualsTwo())),
+                           predicates.Any(predicates.is_user('rms')))
+        optimized = predicates.optimize(p)
+        self.assertEqual(type(optimized), predicates.All)
+        self.assertEqual([type(c) for c in optimized.predicates],
+                         [predicates.not_anonymous, EqualsTwo,
+                          predicates.is_user])
+    
+    def test_double_negations(self):
+        leaf = predicates.is_user('rms')
+        p = predicates.Not(predicates.Not(predicates.Not(leaf)))
+        optimized = predicates.optimize(p)
+        self.assertEqual(type(optimized), predicates.Not)
+        assert optimized.predicate is leaf
+        p = predicates.Not(predicates.Not(leaf), msg='Custom')
+        self.assertEqual(type(predicates.optimize(p)), predicates.Not)
+    
+    def test_duplicates(self):
+        p = predicates.Any(predicates.is_user('rms'), EqualsTwo(),
+                           predicates.is_user('rms'), EqualsTwo())
+        optimized = predicates.optimize(p)
+        self.assertEqual([type(c) for c in optimized.predicates],
+                         [predicates.is_user, EqualsTwo, EqualsTwo])
+    
+    def test_merging_leaves(self):
+        p = predicates.All(predicates.in_group('a'),
+                           predicates.in_all_groups('b', 'a'),
+                           EqualsTwo(),
+                           predicates.has_permission('x'),
+                           predicates.has_permission('y'),
+                           predicates.in_group('c'))
+        optimized = predicates.optimize(p)
+        children = optimized.predicates
+        self.assertEqual([type(c) for c in children],
+                         [predicates.in_all_groups, EqualsTwo,
+                          predicates.has_all_permissions, predicates.in_group])
+        self.assertEqual(children[0].group_names, ('a', 'b'))
+        self.assertEqual(children[2].permission_names, ('x', 'y'))
+        p = predicates.Any(predicates.in_group('a'),
+                           predicates.Any(predicates.in_group('b')))
+        optimized = predicates.optimize(p)
+        self.assertEqual(type(optimized), predicates.in_any_group)
+        self.assertEqual(optimized.group_names, ('a', 'b'))
+    
+    def test_leaves_with_custom_messages_are_not_merged(self):
+        p = predicates.All(predicates.in_group('a'),
+                           predicates.in_group('b', msg='Not in b'))
+        optimized = predicates.optimize(p)
+        self.assertEqual(len(optimized.predicates), 2)
+    
+    def test_subclasses_are_not_optimized(self):
+        class AllOrNothing(predicates.All):
+            pass
+        p = AllOrNothing(predicates.All(predicates.in_group('a')))
+        assert predicates.optimize(p) is p
+    
+    def test_results_and_errors_are_unchanged(self):
+        p = predicates.All(
+            predicates.All(predicates.not_anonymous(),
+                           predicates.in_group('developers')),
+            predicates.All(predicates.in_group('admins')),
+            predicates.in_group('developers'),
+            predicates.has_permission('commit'),
+            predicates.has_all_permissions('edit', 'commit'))
+        optimized = predicates.optimize(p)
+        environs = [
+            {},
+            make_environ('linus', ['developers'], ['commit']),
+            make_environ('rms', ['developers', 'admins'], ['commit']),
+            make_environ('rms', ['developers', 'admins'], ['edit', 'commit']),
+            ]
+        for environ in environs:
+            self.assertEqual(p.is_met(environ), optimized.is_met(environ))
+            credentials = environ.get('repoze.what.credentials', {})
+            try:
+                p.evaluate(environ, credentials)
+                expected_error = None
+            except predicates.NotAuthorizedError, error:
+                expected_error = unicode(error)
+            try:
+                optimized.evaluate(environ, credentials)
+                actual_error = None
+            except predicates.NotAuthorizedError, error:
+                actual_error = unicode(error)
+            self.assertEqual(expected_error, actual_error)
+
+
+class TestPredicateEquality(BasePredicateTester):
+    
+    def test_builtin_predicates(self):
+        p1 = predicates.All(predicates.in_group('admins'),
+                            predicates.Not(predicates.is_user('rms')),
+                            predicates.has_any_permission('edit', 'post'))
+        p2 = predicates.All(predicates.in_group('admins'),
+                            predicates.Not(predicates.is_user('rms')),
+                            predicates.has_any_permission('edit', 'post'))
+        self.assertEqual(p1, p2)
+        self.assertEqual(hash(p1), hash(p2))
+        self.assertEqual(predicates.not_anonymous(),
+                         predicates.not_anonymous())
+        self.assertEqual(len(set([p1, p2, predicates.in_group('admins')])), 2)
+    
+    def test_different_predicates(self):
+        self.assertNotEqual(predicates.in_group('admins'),
+                            predicates.in_group('developers'))
+        self.assertNotEqual(predicates.in_group('admins'),
+                            predicates.has_permission('admins'))
+        self.assertNotEqual(predicates.in_group('admins'),
+                            predicates.in_group('admins', msg='Go away'))
+        self.assertNotEqual(predicates.All(predicates.in_group('admins')),
+                            predicates.Any(predicates.in_group('admins')))
+        self.assertNotEqual(predicates.All(predicates.in_group('admins'),
+                                           predicates.not_anonymous(),
+                                           ordering='cost'),
+                            predicates.All(predicates.in_group('admins'),
+                                           predicates.not_anonymous()))
+        self.assertNotEqual(predicates.in_group('admins'), 'admins')
+    
+    def test_custom_predicates(self):
+        p = EqualsTwo()
+        self.assertEqual(p, p)
+        self.assertNotEqual(p, EqualsTwo())
+        self.assertNotEqual(predicates.Not(p), predicates.Not(EqualsTwo()))
+        self.assertEqual(hash(p), hash(p))
+    
+    def test_predicates_with_unhashable_values(self):
+        p1 = predicates.is_user(['rms'])
+        p2 = predicates.All(predicates.not_anonymous(), p1)
+        self.assertEqual(p1, p1)
+        self.assertNotEqual(p1, predicates.is_user(['rms']))
+        self.assertNotEqual(p2, predicates.All(predicates.not_anonymous(),
+                                               predicates.is_user(['rms'])))
+        self.assertEqual(p1.is_met({}), False)
+        self.assertEqual(p2.is_met(make_environ('rms')), False)
+        self.assertEqual(predicates.optimize(predicates.Any(p1, p1)).predicates,
+                         (p1, p1))
+    
+    def test_hash_is_cached(self):
+        p = predicates.in_group('admins')
+        predicate_hash = hash(p)
+        p.group_name = 'developers'
+        self.assertEqual(hash(p), predicate_hash)
+    
+    def test_interned_predicates(self):
+        p1 = predicates.in_group.interned('admins')
+        p2 = predicates.in_group.interned('admins')
+        p3 = predicates.in_group.interned('developers')
+        assert p1 is p2
+        assert p1 is not p3
+        self.assertEqual(p1, predicates.in_group('admins'))
+        p4 = predicates.All.interned(predicates.in_group('admins'),
+                                     predicates.not_anonymous())
+        p5 = predicates.All.interned(predicates.in_group('admins'),
+                                     predicates.not_anonymous())
+        assert p4 is p5
+    
+    def test_custom_predicates_are_not_interned(self):
+        assert EqualsTwo.interned() is not EqualsTwo.interned()
+
+
+class TestOrderingPredicates(BasePredicateTester):
+    
+    def setUp(self):
+        self.evaluated = []
+    
+    def _make_predicate(self, name, result, cost=1, side_effect_free=True):
+        p = RecordingPredicate(name, result, self.evaluated)
+        p.cost = cost
+        p.side_effect_free = side_effect_free
+        return p
+    
+    def test_declaration_order_by_default(self):
+        p = predicates.All(self._make_predicate('expensive', True, 100),
+                           self._make_predicate('cheap', True))
+        assert p.is_met({})
+        self.assertEqual(self.evaluated, ['expensive', 'cheap'])
+    
+    def test_cost_ordering(self):
+        p = predicates.All(self._make_predicate('expensive', False, 100),
+                           self._make_predicate('medium', True, 10),
+                           self._make_predicate('cheap', False),
+                           ordering='cost')
+        assert not p.is_met({})
+        self.assertEqual(self.evaluated, ['cheap'])
+        self.eval_unmet_predicate(p, {}, 'cheap is not met')
+        self.assertEqual(p.cost, 111)
+        p = predicates.Any(self._make_predicate('expensive', True, 100),
+                           predicates.Not(self._make_predicate('cheap',
+                                                               False)),
+                           ordering='cost')
+        self.evaluated[:] = []
+        assert p.is_met({})
+        self.assertEqual(self.evaluated, ['cheap'])
+    
+    def test_predicates_with_side_effects_are_not_reordered(self):
+        p = predicates.All(self._make_predicate('expensive', True, 100),
+                           self._make_predicate('cheap', True, 1, False),
+                           ordering='cost')
+        assert not p.side_effect_free
+        assert p.is_met({})
+        self.assertEqual(self.evaluated, ['expensive', 'cheap'])
+    
+    def test_adaptive_ordering(self):
+        p = predicates.Any(self._make_predicate('rarely-met', False),
+                           self._make_predicate('usually-met', True),
+                           ordering='adaptive')
+        for i in range(101):
+            assert p.is_met({})
+        self.evaluated[:] = []
+        assert p.is_met({})
+        self.assertEqual(self.evaluated, ['usually-met'])
+        # It's also used when evaluating the predicate:
+        p.evaluate({}, {})
+        self.assertEqual(self.evaluated, ['usually-met', 'usually-met'])
+    
+    def test_unsupported_ordering(self):
+        self.assertRaises(ValueError, predicates.All, ordering='random')
+    
+    def test_builtin_predicates_are_side_effect_free(self):
+        p = predicates.Any(predicates.Not(predicates.not_anonymous()),
+                           predicates.in_all_groups('a', 'b'),
+                           predicates.has_permission('c'))
+        assert p.side_effect_free
+        self.assertEqual(p.cost, 3)
+        assert not predicates.All(EqualsTwo()).side_effect_free
+
+
+class TestMemoizedPredicates(BasePredicateTester):
+    
+    def setUp(self):
+        self.evaluated = []
+    
+    def _make_predicate(self, name, result, memoizable=True):
+        p = RecordingPredicate(name, result, self.evaluated)
+        p.memoizable = memoizable
+        return p
+    
+    def test_results_are_memoized_per_request(self):
+        p = self._make_predicate('met', True)
+        environ = make_environ('gustavo')
+        assert p.is_met(environ)
+        assert p.is_met(environ)
+        p.check_authorization(environ)
+        self.assertEqual(self.evaluated, ['met'])
+        assert p.is_met(make_environ('gustavo'))
+        self.assertEqual(self.evaluated, ['met', 'met'])
+    
+    def test_errors_are_memoized(self):
+        p = self._make_predicate('unmet', False)
+        environ = make_environ('gustavo')
+        assert not p.is_met(environ)
+        for i in range(2):
+            try:
+                p.check_authorization(environ)
+                self.fail('The predicate must not be met')
+            except predicates.NotAuthorizedError, error:
+                self.assertEqual(unicode(error), 'unmet is not met')
+        assert not p.is_met(environ)
+        self.assertEqual(self.evaluated, ['unmet', 'unmet'])
+    
+    def test_predicates_are_not_memoized_by_default(self):
+        p = RecordingPredicate('met', True, self.evaluated)
+        environ = make_environ('gustavo')
+        assert p.is_met(environ)
+        assert p.is_met(environ)
+        self.assertEqual(self.evaluated, ['met', 'met'])
+        p = predicates.All(predicates.not_anonymous(), p)
+        assert not p.memoizable
+    
+    def test_builtin_predicates_are_memoized_by_structure(self):
+        environ = make_environ('gustavo', ['admins'])
+        assert predicates.in_group('admins').is_met(environ)
+        environ['repoze.what.credentials']['groups'] = []
+        assert predicates.in_group('admins').is_met(environ)
+        assert not predicates.in_group('developers').is_met(environ)
+    
+    def test_custom_predicates_are_memoized_by_identity(self):
+        p1 = self._make_predicate('met', True)
+        p2 = self._make_predicate('met', True)
+        environ = make_environ('gustavo')
+        assert p1.is_met(environ)
+        assert p2.is_met(environ)
+        self.assertEqual(self.evaluated, ['met', 'met'])
+    
+    def test_compound_predicates_find_their_flags_once(self):
+        child = self._make_predicate('met', True)
+        p = predicates.All(predicates.not_anonymous(), child)
+        assert p.memoizable
+        child.memoizable = False
+        # Like the hash, it's not updated when the predicates change:
+        assert p.memoizable
+    
+    def test_memo_is_forgotten_when_credentials_change(self):
+        p = predicates.not_anonymous()
+        environ = {}
+        assert not p.is_met(environ)
+        environ.update(make_environ('gustavo'))
+        assert p.is_met(environ)
+
+
+class TestCachedDecisions(BasePredicateTester):
+    
+    def setUp(self):
+        self.evaluated = []
+        self.decisions = TTLCache(10)
+    
+    def _make_predicate(self, name, result, cacheable=True):
+        p = RecordingPredicate(name, result, self.evaluated)
+        p.cacheable = cacheable
+        return p
+    
+    def _make_environ(self, user, groups=None, permissions=None):
+        environ = make_environ(user, groups, permissions)
+        environ['repoze.what.decisions'] = self.decisions
+        return environ
+    
+    def test_results_are_cached_across_requests(self):
+        p = self._make_predicate('met', True)
+        assert p.is_met(self._make_environ('gustavo', ['admins']))
+        assert p.is_met(self._make_environ('gustavo', ['admins']))
+        p.check_authorization(self._make_environ('gustavo', ['admins']))
+        self.assertEqual(self.evaluated, ['met'])
+        # The credentials are different:
+        assert p.is_met(self._make_environ('gustavo', ['developers']))
+        assert p.is_met(self._make_environ('linus', ['admins']))
+        self.assertEqual(self.evaluated, ['met', 'met', 'met'])
+    
+    def test_errors_are_cached_across_requests(self):
+        p = self._make_predicate('unmet', False)
+        for i in range(2):
+            try:
+                p.check_authorization(self._make_environ('gustavo'))
+                self.fail('The predicate must not be met')
+            except predicates.NotAuthorizedError, error:
+                self.assertEqual(unicode(error), 'unmet is not met')
+        assert not p.is_met(self._make_environ('gustavo'))
+        self.assertEqual(self.evaluated, ['unmet'])
+    
+    def test_translated_errors_cached_across_requests(self):
+        message = TranslatedMessage({'en': u'Go away, %(name)s',
+                                     'es': u'Vete, %(name)s'})
+        p = RecordingPredicate('gustavo', False, self.evaluated, msg=message)
+        p.cacheable = True
+        for (language, expected) in (('en', u'Go away, gustavo'),
+                                     ('es', u'Vete, gustavo')):
+            message.language = language
+            try:
+                p.check_authorization(self._make_environ('gustavo'))
+                self.fail('The predicate must not be met')
+            except predicates.NotAuthorizedError, error:
+                self.assertEqual(unicode(error), expected)
+        self.assertEqual(self.evaluated, ['gustavo'])
+    
+    def test_uncacheable_predicates(self):
+        p = self._make_predicate('met', True, cacheable=False)
+        assert p.is_met(self._make_environ('gustavo'))
+        assert p.is_met(self._make_environ('gustavo'))
+        self.assertEqual(self.evaluated, ['met', 'met'])
+        self.assertEqual(len(self.decisions), 0)
+        assert not RecordingPredicate('met', True, []).cacheable
+        assert not predicates.All(predicates.in_group('admins'), p).cacheable
+    
+    def test_builtin_predicates_are_cached(self):
+        p = predicates.All(predicates.in_group('admins'),
+                           predicates.Not(predicates.is_user('linus')))
+        assert p.cacheable
+        environ = self._make_environ('gustavo', ['admins'])
+        assert p.is_met(environ)
+        environ = self._make_environ('gustavo', ['admins'])
+        environ['repoze.what.credentials']['groups'] = []
+        # The credentials are different now:
+        assert not p.is_met(environ)
+        self.assertEqual(len(self.decisions), 2)
+    
+    def test_lazy_sections_are_not_loaded(self):
+        p = self._make_predicate('met', True)
+        loaded = []
+        def load():
+            loaded.append(True)
+            return ['admins']
+        environ = self._make_environ('gustavo')
+        environ['repoze.what.credentials']['groups'] = LazySections(load)
+        assert p.is_met(environ)
+        self.assertEqual(loaded, [])
+    
+    def test_overridden_evaluation_is_not_cached(self):
+        class in_admin_group(predicates.in_group):
+            def evaluate(self, environ, credentials):
+                if environ.get('HTTP_HOST') != 'admin.example.com':
+                    self.unmet()
+                super(in_admin_group, self).evaluate(environ, credentials)
+        class all_on_admin_host(predicates.All):
+            def evaluate(self, environ, credentials):
+                if environ.get('HTTP_HOST') != 'admin.example.com':
+                    self.unmet('Wrong host')
+                super(all_on_admin_host, self).evaluate(environ, credentials)
+        for p in (in_admin_group('admins'),
+                  all_on_admin_host(predicates.in_group('admins'))):
+            environ = self._make_environ('gustavo', ['admins'])
+            environ['HTTP_HOST'] = 'admin.example.com'
+            assert p.is_met(environ)
+            p.check_authorization(environ)
+            environ = self._make_environ('gustavo', ['admins'])
+            environ['HTTP_HOST'] = 'evil.example.com'
+            assert not p.is_met(environ)
+            self.assertRaises(predicates.NotAuthorizedError,
+                              p.check_authorization, environ)
+            assert not predicates.Not(p).cacheable
+        self.assertEqual(len(self.decisions), 0)
+    
+    def test_results_with_unloaded_sections_are_not_cached(self):
+        p = predicates.in_group('admins')
+        results = []
+        for groups in (['admins'], []):
+            environ = self._make_environ('gustavo')
+            credentials = environ['repoze.what.credentials']
+            credentials['groups'] = LazySections(lambda: groups)
+            results.append(p.is_met(environ))
+        # The group was revoked in the source:
+        self.assertEqual(results, [True, False])
+    
+    def test_results_with_loaded_sections_are_cached(self):
+        p = self._make_predicate('met', True)
+        for i in range(2):
+            environ = self._make_environ('gustavo')
+            groups = LazySections(lambda: ['admins'])
+            groups._load()
+            environ['repoze.what.credentials']['groups'] = groups
+            assert p.is_met(environ)
+        self.assertEqual(self.evaluated, ['met'])
+
+
+class TestEvaluatingManyPredicates(BasePredicateTester):
+    
+    def test_results(self):
+        evaluated = []
+        custom = RecordingPredicate('custom', True, evaluated)
+        p = [
+            predicates.not_anonymous(),
+            predicates.All(predicates.not_anonymous(),
+                           predicates.in_group('admins'), custom),
+            predicates.Any(predicates.in_group('admins'),
+                           predicates.Not(predicates.not_anonymous())),
+            predicates.All(predicates.not_anonymous(), custom),
+            predicates.in_any_group('developers', 'admins'),
+            ]
+        environ = make_environ('gustavo', ['developers'])
+        results = predicates.evaluate_many(p, environ)
+        self.assertEqual(results, [True, False, False, True, True])
+        self.assertEqual(evaluated, ['custom'])
+        self.assertEqual(results, [q.is_met(environ) for q in p])
+    
+    def test_shared_predicates_are_evaluated_once(self):
+        evaluated = []
+        shared = RecordingPredicate('shared', True, evaluated)
+        p = [predicates.All(shared, predicates.not_anonymous()),
+             predicates.Any(predicates.is_anonymous(), shared),
+             shared]
+        results = predicates.evaluate_many(p, make_environ('gustavo'))
+        self.assertEqual(results, [True, True, True])
+        self.assertEqual(evaluated, ['shared'])
+    
+    def test_short_circuit(self):
+        evaluated = []
+        p = [predicates.All(predicates.not_anonymous(),
+                            RecordingPredicate('custom', True, evaluated))]
+        self.assertEqual(predicates.evaluate_many(p, {}), [False])
+        self.assertEqual(evaluated, [])
+    
+    def test_networks_are_cached(self):
+        p = [predicates.in_group('admins'), predicates.is_user('gustavo')]
+        self.assertEqual(predicates.evaluate_many(p, make_environ('gustavo')),
+                         [False, True])
+        network = predicates._networks.get(tuple(p))
+        assert network.is_for(tuple(p))
+        self.assertEqual(predicates.evaluate_many(p, make_environ('rms')),
+                         [False, False])
+        assert predicates._networks.get(tuple(p)) is network
+        # Equal built-in predicates use the same network:
+        p = [predicates.in_group('admins'), predicates.is_user('gustavo')]
+        self.assertEqual(predicates.evaluate_many(p, make_environ('gustavo')),
+                         [False, True])
+        assert predicates._networks.get(tuple(p)) is network
+    
+    def test_networks_of_custom_predicates(self):
+        p = [EqualsTwo(), predicates.not_anonymous()]
+        self.assertEqual(predicates.evaluate_many(p, {'test_number': 2}),
+                         [True, False])
+        network = predicates._networks.get(tuple(p))
+        assert network.is_for(tuple(p))
+        assert not network.is_for((EqualsTwo(), predicates.not_anonymous()))
+        self.assertEqual(predicates.evaluate_many([EqualsTwo(), p[1]],
+                                                  {'test_number': 3}),
+                         [False, False])
+
+
+class TestUnmetMessages(BasePredicateTester):
+    
+    def test_messages_are_built_when_converted(self):
+        message = LazyMessage(u'Number %(number)s is wrong')
+        p = EqualsTwo(msg=message)
+        try:
+            p.evaluate({'test_number': 3}, None)
+            self.fail('The predicate must not be met')
+        except predicates.NotAuthorizedError, error:
+            self.assertEqual(message.conversions, 0)
+            self.assertEqual(unicode(error), u'Number 3 is wrong')
+            self.assertEqual(unicode(error), u'Number 3 is wrong')
+            self.assertEqual(str(error), 'Number 3 is wrong')
+        # The "lazy" messages are translated on every conversion:
+        self.assertEqual(message.conversions, 3)
+    
+    def test_messages_converted_concurrently(self):
+        # The message is converted again while it's being converted, as if
+        # by another thread:
+        p = EqualsTwo(msg=ReentrantMessage(u'Number %(number)s is wrong'))
+        try:
+            p.evaluate({'test_number': 3}, None)
+            self.fail('The predicate must not be met')
+        except predicates.NotAuthorizedError, error:
+            p.message.unmet_message = error
+            self.assertEqual(unicode(error), u'Number 3 is wrong')
+            self.assertEqual(p.message.inner_text, u'Number 3 is wrong')
+    
+    def test_failed_predicates_are_joined_when_converted(self):
+        message = LazyMessage(u'Not %(number)s')
+        p = predicates.Any(EqualsTwo(msg=message), EqualsFour())
+        try:
+            p.evaluate({'test_number': 3}, None)
+            self.fail('The predicate must not be met')
+        except predicates.NotAuthorizedError, error:
+            self.assertEqual(message.conversions, 0)
+            self.assertEqual(unicode(error),
+                             u'At least one of the following predicates must '
+                             u"be met: Not 3, Number 3 doesn't equal 4")
+        self.assertEqual(message.conversions, 1)
+    
+    def test_message_equality(self):
+        try:
+            predicates.in_group('admins').evaluate({}, None)
+        except predicates.NotAuthorizedError, error:
+            message = error.args[0]
+        expected = u'The current user must belong to the group "admins"'
+        self.assertEqual(message, expected)
+        self.assertEqual(hash(message), hash(expected))
+        self.assertEqual(repr(message), repr(expected))
+    
+    def test_errors_are_text_compatible(self):
+        p = EqualsTwo(msg=LazyMessage(u'Number %(number)s is wrong'))
+        try:
+            p.evaluate({'test_number': 3}, None)
+            self.fail('The predicate must not be met')
+        except predicates.NotAuthorizedError, error:
+            self.assertEqual(u'Denied: ' + error.message,
+                             u'Denied: Number 3 is wrong')
+            self.assertEqual(error.args, (u'Number 3 is wrong', ))
+            assert isinstance(error.args[0], unicode)
+
+
+class TestCheckingPredicates(BasePredicateTester):
+    
+    def test_builtin_predicates_dont_raise_exceptions(self):
+        p = predicates.Any(predicates.Not(predicates.not_anonymous()),
+                           predicates.in_group('admins'),
+                           predicates.has_any_permission('hire', 'fire'))
+        credentials = make_environ('linus')['repoze.what.credentials']
+        original_unmet = predicates.Predicate.unmet
+        def unmet(self, *args, **kwargs):
+            self.fail('No exception must be raised')
+        predicates.Predicate.unmet = unmet
+        try:
+            self.assertEqual(p.check({}, credentials), False)
+            self.assertEqual(p.is_met({}), True)
+        finally:
+            predicates.Predicate.unmet = original_unmet
+    
+    def test_custom_check_is_used(self):
+        p = predicates.All(EqualsTwoWithCheck(), predicates.not_anonymous())
+        environ = make_environ('rms')
+        environ['test_number'] = 2
+        assert p.is_met(environ)
+        self.assertEqual(EqualsTwoWithCheck.checks, 1)
+    
+    def test_overridden_evaluation_is_used(self):
+        class in_odd_group(predicates.in_group):
+            def evaluate(self, environ, credentials):
+                if len(self.group_name) % 2:
+                    return
+                self.unmet()
+        p = predicates.All(in_odd_group('abc'))
+        self.assertEqual(p.check({}, None), True)
+        self.assertEqual(p.is_met({}), True)
+
+
+class TestCompiledPredicates(BasePredicateTester):
+    
+    def test_builtin_predicates_are_compiled(self):
+        p = predicates.All(predicates.not_anonymous(),
+                           predicates.Not(predicates.in_group('trolls')),
+                           predicates.Any(predicates.is_user('rms'),
+                                          predicates.has_permission('commit')))
+        evaluate = p.compile()
+        self.assertEqual(evaluate.func_code.co_names.count('_is_met'), 0)
+        credentials = make_environ('linus', ['developers'],
+                                   ['commit'])['repoze.what.credentials']
+        assert evaluate({}, credentials)
+        credentials['groups'].append('trolls')
+        assert not evaluate({}, credentials)
+        assert not evaluate({}, None)
+    
+    def test_custom_predicates_are_evaluated(self):
+        p = predicates.Any(EqualsTwo(), predicates.is_user('rms'))
+        evaluate = p.compile()
+        assert evaluate({'test_number': 2}, None)
+        assert not evaluate({'test_number': 3}, None)
+        credentials = make_environ('rms')['repoze.what.credentials']
+        assert evaluate({'test_number': 3}, credentials)
+    
+    def test_overridden_evaluation_is_used(self):
+        class in_odd_group(predicates.in_group):
+            def evaluate(self, environ, credentials):
+                if len(self.group_name) % 2:
+                    return
+                self.unmet()
+        p = in_odd_group('abc')
+        self.assertEqual(p.compile()({}, None), True)
+    
+    def test_empty_compound_predicates(self):
+        self.assertEqual(predicates.All().compile()({}, None), True)
+        self.assertEqual(predicates.Any().compile()({}, None), False)
+    
+    def test_predicate_values_are_not_interpolated(self):
+        p = predicates.in_group('") or ("')
+        credentials = make_environ('rms')['repoze.what.credentials']
+        self.assertEqual(p.compile()({}, credentials), False)
+    
+    def test_deeply_nested_predicates(self):
+        p1 = p2 = predicates.in_group('a')
+        for i in range(50):
+            p1 = predicates.All(predicates.in_group('b'),
+                                predicates.Any(p1, predicates.in_group('c')))
+            p2 = predicates.All(predicates.Not(predicates.Not(p2)))
+        environ = make_environ('rms', ['a', 'b'])
+        credentials = environ['repoze.what.credentials']
+        for p in (p1, p2):
+            self.assertEqual(p.compile()(environ, credentials), True)
+            self.assertEqual(p.is_met(environ), True)
+        credentials['groups'] = ['b']
+        self.assertEqual(p1.compile()({}, credentials), False)
+        self.assertEqual(p2.compile()({}, credentials), False)
+
+
 #{ Test utilities
 
 
@@ -485,9 +1444,84 @@ def make_environ(user, groups=None, permissions=None):
     return environ
 
 
+def make_post_environ(body, content_type):
+    """Make a WSGI environment for a POST request with ``body``"""
+    from StringIO import StringIO
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'wsgi.input': StringIO(body),
+        'CONTENT_TYPE': content_type,
+        'CONTENT_LENGTH': str(len(body))}
+    return environ
+
+
 #{ Mock definitions
 
 
+class LazyMessage(object):
+    """Mock "lazy" translation message, as in Pylons."""
+    
+    def __init__(self, message):
+        self.message = message
+        self.conversions = 0
+    
+    def __unicode__(self):
+        self.conversions += 1
+        return self.message
+
+
+class ReentrantMessage(LazyMessage):
+    """Mock message which converts the unmet message while it's converted."""
+    
+    unmet_message = None
+    
+    inner_text = None
+    
+    def __unicode__(self):
+        if self.conversions == 0 and self.unmet_message is not None:
+            self.conversions += 1
+            self.inner_text = unicode(self.unmet_message)
+        return LazyMessage.__unicode__(self)
+
+
+class TranslatedMessage(object):
+    """Mock "lazy" translation message for the current language."""
+    
+    language = 'en'
+    
+    def __init__(self, translations):
+        self.translations = translations
+    
+    def __unicode__(self):
+        return self.translations[self.language]
+
+
+class UnreadableInput(object):
+    """Mock WSGI input which must not be read."""
+    
+    def read(self, *args):
+        raise AssertionError('The body of the request must not be read')
+    
+    readline = read
+
+
+class RecordingPredicate(predicates.Predicate):
+    """Mock predicate which records its evaluations."""
+    
+    message = "%(name)s is not met"
+    
+    def __init__(self, name, result, evaluated, **kwargs):
+        super(RecordingPredicate, self).__init__(**kwargs)
+        self.name = name
+        self.result = result
+        self.evaluated = evaluated
+    
+    def evaluate(self, environ, credentials):
+        self.evaluated.append(self.name)
+        if not self.result:
+            self.unmet()
+
+
 class MockPredicate(predicates.Predicate):
     message = "I'm a fake predicate"
 
@@ -501,6 +1535,14 @@ class EqualsTwo(predicates.Predicate):
             self.unmet(number=number)
 
 
+class EqualsTwoWithCheck(EqualsTwo):
+    checks = 0
+    
+    def check(self, environ, credentials):
+        EqualsTwoWithCheck.checks += 1
+        return environ.get('test_number') == 2
+
+
 class EqualsFour(predicates.Predicate):
     message = "Number %(number)s doesn't equal 4"
     